@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fees.settings')
 
 application = get_asgi_application()
+
+# Start loading the patent set data in the background, so the first
+# requests don't have to wait for all of it
+from pto.snapshot import warm_up
+warm_up()
@@ -77,6 +77,53 @@ CRONJOBS = [
     ('0 0 * * *', 'pto.pto_cron.update_pto_assignment_data')
 ]
 
+# Load the patent set data in a background thread when the app starts and
+# whenever a new snapshot is published, rather than on first use
+PTO_WARM_UP = True
+
+# Cache of the pto API responses, shared by all the worker processes. Its
+# entries are keyed by snapshot version, so they are never used once a new
+# data snapshot is swapped in, and memcached evicts them as the least
+# recently used ones once it is full. Give it room with memcached's -m
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pto_responses': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+        'TIMEOUT': 86400,
+        'KEY_PREFIX': 'fees',
+    }
+}
+
+PTO_RESPONSE_CACHE = 'pto_responses'
+
+# Largest pto API response kept in the response cache, in bytes. It has to
+# fit in one memcached item, which is 1 MB unless memcached's -I raises it
+PTO_RESPONSE_CACHE_MAX_BYTES = 1000000
+
+# Load the initial maintenance fee build with MySQL's LOAD DATA LOCAL INFILE
+# instead of batched INSERTs. Needs 'local_infile' enabled on the connection
+PTO_MYSQL_LOAD_DATA = False
+
+# Keep the downloaded USPTO zip files in the mirror once their data is in
+# the database. Otherwise they are deleted, and downloaded again if needed
+PTO_KEEP_ARCHIVES = True
+
+# Size the mirror of downloaded USPTO zip files is kept under, by deleting
+# the least recently used files
+PTO_MIRROR_MAX_BYTES = 100 * 2**30
+
+# Update the orderings and paid patents of each patent set from the previous
+# snapshot, only sorting the patents that entered the set or changed
+PTO_INCREMENTAL_SETS = True
+
+# Number of incremental updates of the patent sets after which they are
+# checked against a full rebuild, which is used if they differ. 1 checks
+# every update
+PTO_VERIFY_SETS_EVERY = 4
+
 WSGI_APPLICATION = 'fees.wsgi.application'
 
 
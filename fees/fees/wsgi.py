@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fees.settings')
 
 application = get_wsgi_application()
+
+# Start loading the patent set data in the background, so the first
+# requests don't have to wait for all of it
+from pto.snapshot import warm_up
+warm_up()
@@ -0,0 +1,192 @@
+"""
+Parsing of the USPTO assignment data used by pto_cron.py.
+
+The daily and backfile assignment xml files are parsed incrementally, one
+<patent-assignment> element at a time, which is turned into a compact
+assignment record and then cleared, so memory doesn't grow with the size
+of the file. The patents of the records are found with a PatentResolver,
+which maps the application and patent numbers of all patents in memory.
+
+The assignment economics dataset is broken up in separate csv files, which
+are joined on their rf_id column. A copy of the schema can be found here:
+uspto/fees/pat_assign_dataset_schema.pdf. The files are read as streams
+straight from the downloaded zip file, and only the assignments of
+patents in the database are kept.
+"""
+
+import io
+import csv
+from xml.etree import ElementTree as ET
+
+
+# Patent fields set from the assignment data, in the order of the values
+# of assignment_updates
+ASSIGNMENT_FIELDS = ['reel_num', 'frame_num', 'correspondent_name',
+                     'correspondent_address', 'pat_assignee_name',
+                     'pat_assignee_address']
+
+
+def csv_rows(csv_zip, name):
+    """Read the rows of a csv file in an open zip file, without its row of
+    column labels.
+    """
+    member = next(info for info in csv_zip.infolist()
+                  if info.filename.split('/')[-1] == name)
+    with csv_zip.open(member) as csv_file:
+        rows = csv.reader(io.TextIOWrapper(csv_file))
+        next(rows, None)
+        yield from rows
+
+
+def assignment_updates(csv_zip, patent_ids):
+    """Join documentid.csv, assignee.csv and assignment.csv of the open
+    assignment csv zip file on rf_id, for the patents in a patent_number ->
+    id map. Returns a dictionary of patent id to the values of
+    ASSIGNMENT_FIELDS, from the last assignment of each patent that has an
+    assignee.
+    """
+    # patents of each assignment, only counting patents we have
+    rf_patents = {}
+    for row in csv_rows(csv_zip, 'documentid.csv'):
+        pk = patent_ids.get(row[9])
+        if pk is not None:
+            rf_patents.setdefault(row[0], []).append(pk)
+
+    # an assignment's assignee name is its last assignee's, and its address
+    # lists the addresses of all its assignees
+    assignees = {}
+    for row in csv_rows(csv_zip, 'assignee.csv'):
+        if row[0] in rf_patents:
+            assignee = assignees.setdefault(row[0], ['', []])
+            assignee[0] = row[1]
+            assignee[1].extend(row[2:])
+
+    updates = {}
+    for row in csv_rows(csv_zip, 'assignment.csv'):
+        if row[0] in assignees:
+            name, address = assignees[row[0]]
+            values = (row[7], row[8], row[2], '\n'.join(row[3:7]), name,
+                      '\n'.join(address))
+            for pk in rf_patents[row[0]]:
+                updates[pk] = values
+    return updates
+
+
+def assignment_record(assignment):
+    """Get an assignment record from a <patent-assignment> element: a
+    (reel_num, frame_num, correspondent_name, correspondent_address,
+    pat_assignee_name, pat_assignee_address, doc_numbers) tuple, where
+    doc_numbers lists the document numbers of each patent property.
+    """
+    reel_num, frame_num, correspondent_name, pat_assignee_name = \
+        '', '', '', ''
+    correspondent_addys, pat_addys, all_doc_nums = [], [], []
+    for record in assignment:
+        if record.tag == 'assignment-record':
+            for assignee_field in record:
+                if assignee_field.tag == 'reel-no':
+                    reel_num = assignee_field.text
+                if assignee_field.tag == 'frame-no':
+                    frame_num = assignee_field.text
+                if assignee_field.tag == 'correspondent':
+                    for cfield in assignee_field:
+                        if cfield.tag == 'name':
+                            correspondent_name = cfield.text
+                        else:
+                            correspondent_addys.append(cfield.text)
+        if record.tag == 'patent-assignees':
+            for pat_assignee in record.findall('./patent-assignee'):
+                for pat_address in pat_assignee:
+                    if pat_address.tag == 'name':
+                        pat_assignee_name = pat_address.text
+                    else:
+                        pat_addys.append(pat_address.text)
+        if record.tag == 'patent-properties':
+            for doc_record in record.findall('./patent-property'):
+                doc_nums = [
+                    doc_id.findtext('./doc-number')
+                    for doc_id in doc_record.findall('.//document-id')
+                ]
+                all_doc_nums.append([doc_num for doc_num in doc_nums
+                                     if doc_num and len(doc_num) < 10])
+    return (reel_num, frame_num, correspondent_name,
+            '\n'.join(addy for addy in correspondent_addys if addy),
+            pat_assignee_name, '\n'.join(addy for addy in pat_addys if addy),
+            all_doc_nums)
+
+
+def xml_assignments(xml_file):
+    """Parse an assignment xml file into assignment records, one at a
+    time. Parsed assignments are removed from the tree.
+    """
+    assignments = None
+    for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'patent-assignments':
+                assignments = element
+        elif element.tag == 'patent-assignment':
+            yield assignment_record(element)
+            if assignments is not None:
+                assignments.clear()
+            else:
+                element.clear()
+
+
+class PatentResolver:
+    """Finds the patents of assignment records in memory, from the (id,
+    patent_number, application_number, correspondent_name) rows of all
+    patents, and keeps track of which patents have no assignment data yet.
+    """
+
+    def __init__(self, rows):
+        self.patents = {}
+        self.applications = {}
+        self.unassigned = set()
+        for pk, patent_number, application_number, name in rows:
+            self.patents[patent_number] = (pk, application_number)
+            # like a get() on application_number, an application number
+            # shared by several patents doesn't match any of them
+            if application_number in self.applications:
+                self.applications[application_number] = None
+            else:
+                self.applications[application_number] = pk
+            if name == '':
+                self.unassigned.add(pk)
+
+    def resolve(self, doc_nums):
+        """Get the id of the patent of a patent property's document
+        numbers, or None. A single number is tried as an application number,
+        then as a patent number. A pair is tried as (application number,
+        patent number), then as (patent number, application number).
+        """
+        if len(doc_nums) == 1:
+            pk = self.applications.get(doc_nums[0])
+            if pk is None:
+                pk = self.patents.get(doc_nums[0], (None,))[0]
+            return pk
+        if len(doc_nums) == 2:
+            for application_number, patent_number in (doc_nums,
+                                                      doc_nums[::-1]):
+                pk, number = self.patents.get(patent_number, (None, None))
+                if number == application_number:
+                    return pk
+        return None
+
+    def updates(self, assignments):
+        """Get a dictionary of patent id to the values of ASSIGNMENT_FIELDS
+        from assignment records. Only patents without a correspondent_name
+        are updated, by the first record with one, and they are no longer
+        unassigned afterwards.
+        """
+        updates = {}
+        for assignment in assignments:
+            # Every now and then an empty record gets included, but it is
+            # always missing the correspondent_name
+            if assignment[2] == '':
+                continue
+            for doc_nums in assignment[6]:
+                pk = self.resolve(doc_nums)
+                if pk in self.unassigned:
+                    self.unassigned.remove(pk)
+                    updates[pk] = assignment[:6]
+        return updates
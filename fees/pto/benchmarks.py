@@ -0,0 +1,825 @@
+"""
+Benchmarks for the data structures and loaders used by the app. They use
+synthetic patents, so they can be run without the USPTO data from the
+django shell, e.g. `./manage.py shell -c "from pto import benchmarks;
+benchmarks.store_memory()"`, and print their results.
+"""
+
+import os
+import csv
+import sys
+import json
+import mmap
+import time
+import pickle
+import random
+import zipfile
+import tempfile
+import subprocess
+import tracemalloc
+import threading
+import multiprocessing
+from array import array
+from timeit import timeit
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from xml.etree import ElementTree as ET
+from datetime import date, timedelta
+
+from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+
+from pto.assignments import (
+    assignment_record, assignment_updates, xml_assignments
+)
+from pto.maintfees import (
+    fee_records, chunk_columns, chunk_tsv, column_rows, parallel_chunks,
+    zip_fee_lines, line_fingerprints, fingerprint_delta
+)
+from pto.constants import SORT_IDS
+from pto.mapfile import MapFile, write_mapfile
+from pto.models import Patent
+from pto.orderings import SortKeys, build_orderings, merge_orderings
+from pto.patentsview import PatentsViewClient, week_ranges
+from pto.pto_cron import DATE_ARRAYS, process_docs
+from pto.serializers import PatentSerializer
+from pto.snapshot import Snapshot, current_version
+from pto.store import FIELDS, PatentStore
+
+
+def synthetic_patents(count=200000, seed=0):
+    """Create unsaved patents resembling a realistic patent set."""
+    rand = random.Random(seed)
+    names = ['ASSIGNEE COMPANY %d INC.' % i for i in range(count//20)]
+    names += ['']*(len(names)//3)
+    first_issue = date(2009, 1, 6)
+    patents = []
+    for pk in range(1, count+1):
+        issue_date = first_issue + timedelta(rand.randrange(4000))
+        name = rand.choice(names)
+        patents.append(Patent(
+            id=pk,
+            patent_number=str(7500000+pk),
+            application_number=str(rand.randrange(11000000, 16000000)),
+            entity_status=rand.choice('NYM'),
+            application_date=issue_date - timedelta(rand.randrange(400, 1500)),
+            issue_date=issue_date,
+            reel_num=str(rand.randrange(10000, 60000)),
+            frame_num=str(rand.randrange(1, 1000)),
+            correspondent_name=rand.choice(names),
+            correspondent_address='%d MAIN STREET\nSUITE %d\nNEW YORK, NY'
+                                  % (rand.randrange(9999), rand.randrange(99)),
+            pat_assignee_name=name,
+            pat_assignee_address=name and 'CITY %d\nSTATE' % (pk % 500)
+        ))
+    return patents
+
+
+def _traced_size(build):
+    """Get the memory still allocated by the result of build()."""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def store_memory(count=200000):
+    """Compare the memory per worker of Patent instances loaded with
+    in_bulk against the columnar PatentStore for the same patents.
+    """
+    patents = synthetic_patents(count)
+    rows = [tuple(getattr(p, field) for field in FIELDS) for p in patents]
+    del patents
+
+    # in_bulk builds model instances from database rows the same way
+    _, qs_size = _traced_size(lambda: {
+        row[0]: Patent.from_db('default', FIELDS, row) for row in rows
+    })
+    _, store_size = _traced_size(lambda: PatentStore(iter(rows)))
+    print('%d patents' % count)
+    print('model instances: %.1f MB' % (qs_size/2**20))
+    print('patent store:    %.1f MB' % (store_size/2**20))
+
+
+def page_render(count=20000, page_size=25, number=2000):
+    """Compare rendering table pages through PatentSerializer and
+    JsonResponse against joining the pre-encoded JSON of the patent store.
+    """
+    patents = synthetic_patents(count)
+    patent_store = PatentStore(
+        tuple(getattr(p, field) for field in FIELDS) for p in patents
+    )
+    page = patents[count//2:count//2+page_size]
+    page_ids = [p.pk for p in page]
+
+    def drf_page():
+        queryset = [PatentSerializer(p).data for p in page]
+        return JsonResponse({'patents': queryset, 'count': count}).content
+
+    def store_page():
+        queryset = patent_store.json_rows(page_ids)
+        return b'{"patents": [%s], "count": %d}' % (queryset, count)
+
+    assert drf_page() == store_page()
+    drf_time = timeit(drf_page, number=number)/number
+    store_time = timeit(store_page, number=number)/number
+    print('%d rows per page' % page_size)
+    print('serializer:   %.3f ms' % (drf_time*1000))
+    print('pre-encoded:  %.3f ms' % (store_time*1000))
+
+
+def _touch(value):
+    """Read every page of the memory mapped data reachable from value."""
+    if isinstance(value, memoryview):
+        return sum(value.cast('B')[::mmap.PAGESIZE])
+    if isinstance(value, dict):
+        return sum(_touch(item) for item in value.values())
+    if hasattr(value, '__dict__'):
+        return _touch(vars(value))
+    return 0
+
+
+def _memory_usage():
+    """Get the RSS, PSS and private memory of this process in kB."""
+    usage = {}
+    with open('/proc/self/smaps_rollup') as smaps:
+        for line in smaps:
+            field = line.split(':')[0]
+            if field in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                usage[field] = int(line.split()[1])
+    return usage
+
+
+def _snapshot_worker(version, results, done):
+    before = _memory_usage()
+    snapshot = Snapshot(version)
+    snapshot.warm_up()
+    _touch(snapshot)
+    after = _memory_usage()
+    results.put({field: after[field]-before[field] for field in after})
+    done.wait()
+
+
+def worker_memory(worker_counts=(1, 2, 4, 8)):
+    """Load the current snapshot in a growing number of worker processes
+    and report how much memory loading it added to them. Linux only, since
+    it reads smaps_rollup.
+
+    RSS counts the shared snapshot pages in every worker, while the private
+    memory per worker and the total PSS of all workers show what is really
+    used. Both should stay flat as workers are added.
+    """
+    version = current_version()
+    print('workers  rss/worker  private/worker  total pss')
+    for workers in worker_counts:
+        results, done = multiprocessing.Queue(), multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(target=_snapshot_worker,
+                                    args=(version, results, done))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        usages = [results.get() for _ in processes]
+        done.set()
+        for process in processes:
+            process.join()
+        rss = sum(usage['Rss'] for usage in usages)/workers
+        private = sum(usage['Private_Clean']+usage['Private_Dirty']
+                      for usage in usages)/workers
+        pss = sum(usage['Pss'] for usage in usages)
+        print('%7d  %7.1f MB  %11.1f MB  %6.1f MB'
+              % (workers, rss/1024, private/1024, pss/1024))
+
+
+# Run in a fresh interpreter by startup_time, printing the time to set up
+# django and import the views, and the time the first request then takes
+STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+from django.test import RequestFactory
+from pto import snapshot, views
+settings.PTO_WARM_UP = sys.argv[1] == 'warm'
+snapshot.warm_up()
+startup = time.perf_counter()-start
+request = RequestFactory().get('/api/update_patents', json.loads(sys.argv[2]))
+start = time.perf_counter()
+views.update_patents(request)
+print(json.dumps([startup, time.perf_counter()-start]))
+"""
+
+
+def startup_time(patent_set='6', repeat=5):
+    """Compare startup time and time to first response of a new process,
+    with and without warming up the current snapshot in the background.
+    """
+    params = json.dumps({
+        'patent_set': patent_set, 'start_row': 0, 'count': 25,
+        'sort_by': 'patent_number', 'descending': 'false', 'unpaid': 'true'
+    })
+    for mode in ('cold', 'warm'):
+        timings = [
+            json.loads(subprocess.check_output(
+                [sys.executable, '-c', STARTUP_SCRIPT, mode, params],
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            ))
+            for _ in range(repeat)
+        ]
+        startup = sum(timing[0] for timing in timings)/repeat
+        first_response = sum(timing[1] for timing in timings)/repeat
+        print('%s: startup %.1f ms, first response %.1f ms'
+              % (mode, startup*1000, first_response*1000))
+
+
+def synthetic_fee_zip(path, count=1000000, seed=0):
+    """Write a zip file resembling MaintFeeEvents.zip with count fee lines,
+    about three per patent.
+    """
+    rand = random.Random(seed)
+    codes = ['M1551', 'M1552', 'M2551', 'M170', 'M171', 'EXP.', 'REM.']
+    lines = []
+    patent_number = 7500000
+    while len(lines) < count:
+        patent_number += 1
+        issue_date = date(2009, 1, 6) + timedelta(rand.randrange(4000))
+        fields = '%011d %s %s %s %s' % (
+            patent_number, rand.randrange(11000000, 16000000),
+            rand.choice('NYM'),
+            (issue_date - timedelta(rand.randrange(400, 1500))).strftime(
+                '%Y%m%d'
+            ),
+            issue_date.strftime('%Y%m%d')
+        )
+        for _ in range(rand.randrange(1, 6)):
+            event_date = issue_date + timedelta(rand.randrange(4000))
+            lines.append('%s %s %s\n' % (fields, event_date.strftime('%Y%m%d'),
+                                         rand.choice(codes)))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as fee_zip:
+        fee_zip.writestr('MaintFeeEvents_20200106.txt', ''.join(lines))
+        fee_zip.writestr('MaintFeeEventsDesc_20200106.txt',
+                         ''.join('%s Description of %s\n' % (code, code)
+                                 for code in codes))
+
+
+# Run in a fresh interpreter by parse_memory, printing the peak RSS in kB
+# before and after parsing the fee zip, and the time spent parsing it
+PARSE_SCRIPT = """
+import sys, json, time, resource, zipfile
+import django
+django.setup()
+from pto.loaders import batches
+from pto.maintfees import fee_lines, fee_records
+mzip = zipfile.ZipFile(sys.argv[2])
+mfile = max(mzip.infolist(), key=lambda info: info.file_size).filename
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if sys.argv[1] == 'readlines':
+    # what update_pto_data did before parsing was streamed
+    with mzip.open(mfile) as main_lines:
+        lines = main_lines.readlines()
+    lines = set([line.decode() for line in lines])
+    split_lines = [line.split() for line in lines]
+    split_lines = [line for line in split_lines
+                   if not line[1].startswith('59')]
+    pat_dict = {}
+    for sline in split_lines:
+        pat_dict.setdefault(sline[0].lstrip('0'), []).append(sline[1:])
+else:
+    with mzip.open(mfile) as member:
+        for batch in batches(fee_records(fee_lines(member))):
+            pass
+elapsed = time.perf_counter()-start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps([before, after, elapsed]))
+"""
+
+
+def parse_memory(line_counts=(250000, 500000, 1000000)):
+    """Compare the peak RSS of reading the maintenance fee file with
+    readlines and sets, as update_pto_data used to, against parsing it as a
+    stream of fee records in batches. The streaming peak should stay flat
+    as the file grows.
+    """
+    print('lines      readlines          streaming')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for count in line_counts:
+            path = os.path.join(tmp_dir, 'maintfees.zip')
+            synthetic_fee_zip(path, count)
+            results = []
+            for mode in ('readlines', 'streaming'):
+                before, after, elapsed = json.loads(subprocess.check_output(
+                    [sys.executable, '-c', PARSE_SCRIPT, mode, path],
+                    env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+                ))
+                results += [(after-before)/1024, elapsed]
+            print('%-9d  +%6.1f MB %5.1f s  +%6.1f MB %5.1f s'
+                  % ((count,) + tuple(results)))
+
+
+def _traced_peak(run):
+    """Get the time taken by run() and the peak memory it allocated."""
+    start = time.perf_counter()
+    run()
+    elapsed = time.perf_counter()-start
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def fee_diff(count=1000000, changed=5000):
+    """Compare finding a week's changed maintenance fee lines through a
+    pickled set of last week's lines against a map file of sorted line
+    fingerprints, showing the time and peak memory of the diff and the size
+    of the saved file.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_path = os.path.join(tmp_dir, 'synthetic.zip')
+        synthetic_fee_zip(synthetic_path, count+changed)
+        lines = list(zip_fee_lines(synthetic_path))
+
+        # last week's lines lack the first added ones, and this week's the
+        # last removed ones
+        zfile = os.path.join(tmp_dir, 'maintfees.zip')
+        old_path = os.path.join(tmp_dir, 'maintfees_old.zip')
+        for path, week_lines in ((old_path, lines[changed:]),
+                                 (zfile, lines[:-changed])):
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as week:
+                week.writestr('MaintFeeEvents.txt', ''.join(week_lines))
+        del lines
+
+        pickle_path = os.path.join(tmp_dir, 'maintfees_old.p')
+        pickle.dump(set(zip_fee_lines(old_path)), open(pickle_path, 'wb'),
+                    protocol=2)
+        map_path = os.path.join(tmp_dir, 'maintfees_fingerprints.map')
+        write_mapfile(map_path, {
+            'fingerprints': line_fingerprints(zip_fee_lines(old_path))
+        })
+
+        def pickle_diff():
+            lines = set(zip_fee_lines(zfile))
+            return lines.difference(pickle.load(open(pickle_path, 'rb')))
+
+        def fingerprint_diff():
+            return fingerprint_delta(
+                MapFile(map_path)['fingerprints'],
+                line_fingerprints(zip_fee_lines(zfile))
+            )
+
+        added, removed = fingerprint_diff()
+        assert len(added) == len(pickle_diff())
+        print('%d lines, %d added, %d removed'
+              % (count, len(added), len(removed)))
+        for name, run, path in (('pickled set', pickle_diff, pickle_path),
+                                ('fingerprints', fingerprint_diff, map_path)):
+            elapsed, peak = _traced_peak(run)
+            print('%-13s diff %.1f s, peak %.1f MB, file %.1f MB'
+                  % (name+':', elapsed, peak/2**20,
+                     os.path.getsize(path)/2**20))
+
+
+def parse_workers(count=2000000, worker_counts=(1, 2, 4, 8)):
+    """Time parsing a decompressed maintenance fee file into the rows the
+    initial build inserts, in one process against a growing pool of worker
+    processes, with the workers passing back columns of the rows or writing
+    them to LOAD DATA files. The main process only turns columns into rows
+    for executemany, so the speedup is bounded by the cores available, and
+    at most the serial time over the cpu time of the main process.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zfile = os.path.join(tmp_dir, 'maintfees.zip')
+        synthetic_fee_zip(zfile, count)
+        path = os.path.join(tmp_dir, 'maintfees.txt')
+        with open(path, 'w') as text_file:
+            text_file.writelines(zip_fee_lines(zfile))
+
+        start = time.perf_counter()
+        chunk_columns(path, 0, os.path.getsize(path), 1)
+        serial = time.perf_counter()-start
+        print('%d lines, %d cores' % (count, os.cpu_count()))
+        print('serial:     %5.1f s' % serial)
+        for name, parse_chunk, rows in (
+                ('columns', chunk_columns, column_rows),
+                ('LOAD DATA files', chunk_tsv, lambda paths: paths)
+        ):
+            print(name)
+            for workers in worker_counts:
+                start, cpu_start = time.perf_counter(), time.process_time()
+                for chunk in parallel_chunks(path, parse_chunk, 1, workers):
+                    rows(chunk[2]), rows(chunk[3])
+                elapsed = time.perf_counter()-start
+                main_cpu = time.process_time()-cpu_start
+                print('%d workers: %5.1f s (%.1fx), main process cpu %.2f s '
+                      '(%.0fx at most)' % (workers, elapsed, serial/elapsed,
+                                           main_cpu, serial/main_cpu))
+
+
+def synthetic_assignment_csvs(csv_dir, count=1000000, seed=0):
+    """Write assignment.csv, documentid.csv and assignee.csv files with
+    count assignments, of patents numbered from 7500001 up.
+    """
+    rand = random.Random(seed)
+    paths = [os.path.join(csv_dir, name+'.csv')
+             for name in ('assignment', 'documentid', 'assignee')]
+    with open(paths[0], 'w') as assignment_file, \
+            open(paths[1], 'w') as document_file, \
+            open(paths[2], 'w') as assignee_file:
+        assignments = csv.writer(assignment_file)
+        documents = csv.writer(document_file)
+        assignees = csv.writer(assignee_file)
+        assignments.writerow(['rf_id', 'file_id', 'cname', 'caddress_1',
+                              'caddress_2', 'caddress_3', 'caddress_4',
+                              'reel_no', 'frame_no'])
+        documents.writerow(['rf_id', 'title', 'lang', 'appno', 'fdate',
+                            'pgpub_doc_num', 'pgpub_date', 'pgpub_country',
+                            'grant_country', 'grant_doc_num', 'grant_date'])
+        assignees.writerow(['rf_id', 'ee_name', 'ee_address_1',
+                            'ee_address_2', 'ee_city'])
+        for rf_id in range(count):
+            assignments.writerow([
+                rf_id, 1, 'CORRESPONDENT %d' % rand.randrange(count//10),
+                '%d MAIN STREET' % rand.randrange(9999), 'SUITE 100', '',
+                'NEW YORK, NY', rand.randrange(10000, 60000),
+                rand.randrange(1, 1000)
+            ])
+            documents.writerow([
+                rf_id, 'SYSTEM AND METHOD', 'ENGLISH',
+                rand.randrange(11000000, 16000000), '2010-01-01', '', '',
+                '', 'US', 7500000+rand.randrange(1, 4*count), '2012-01-01'
+            ])
+            assignees.writerow([rf_id, 'ASSIGNEE %d INC.' % rf_id,
+                                'PO BOX %d' % rf_id, '', 'BOSTON'])
+
+
+def _mapped_data(csv_dir):
+    """Join the assignment csv files the way initial_assignment_data did
+    before it was streamed, into a dict of every assignment.
+    """
+    mapped_dict = {}
+    for name in ('assignee', 'assignment', 'documentid'):
+        with open(os.path.join(csv_dir, name+'.csv')) as csv_file:
+            mapped_dict[name] = list(csv.reader(csv_file))[1:]
+    mapped_data = {}
+    for row in mapped_dict['assignment']:
+        mapped_data[row[0]] = {
+            'correspondent_name': row[2],
+            'correspondent_address': '\n'.join(row[3:7]),
+            'reel_num': row[7], 'frame_num': row[8]
+        }
+    for row in mapped_dict['documentid']:
+        if row[0] in mapped_data:
+            mapped_data[row[0]].update(
+                application_number=row[3], application_date=row[4],
+                patent_number=row[9], issue_date=row[10]
+            )
+    for row in mapped_dict['assignee']:
+        if row[0] in mapped_data:
+            mapped_data[row[0]]['assignee_name'] = row[1]
+            mapped_data[row[0]]['assignee_address'] = '\n'.join(row[2:])
+    return mapped_data
+
+
+def assignment_join(count=1000000, patents=1000000):
+    """Compare the time and peak memory of joining the assignment csv files
+    into a dict of every assignment against the streaming join that only
+    keeps the assignments of patents in the database. A quarter of the
+    synthetic assignments are of one of the given number of patents.
+    """
+    patent_ids = {str(7500000+pk): pk for pk in range(1, patents+1)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_assignment_csvs(tmp_dir, count)
+        print('%d assignments, %d patents' % (count, patents))
+        for name, run in (
+                ('dict of all:', lambda: _mapped_data(tmp_dir)),
+                ('streaming:', lambda: assignment_updates(tmp_dir,
+                                                          patent_ids))):
+            elapsed, peak = _traced_peak(run)
+            print('%-13s %5.1f s, peak %6.1f MB'
+                  % (name, elapsed, peak/2**20))
+
+
+# One <patent-assignment> of a synthetic assignment xml file
+ASSIGNMENT_XML = """<patent-assignment>
+<assignment-record><reel-no>%(reel)d</reel-no><frame-no>%(frame)d</frame-no>
+<last-update-date><date>20190102</date></last-update-date>
+<correspondent><name>CORRESPONDENT %(reel)d</name>
+<address-1>%(reel)d MAIN STREET</address-1><address-2>SUITE 100</address-2>
+<address-3>NEW YORK, NY 10001</address-3></correspondent>
+<conveyance>ASSIGNMENT OF ASSIGNORS INTEREST</conveyance>
+</assignment-record>
+<patent-assignors><patent-assignor><name>INVENTOR, FIRST</name>
+<execution-date><date>20181220</date></execution-date></patent-assignor>
+</patent-assignors>
+<patent-assignees><patent-assignee><name>ASSIGNEE %(frame)d INC.</name>
+<address-1>PO BOX %(frame)d</address-1><city>BOSTON</city><state>MA</state>
+<postcode>02101</postcode></patent-assignee></patent-assignees>
+<patent-properties><patent-property>
+<document-id><country>US</country><doc-number>%(application)d</doc-number>
+<kind>X0</kind><date>20100105</date></document-id>
+<document-id><country>US</country><doc-number>%(patent)d</doc-number>
+<kind>B2</kind><date>20120612</date></document-id>
+<invention-title lang="en">SYSTEM AND METHOD</invention-title>
+</patent-property></patent-properties>
+</patent-assignment>
+"""
+
+
+def synthetic_assignment_zip(path, count=100000, seed=0):
+    """Write a zip file resembling a USPTO assignment backfile, with an
+    xml file of count assignments named after the zip file.
+    """
+    rand = random.Random(seed)
+    xml_name = os.path.basename(path).replace('zip', 'xml')
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as xml_zip:
+        with xml_zip.open(xml_name, 'w') as xml_file:
+            xml_file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                           b'<us-patent-assignments dtd-version="0.8">\n'
+                           b'<patent-assignments>\n')
+            for _ in range(count):
+                xml_file.write((ASSIGNMENT_XML % {
+                    'reel': rand.randrange(10000, 60000),
+                    'frame': rand.randrange(1, 1000),
+                    'application': rand.randrange(11000000, 16000000),
+                    'patent': rand.randrange(7500000, 10500000)
+                }).encode())
+            xml_file.write(b'</patent-assignments>\n'
+                           b'</us-patent-assignments>\n')
+
+
+def _bytes_written():
+    """Get the bytes this process has written, from /proc/self/io."""
+    with open('/proc/self/io') as io_file:
+        for line in io_file:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+
+
+def backfile_reads(files=3, count=100000):
+    """Compare extracting synthetic assignment backfiles to disk and parsing
+    the extracted xml against parsing the xml straight from the zip file,
+    showing the wall time and the bytes written. Linux only, since it reads
+    /proc/self/io.
+    """
+    def extracted(zip_path, tmp_dir):
+        with zipfile.ZipFile(zip_path) as xml_zip:
+            xml_zip.extractall(path=tmp_dir)
+        xml_path = zip_path.replace('zip', 'xml')
+        root = ET.parse(xml_path).getroot()
+        os.remove(xml_path)
+        return len(root.findall('./patent-assignments/'))
+
+    def in_place(zip_path, tmp_dir):
+        with zipfile.ZipFile(zip_path) as xml_zip:
+            with xml_zip.open(os.path.basename(
+                    zip_path.replace('zip', 'xml'))) as xml_file:
+                root = ET.parse(xml_file).getroot()
+        return len(root.findall('./patent-assignments/'))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(1, files+1):
+            paths.append(os.path.join(
+                tmp_dir, 'ad19800101-20191231-%02d.zip' % i
+            ))
+            synthetic_assignment_zip(paths[-1], count, seed=i)
+        print('%d backfiles of %d assignments, %.1f MB zipped'
+              % (files, count,
+                 sum(os.path.getsize(path) for path in paths)/2**20))
+        for name, parse in (('extractall:', extracted),
+                            ('in place:', in_place)):
+            written = _bytes_written()
+            start = time.perf_counter()
+            assignments = sum(parse(path, tmp_dir) for path in paths)
+            elapsed = time.perf_counter()-start
+            written = _bytes_written()-written
+            assert assignments == files*count
+            print('%-12s %5.1f s, %7.1f MB written'
+                  % (name, elapsed, written/2**20))
+
+
+def xml_parse(count=200000):
+    """Compare the peak memory and assignments parsed per second of parsing
+    a synthetic assignment xml file into one tree against parsing it
+    incrementally with iterparse.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zip_path = os.path.join(tmp_dir, 'ad20200101.zip')
+        synthetic_assignment_zip(zip_path, count)
+        xml_path = os.path.join(tmp_dir, 'ad20200101.xml')
+        with zipfile.ZipFile(zip_path) as xml_zip:
+            xml_zip.extractall(path=tmp_dir)
+        print('%d assignments, %.1f MB of xml'
+              % (count, os.path.getsize(xml_path)/2**20))
+
+        def tree():
+            root = ET.parse(xml_path).getroot()
+            for assignment in root.findall('./patent-assignments/'):
+                assignment_record(assignment)
+
+        def incremental():
+            for _ in xml_assignments(xml_path):
+                pass
+
+        for name, parse in (('tree:', tree), ('iterparse:', incremental)):
+            elapsed, peak = _traced_peak(parse)
+            print('%-11s %7.0f assignments/s, peak %6.1f MB'
+                  % (name, count/elapsed, peak/2**20))
+
+
+def _orm_ordered_docs(docs):
+    """Get the orderings of a patent set with a query per ordering, the way
+    process_docs used to.
+    """
+    ordered_docs = {'count': docs.count()}
+    for sort_id in SORT_IDS:
+        if 'name' in sort_id:
+            docs_sorted = docs.extra(select={
+                'has_foo': 'LENGTH(pto_patent.'+sort_id+') > 0'
+            })
+            for prefix, order in (('', sort_id), ('-', '-'+sort_id)):
+                ordered_docs[prefix+sort_id] = array('i', [
+                    p.pk for p in docs_sorted.extra(order_by=['-has_foo',
+                                                              order])
+                ])
+        else:
+            idlst = array('i', [p.pk for p in docs.order_by(sort_id)])
+            ordered_docs[sort_id] = idlst
+            ordered_docs['-'+sort_id] = idlst[::-1]
+    return ordered_docs
+
+
+def sort_orders():
+    """Compare building the orderings of each patent set in the database
+    with a query per ordering against a single scan sorted in memory,
+    showing whether the orderings are the same. Orderings can only differ
+    in how ties are broken, which the queries leave to the database.
+    """
+    for dates in DATE_ARRAYS:
+        for beginning, end in zip(dates, dates[1:]):
+            docs = Patent.objects.filter(issue_date__range=(beginning, end))
+            start = time.perf_counter()
+            orm = _orm_ordered_docs(docs)
+            orm_time = time.perf_counter()-start
+            start = time.perf_counter()
+            scan = process_docs(docs)
+            scan_time = time.perf_counter()-start
+            print('%s to %s: %7d patents, queries %6.2f s, scan %6.2f s, '
+                  'same: %s' % (beginning, end, scan['count'], orm_time,
+                                scan_time, orm == scan))
+
+
+def incremental_sets(count=1000000, shifted=5000, changed=5000):
+    """Compare sorting a synthetic patent set from scratch against merging
+    a day's changes into its previous orderings: shifted patents leaving
+    and entering the set, and changed patents getting new names. Checks
+    that both give the same orderings.
+    """
+    patents = synthetic_patents(count+shifted)
+    rows = [(p.pk,)+tuple(getattr(p, sort_id) for sort_id in SORT_IDS)
+            for p in patents]
+    old_keys = SortKeys(rows[:count])
+    ordered_docs = build_orderings(old_keys)
+
+    rand = random.Random(1)
+    new_rows = rows[shifted:]
+    for i in rand.sample(range(len(new_rows)), changed):
+        new_rows[i] = new_rows[i][:5] + (
+            rand.choice(['', None, 'CHANGED %d INC.' % i]), new_rows[i][6]
+        )
+    sort_keys = SortKeys(new_rows)
+
+    start = time.perf_counter()
+    full = build_orderings(sort_keys)
+    print('full sort: %6.2f s' % (time.perf_counter()-start))
+    start = time.perf_counter()
+    merged, changes = merge_orderings(ordered_docs, old_keys, sort_keys)
+    print('merge:     %6.2f s (%d entered, %d left, %d changed), same: %s'
+          % (time.perf_counter()-start, len(changes['entered']),
+             len(changes['left']), len(changes['changed']), merged == full))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering each request in its own thread."""
+
+    daemon_threads = True
+
+
+class PatentsViewStandIn(BaseHTTPRequestHandler):
+    """Local stand-in for the PatentsView patents query API, answering with
+    per_day synthetic patents for each day of the date range asked for,
+    after a delay of latency seconds. Every failure_rate-th request fails
+    with failure_status, sent with a Retry-After header if retry_after is
+    set, and requests for ranges starting on one of the broken_starts fail
+    with a 404. The server counts the requests it got.
+    """
+
+    per_day = 400
+    latency = 0.05
+    failure_rate = 0
+    failure_status = 503
+    retry_after = None
+    broken_starts = ()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = (self.failure_rate and
+                       server.requests % self.failure_rate == 0)
+        time.sleep(self.latency)
+        query = parse_qs(urlparse(self.path).query)
+        dates = json.loads(query['q'][0])['_and']
+        if dates[0]['_gte']['patent_date'] in self.broken_starts:
+            self.send_error(404)
+            return
+        if failing:
+            self.send_response(self.failure_status)
+            if self.retry_after is not None:
+                self.send_header('Retry-After', str(self.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start = parse_date(dates[0]['_gte']['patent_date'])
+        end = parse_date(dates[1]['_lte']['patent_date'])
+        options = json.loads(query['o'][0])
+        per_page, page = int(options['per_page']), int(options['page'])
+
+        total = ((end-start).days+1)*self.per_day
+        patents = []
+        for i in range((page-1)*per_page, min(page*per_page, total)):
+            day = start+timedelta(i//self.per_day)
+            patents.append({
+                'patent_number': str(day.toordinal()*1000 +
+                                     i % self.per_day),
+                'patent_date': day.isoformat(),
+                'assignees': [{
+                    'assignee_first_name': None,
+                    'assignee_last_name': None,
+                    'assignee_organization': 'ORGANIZATION %d' % (i % 97),
+                    'assignee_lastknown_city': 'CITY',
+                    'assignee_lastknown_state': 'ST',
+                    'assignee_lastknown_country': 'US',
+                    'assignee_lastknown_location_id': str(i % 31)
+                }]
+            })
+        body = json.dumps({'patents': patents or None, 'count': len(patents),
+                           'total_patent_count': total}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_patentsview_standin(**attributes):
+    """Serve a PatentsViewStandIn from a background thread, with some of
+    its class attributes changed. Returns the server, whose url attribute
+    is the API url to use.
+    """
+    handler = type('StandIn', (PatentsViewStandIn,), attributes)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.url = 'http://127.0.0.1:%d/api/patents/query' % server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def patentsview_fetch(weeks=26, per_page=1000, latency=0.05):
+    """Compare fetching half a year of patents from a local PatentsView
+    stand-in one page at a time against fetching with a pool of workers,
+    with every tenth request failing once, then fetch them again from the
+    cache. Checks that every run gets the same patents.
+    """
+    server = start_patentsview_standin(latency=latency, failure_rate=10)
+    beginning = date(2015, 1, 1)
+    ranges = week_ranges(beginning, beginning+timedelta(7*weeks-1))
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, workers, cache in (('sequential', 1, 'a'),
+                                     ('concurrent', 4, 'b'),
+                                     ('cached', 4, 'b')):
+            client = PatentsViewClient(
+                server.url, os.path.join(cache_dir, cache), workers,
+                rate_limit=6000, backoff=0.01, per_page=per_page
+            )
+            served = server.requests
+            start = time.perf_counter()
+            results.append(client.patents(ranges))
+            print('%-10s %6.2f s, %4d requests, %d patents (%s)' % (
+                name, time.perf_counter()-start, server.requests-served,
+                sum(len(patents) for patents in results[-1].values()),
+                ', '.join('%d %s' % (count, key)
+                          for key, count in client.counts.items())
+            ))
+    server.shutdown()
+    print('same patents:', all(result == results[0] for result in results))
@@ -0,0 +1,58 @@
+"""
+HTTP caching for the pto API. Responses only change when the nightly cron
+publishes a new data snapshot, so they are kept in a cache shared by every
+worker process, the Django cache named by settings.PTO_RESPONSE_CACHE,
+keyed on the snapshot version and their normalized query parameters. A
+newer snapshot never sees the entries of older ones. The default backend,
+memcached, is bounded by its memory size and evicts the least recently
+used entries once full, so the older entries go first while the popular
+pages of the current snapshot stay cached. Every response carries an ETag
+derived from the snapshot version, so browsers and proxies can revalidate
+it with a 304.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+
+
+def cached_response(cache_key):
+    """Cache the responses of a view taking the current snapshot, using
+    cache_key to get the normalized parameters of a request's query.
+    Responses larger than settings.PTO_RESPONSE_CACHE_MAX_BYTES aren't
+    cached, so one large export can't push out many popular pages.
+    """
+    def decorator(view):
+        @wraps(view)
+        def cached_view(request, snapshot, *args, **kwargs):
+            key = (view.__name__,) + cache_key(request.GET)
+            digest = hashlib.sha1(repr(key).encode()).hexdigest()
+            etag = '"%s-%s"' % (snapshot.version, digest[:16])
+            if_none_match = parse_etags(
+                request.META.get('HTTP_IF_NONE_MATCH', '')
+            )
+            if etag in if_none_match or '*' in if_none_match:
+                response = HttpResponseNotModified()
+            else:
+                response_cache = caches[settings.PTO_RESPONSE_CACHE]
+                entry_key = 'pto:%s:%s' % (snapshot.version, digest)
+                entry = response_cache.get(entry_key)
+                if entry is None:
+                    response = view(request, snapshot, *args, **kwargs)
+                    if response.status_code != 200 or response.streaming:
+                        return response
+                    entry = (response.content, response['Content-Type'])
+                    if len(entry[0]) <= \
+                            settings.PTO_RESPONSE_CACHE_MAX_BYTES:
+                        response_cache.set(entry_key, entry)
+                response = HttpResponse(entry[0], content_type=entry[1])
+            response['ETag'] = etag
+            patch_cache_control(response, public=True, no_cache=True)
+            return response
+        return cached_view
+    return decorator
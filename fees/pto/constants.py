@@ -49,3 +49,19 @@ ORDERED_PATS = [
     'twelve_year',
     'twelve_year_late'
 ]
+
+# Most patents whose fee events can be loaded by one batch_fee_events request
+MAX_BATCH_PATENTS = 100
+
+# Directory holding the versioned data snapshots generated by pto_cron.py
+SNAPSHOT_DIR = 'snapshots'
+
+# Number of published snapshots kept on disk
+SNAPSHOTS_KEPT = 3
+
+# Content-addressed mirror of the USPTO bulk data files downloaded by
+# pto_cron.py
+MIRROR_DIR = '../../mirror'
+
+# Cache of the PatentsView API responses fetched by pto_cron.py
+API_CACHE_DIR = '../../api_cache'
@@ -0,0 +1,257 @@
+"""
+Downloads of the USPTO bulk data files used by pto_cron.py. Files are
+streamed to disk in chunks, and a failed transfer is resumed with an HTTP
+Range request instead of starting over. Downloaded files are kept in a
+content-addressed mirror, named by their SHA-256, along with an index of
+the ETag, Last-Modified and size each URL had, so a file the server still
+has the same version of is never downloaded twice.
+
+Once the data of a file is in the database, retire_archive applies the
+retention policy: the file is kept in the mirror, or deleted along with
+its mirrored copy unless settings.PTO_KEEP_ARCHIVES is set. Kept files are
+evicted least recently used first once the mirror grows past
+settings.PTO_MIRROR_MAX_BYTES.
+
+Connection errors, timeouts and server errors are retried with a backoff,
+while other client errors, like the 404 of a daily file that isn't out
+yet, fail right away.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from pto.constants import MIRROR_DIR
+
+
+# Size of the chunks files are streamed to disk in
+CHUNK_SIZE = 2**20
+
+# Number of attempts made at downloading a file before giving up
+DOWNLOAD_ATTEMPTS = 5
+
+# Seconds to wait for the server to connect or send data
+TIMEOUT = 60
+
+# Client error statuses that are retried like server errors
+RETRIED_STATUSES = (408, 429)
+
+INDEX_FILE = os.path.join(MIRROR_DIR, 'index.json')
+
+# Shared session, so connections to the USPTO servers are pooled and reused.
+# Files are asked for as they are stored, so their sizes can be checked
+SESSION = requests.Session()
+SESSION.headers['Accept-Encoding'] = 'identity'
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+def _load_index():
+    """Get the mirror's index of URL versions and contents."""
+    try:
+        with open(INDEX_FILE) as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_index(index):
+    """Replace the mirror's index."""
+    with open(INDEX_FILE+'.tmp', 'w') as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+    os.replace(INDEX_FILE+'.tmp', INDEX_FILE)
+
+
+def mirror_path(sha256):
+    """Get the path of the mirrored file with the given SHA-256."""
+    return os.path.join(MIRROR_DIR, sha256[:2], sha256)
+
+
+def _version(headers):
+    """Get what identifies the version of a file from response headers."""
+    size = headers.get('Content-Length')
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'size': int(size) if size is not None else None
+    }
+
+
+def _validator(version):
+    """Get the ETag or date an If-Range header can use, if any. Weak
+    ETags can't be used to resume a download.
+    """
+    etag = version['etag']
+    if etag and not etag.startswith('W/'):
+        return etag
+    return version['last_modified']
+
+
+def _file_sha256(path):
+    """Hash a file in chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _transfer(url, part_path, version):
+    """Stream url into part_path, continuing after the bytes already in it
+    if the server still has the same version. Returns the version that was
+    downloaded, raising an exception if the download was cut short.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset and _validator(version):
+        headers = {'Range': 'bytes=%d-' % offset,
+                   'If-Range': _validator(version)}
+    with SESSION.get(url, headers=headers, stream=True,
+                     timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            os.remove(part_path)
+            raise IOError('Could not resume download of ' + url)
+        response.raise_for_status()
+
+        # anything but a partial response means the whole file is sent
+        if response.status_code == 206:
+            if response.headers.get('ETag', version['etag']) != \
+                    version['etag']:
+                raise IOError('File changed while resuming ' + url)
+        else:
+            offset = 0
+            version = _version(response.headers)
+        with open(part_path, 'ab' if offset else 'wb') as part_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                part_file.write(chunk)
+
+    if version['size'] is not None and \
+            os.path.getsize(part_path) != version['size']:
+        raise IOError('Incomplete download of ' + url)
+    return version
+
+
+def retryable(error):
+    """Whether a failed request may succeed if made again."""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in RETRIED_STATUSES
+    return True
+
+
+def _retrying(description, call):
+    """Call call(), retrying it with a backoff when it fails with an error
+    that may go away.
+    """
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            return call()
+        except (requests.RequestException, IOError) as error:
+            if attempt == DOWNLOAD_ATTEMPTS-1 or not retryable(error):
+                raise
+            print('Retrying %s: %s' % (description, error))
+            time.sleep(2**attempt)
+
+
+def _head(url):
+    """Get the version of url the server has. Servers that don't answer
+    HEAD requests give an empty version, so the file is downloaded.
+    """
+    head = SESSION.head(url, allow_redirects=True, timeout=TIMEOUT)
+    if head.status_code >= 500 or head.status_code in RETRIED_STATUSES:
+        head.raise_for_status()
+    return _version(head.headers if head.ok else {})
+
+
+def _evict(index, keep):
+    """Delete the least recently used mirrored files, other than the one
+    with SHA-256 keep, until the mirror fits in PTO_MIRROR_MAX_BYTES.
+    """
+    used = {}
+    for entry in index.values():
+        used[entry['sha256']] = max(used.get(entry['sha256'], 0),
+                                    entry.get('used', 0))
+    sizes = {sha256: os.path.getsize(mirror_path(sha256))
+             for sha256 in used if os.path.exists(mirror_path(sha256))}
+    total = sum(sizes.values())
+    for sha256 in sorted(sizes, key=used.get):
+        if total <= settings.PTO_MIRROR_MAX_BYTES:
+            break
+        if sha256 != keep:
+            os.remove(mirror_path(sha256))
+            total -= sizes[sha256]
+            for url, entry in list(index.items()):
+                if entry['sha256'] == sha256:
+                    del index[url]
+
+
+def fetch(url):
+    """Download url into the mirror, unless the mirror already has the
+    version the server has, and return the path of the mirrored file.
+    """
+    version = _retrying('HEAD of ' + url, lambda: _head(url))
+    index = _load_index()
+    entry = index.get(url)
+    if entry and _validator(version) and all(
+            entry[key] == version[key]
+            for key in ('etag', 'last_modified', 'size')):
+        path = mirror_path(entry['sha256'])
+        if os.path.exists(path):
+            entry['used'] = time.time()
+            _save_index(index)
+            return path
+
+    # partially downloaded files are kept until they are complete
+    part_dir = os.path.join(MIRROR_DIR, 'partial')
+    os.makedirs(part_dir, exist_ok=True)
+    part_path = os.path.join(part_dir,
+                             hashlib.sha1(url.encode()).hexdigest())
+    version = _retrying('download of ' + url,
+                        lambda: _transfer(url, part_path, version))
+
+    sha256 = _file_sha256(part_path)
+    path = mirror_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(part_path, path)
+    index = _load_index()
+    index[url] = dict(version, sha256=sha256, used=time.time())
+    _evict(index, sha256)
+    _save_index(index)
+    return path
+
+
+def download(url, path):
+    """Download url through the mirror and link the file to path. Since
+    the mirrored file may be linked to path, path must be replaced rather
+    than written to.
+    """
+    mirrored = fetch(url)
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(mirrored, path)
+    except OSError:
+        shutil.copyfile(mirrored, path)
+    return path
+
+
+def retire_archive(path):
+    """Delete a downloaded file whose data is in the database, and its
+    mirrored copy, unless archives are kept.
+    """
+    if settings.PTO_KEEP_ARCHIVES or not os.path.exists(path):
+        return
+    sha256 = _file_sha256(path)
+    index = _load_index()
+    for url, entry in list(index.items()):
+        if entry['sha256'] == sha256:
+            del index[url]
+    _save_index(index)
+    if os.path.exists(mirror_path(sha256)):
+        os.remove(mirror_path(sha256))
+    os.remove(path)
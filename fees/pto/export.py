@@ -0,0 +1,72 @@
+"""
+Generators used by views.py to stream whole patent sets as CSV or NDJSON.
+Rows are produced lazily from the patent store in chunks of EXPORT_CHUNK
+patents, so memory use doesn't depend on the size of the patent set.
+"""
+
+import csv
+import zlib
+
+from pto.store import FIELDS
+
+
+# Number of patents encoded into each chunk of a streamed export
+EXPORT_CHUNK = 1000
+
+
+class _Lines:
+    """File-like object handing back what the csv writer writes."""
+
+    def write(self, line):
+        return line
+
+
+def _chunks(pks):
+    """Split an iterable of patent ids into lists of EXPORT_CHUNK ids."""
+    chunk = []
+    for pk in pks:
+        chunk.append(pk)
+        if len(chunk) == EXPORT_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_rows(patent_store, pks):
+    """Stream patents as CSV, with a header of the PatentSerializer
+    fields.
+    """
+    writer = csv.writer(_Lines())
+    yield writer.writerow(FIELDS).encode()
+    for chunk in _chunks(pks):
+        lines = []
+        for pk in chunk:
+            row = patent_store.row(pk)
+            lines.append(writer.writerow([row[field] for field in FIELDS]))
+        yield ''.join(lines).encode()
+
+
+def ndjson_rows(patent_store, pks):
+    """Stream patents as newline delimited JSON, using the same encoded
+    rows as the patent table.
+    """
+    for chunk in _chunks(pks):
+        yield b'\n'.join(patent_store.json_row(pk) for pk in chunk) + b'\n'
+
+
+def gzip_rows(rows):
+    """Gzip a stream of encoded rows on the fly."""
+    compressor = zlib.compressobj(wbits=31)
+    for row in rows:
+        compressed = compressor.compress(row)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# Row generators and content types of each export format
+EXPORT_FORMATS = {
+    'csv': (csv_rows, 'text/csv'),
+    'ndjson': (ndjson_rows, 'application/x-ndjson')
+}
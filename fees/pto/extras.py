@@ -1,19 +1,21 @@
 """
 All the functions in this file are used to generate constants used by
 views.py and pto_cron.py. Each of the below functions load date or
-pickled data that does not change once the application has started.
+memory mapped data that does not change while a snapshot is being served.
 A cron job updates this information once every night in a separate
 process, after the USPTO has uploaded the latest daily patent data.
-Once the cron job has finished, the processed data is saved and the
-application is restarted.
+Once the cron job has finished, the processed data is saved as a new
+snapshot, which the application swaps in between requests.
 """
 
-import pickle
+import os
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
 from pto.constants import ORDERED_PATS
-from pto.models import Patent
+from pto.indexes import NumberIndex, FeeEventIndex
+from pto.mapfile import MapFile
+from pto.store import PatentStore
 
 
 def yearsago(years, months=0, from_date=None):
@@ -43,26 +45,75 @@ def get_date_arrays():
     return date_arrays
 
 
-def get_ordered_data():
+def get_ordered_docs(snapshot_dir, ordered_file):
+    """Return the orderings of a single patent set."""
+    sections = MapFile(
+        os.path.join(snapshot_dir, ordered_file+'_ordered_ids.map')
+    )
+    ordered_docs = {'unpaid': {}}
+    for name in sections.names():
+        if name.startswith('unpaid:'):
+            ordered_docs['unpaid'][name[len('unpaid:'):]] = sections[name]
+        else:
+            ordered_docs[name] = sections[name]
+    return ordered_docs
+
+
+def get_ordered_data(snapshot_dir):
     """Return all necessary data for app/enhanced pagination speeds."""
-    ordered_dict, ordered_qs = {}, {}
+    ordered_dict = {}
     for ordered_file in ORDERED_PATS:
-        ordered_dict[ordered_file] = pickle.load(
-            open(ordered_file+'_ordered_ids.p', 'rb')
-        )
-        ordered_qs[ordered_file] = Patent.objects.in_bulk(
-            ordered_dict[ordered_file]['patent_number']
-        )
-    return ordered_dict, ordered_qs
+        ordered_dict[ordered_file] = get_ordered_docs(snapshot_dir,
+                                                      ordered_file)
+    return ordered_dict
+
+
+def get_patent_store(snapshot_dir):
+    """Load the columnar store of the patents in every patent set"""
+    patent_store = PatentStore.from_sections(
+        MapFile(os.path.join(snapshot_dir, 'patent_store.map'))
+    )
+    return patent_store
+
+
+def get_number_index(snapshot_dir, ordered_file):
+    """Load the patent number substring index of a single patent set"""
+    number_index = NumberIndex.from_sections(MapFile(
+        os.path.join(snapshot_dir, ordered_file+'_number_index.map')
+    ))
+    return number_index
+
+
+def get_number_indexes(snapshot_dir):
+    """Load the patent number substring index of each patent set"""
+    number_indexes = {}
+    for ordered_file in ORDERED_PATS:
+        number_indexes[ordered_file] = get_number_index(snapshot_dir,
+                                                        ordered_file)
+    return number_indexes
+
+
+def get_fee_event_index(snapshot_dir, ordered_file):
+    """Load the maintenance fee events of the patents in a patent set"""
+    fee_event_index = FeeEventIndex.from_sections(MapFile(
+        os.path.join(snapshot_dir, ordered_file+'_fee_events.map')
+    ))
+    return fee_event_index
 
 
-def get_fee_codes():
+def get_fee_codes(snapshot_dir):
     """Load generated mainenance fee codes defined by the USPTO"""
-    fee_codes = pickle.load(open('fee_event_codes.p', 'rb'))
+    fee_codes = MapFile(
+        os.path.join(snapshot_dir, 'fee_event_codes.map')
+    )['fee_codes']
     return fee_codes
 
 
-def get_paid_patents():
-    """Get patents that have already been paid for each patent set"""
-    paid_patents = pickle.load(open('paid_patents.p', 'rb'))
+def get_paid_patents(snapshot_dir):
+    """Get the sorted ids of the patents that have already been paid for
+    each patent set
+    """
+    sections = MapFile(os.path.join(snapshot_dir, 'paid_patents.map'))
+    paid_patents = {ordered_file: sections[ordered_file]
+                    for ordered_file in ORDERED_PATS}
     return paid_patents
@@ -0,0 +1,210 @@
+"""
+Indexes built alongside the ordered patent sets in pto_cron.py. The number
+index lets the patent number filter used by views.py answer every keystroke
+of the table search box without scanning a whole patent set, and the fee
+event index serves maintenance fee events without querying the database.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import date
+
+from pto.constants import SORT_IDS
+from pto.store import StringPool
+
+
+# Length of the substrings stored in the patent number posting lists
+GRAM_LENGTH = 3
+
+
+class NumberIndex:
+    """Substring index over the patent numbers of a single patent set.
+
+    Patents are referred to by their position in the ascending patent_number
+    ordering of the set. Each substring of GRAM_LENGTH characters maps to a
+    sorted posting list of the positions containing it, and the rank of each
+    position in every other ordering is kept, so matches can be put into
+    the requested table order without visiting non-matching rows.
+    """
+
+    def __init__(self, ordered_docs, numbers, paid_patents):
+        self.ids = ordered_docs['patent_number']
+        positions = {pk: pos for pos, pk in enumerate(self.ids)}
+
+        # patent numbers are unique, so their pool index is their position
+        self.numbers = StringPool()
+        for pk in self.ids:
+            self.numbers.add(numbers[pk])
+        self.numbers.freeze()
+
+        self.paid = bytearray(len(self.ids))
+        for pk in paid_patents:
+            if pk in positions:
+                self.paid[positions[pk]] = 1
+
+        postings = {}
+        for pos, pk in enumerate(self.ids):
+            for gram in _grams(numbers[pk]):
+                postings.setdefault(gram, array('i')).append(pos)
+        self.postings = postings
+
+        # reversed orderings only need their own ranks for the name columns,
+        # since those keep empty values last in both directions
+        self.ranks = {}
+        for sort_id in SORT_IDS[1:]:
+            sort_ids = [sort_id]
+            if 'name' in sort_id:
+                sort_ids.append('-'+sort_id)
+            for rank_id in sort_ids:
+                rank = array('i', bytes(4*len(self.ids)))
+                for i, pk in enumerate(ordered_docs[rank_id]):
+                    rank[positions[pk]] = i
+                self.ranks[rank_id] = rank
+
+    def to_sections(self):
+        """Get the map file sections holding the index."""
+        grams = sorted(self.postings)
+        posting_offsets = array('l', [0])
+        for gram in grams:
+            posting_offsets.append(
+                posting_offsets[-1]+len(self.postings[gram])
+            )
+        sections = {
+            'ids': self.ids,
+            'paid': self.paid,
+            'grams': grams,
+            'posting_offsets': posting_offsets,
+            'postings': array('i', b''.join(
+                self.postings[gram].tobytes() for gram in grams
+            ))
+        }
+        sections.update(self.numbers.to_sections('numbers:'))
+        for rank_id, rank in self.ranks.items():
+            sections['rank:'+rank_id] = rank
+        return sections
+
+    @classmethod
+    def from_sections(cls, sections):
+        """Create an index reading from map file sections."""
+        number_index = cls.__new__(cls)
+        number_index.ids = sections['ids']
+        number_index.paid = sections['paid']
+        number_index.numbers = StringPool.from_sections(sections, 'numbers:')
+        offsets, postings = sections['posting_offsets'], sections['postings']
+        number_index.postings = {
+            gram: postings[offsets[i]:offsets[i+1]]
+            for i, gram in enumerate(sections['grams'])
+        }
+        number_index.ranks = {name[len('rank:'):]: sections[name]
+                              for name in sections.names()
+                              if name.startswith('rank:')}
+        return number_index
+
+    def search(self, filt, sort_by, unpaid=False):
+        """Return the positions of all patents whose number contains filt,
+        ordered by sort_by and optionally leaving out paid patents.
+        """
+        if len(filt) < GRAM_LENGTH:
+            # every occurrence of a short filter lies inside a stored gram
+            matches = set()
+            for gram, posting in self.postings.items():
+                if filt in gram:
+                    matches.update(posting)
+            matches = sorted(matches)
+        else:
+            grams = _grams(filt)
+            candidates = min((self.postings.get(gram, ()) for gram in grams),
+                             key=len)
+            if len(filt) == GRAM_LENGTH:
+                matches = list(candidates)
+            else:
+                matches = [pos for pos in candidates
+                           if filt in self.numbers.get(pos)]
+        if unpaid:
+            matches = [pos for pos in matches if not self.paid[pos]]
+
+        if sort_by == '-patent_number':
+            matches.reverse()
+        elif sort_by != 'patent_number':
+            if sort_by in self.ranks:
+                matches.sort(key=self.ranks[sort_by].__getitem__)
+            else:
+                matches.sort(key=self.ranks[sort_by[1:]].__getitem__,
+                             reverse=True)
+        return matches
+
+    def patent_ids(self, positions):
+        """Convert search result positions into patent ids."""
+        return [self.ids[pos] for pos in positions]
+
+
+class FeeEventIndex:
+    """Maintenance fee events of the patents in a single patent set,
+    grouped by patent with the fee code descriptions resolved in advance.
+
+    Patent ids are kept sorted with the offsets of their events, and each
+    event holds its date as an ordinal and an index into the list of
+    [code, description] pairs used by the patent set.
+    """
+
+    def __init__(self, patent_ids, events, fee_codes):
+        """Build the index from the sorted ids of all the patents in the
+        set and (patent_id, maintenance_date, maintenance_code) tuples
+        sorted by patent id.
+        """
+        self.ids = array('i', patent_ids)
+        self.offsets = array('l', [0])
+        self.dates = array('i')
+        self.codes = array('i')
+        self.code_list = []
+        code_ids = {}
+        events = iter(events)
+        event = next(events, None)
+        for pk in self.ids:
+            while event is not None and event[0] == pk:
+                code = event[2]
+                if code not in code_ids:
+                    code_ids[code] = len(self.code_list)
+                    self.code_list.append([code, fee_codes.get(code, '')])
+                self.dates.append(event[1].toordinal())
+                self.codes.append(code_ids[code])
+                event = next(events, None)
+            self.offsets.append(len(self.dates))
+
+    def to_sections(self):
+        """Get the map file sections holding the index."""
+        return {
+            'ids': self.ids,
+            'offsets': self.offsets,
+            'dates': self.dates,
+            'codes': self.codes,
+            'code_list': self.code_list
+        }
+
+    @classmethod
+    def from_sections(cls, sections):
+        """Create an index reading from map file sections."""
+        fee_event_index = cls.__new__(cls)
+        for name in ('ids', 'offsets', 'dates', 'codes', 'code_list'):
+            setattr(fee_event_index, name, sections[name])
+        return fee_event_index
+
+    def events(self, pk):
+        """Get the [date, code, description] fee events of a patent, or
+        None if the patent isn't in the patent set.
+        """
+        i = bisect_left(self.ids, pk)
+        if i == len(self.ids) or self.ids[i] != pk:
+            return None
+        return [
+            [date.fromordinal(self.dates[j])] + self.code_list[self.codes[j]]
+            for j in range(self.offsets[i], self.offsets[i+1])
+        ]
+
+
+def _grams(number):
+    """Get the unique fixed length substrings of a patent number."""
+    if len(number) <= GRAM_LENGTH:
+        return {number}
+    return {number[i:i+GRAM_LENGTH]
+            for i in range(len(number)-GRAM_LENGTH+1)}
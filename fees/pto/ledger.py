@@ -0,0 +1,41 @@
+"""
+A job ledger for the long running backfills of pto_cron.py. It records
+the state each file of a job reached, along with its row counts and
+timings, in a JSON file that is replaced as a whole on every change, so a
+job that is killed can pick up where it stopped.
+"""
+
+import os
+import json
+
+
+class JobLedger:
+    """The per-file entries of a job, kept in a JSON file. Each entry is a
+    dictionary with the 'state' the file reached and whatever counts and
+    timings were recorded along the way.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as ledger_file:
+                self.entries = json.load(ledger_file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def state(self, name):
+        """Get the state a file reached, or None if it wasn't started."""
+        return self.entries.get(name, {}).get('state')
+
+    def update(self, name, **fields):
+        """Set fields of a file's entry and save the ledger."""
+        self.entries.setdefault(name, {}).update(fields)
+        self.save()
+
+    def save(self):
+        """Replace the ledger file, making sure it is on disk first."""
+        with open(self.path+'.tmp', 'w') as ledger_file:
+            json.dump(self.entries, ledger_file, indent=1, sort_keys=True)
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        os.replace(self.path+'.tmp', self.path)
@@ -0,0 +1,279 @@
+"""
+Database loaders for the fee records parsed from the USPTO MaintFeeEvents
+file (see maintfees.py), used by pto_cron.py. Records are written in large
+batches, one transaction per batch, rather than with a query and an
+autocommit for every patent and fee event. The initial build loads the
+rows a pool of processes parsed from the decompressed file, so it doesn't
+have to build a model instance for every row.
+"""
+
+import os
+import time
+import tempfile
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from pto.maintfees import (chunk_columns, chunk_tsv, column_rows,
+    parallel_chunks)
+from pto.models import Patent, FeeEvents
+
+
+# Number of fee records written per batch and transaction
+BATCH_SIZE = 10000
+
+# Number of patents changed per bulk_update and transaction
+UPDATE_BATCH_SIZE = 1000
+
+# Columns of the patent and fee event rows made by maintfees.chunk_columns
+PATENT_COLUMNS = ['id', 'patent_number', 'application_number',
+                  'entity_status', 'application_date', 'issue_date']
+FEE_EVENT_COLUMNS = ['patent_id', 'maintenance_date', 'maintenance_code']
+
+
+def batches(records, batch_size=BATCH_SIZE):
+    """Split an iterable of records into lists of batch_size records."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def update_patents(updates, fields, batch_size=UPDATE_BATCH_SIZE):
+    """Set fields of patents from a dictionary of patent id to the values of
+    the fields, with one bulk_update and transaction per batch.
+    """
+    for batch in batches(sorted(updates.items()), batch_size):
+        with transaction.atomic():
+            Patent.objects.bulk_update([
+                Patent(id=pk, **dict(zip(fields, values)))
+                for pk, values in batch
+            ], fields)
+
+
+class BulkLoader:
+    """Loads fee records into empty Patent and FeeEvents tables, which is
+    what the initial maintenance fee build does. Each patent is created
+    from the first record seen for it, and the fee events find their patent
+    in a single patent_number -> id map kept for the whole load.
+    load_file loads a whole decompressed file instead, parsed in a pool of
+    worker processes into columns of rows, which are inserted without
+    building model instances.
+    """
+
+    # Parses each chunk of the file given to load_file, in a pool worker
+    parse_chunk = staticmethod(chunk_columns)
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.patent_ids = {}
+        self.counts = {'patents': 0, 'fee events': 0}
+        self.elapsed = 0.0
+
+    def load(self, records):
+        """Load an iterable of fee records, one transaction per batch."""
+        start = time.perf_counter()
+        for batch in batches(records, self.batch_size):
+            with transaction.atomic():
+                self.load_batch(batch)
+        self.elapsed += time.perf_counter()-start
+        return self
+
+    def load_file(self, path, workers=None):
+        """Load a decompressed fee file with the file parsed by a pool of
+        worker processes, one transaction per chunk of the file. The
+        workers number the patents themselves, following the largest id in
+        the table, so the rows they make are inserted as they are.
+        """
+        start = time.perf_counter()
+        first_id = (Patent.objects.aggregate(Max('id'))['id__max'] or 0)+1
+        for patent_count, event_count, patents, events in parallel_chunks(
+                path, self.parse_chunk, first_id, workers
+        ):
+            with transaction.atomic():
+                self.insert_parsed(Patent, PATENT_COLUMNS, patents)
+                self.insert_parsed(FeeEvents, FEE_EVENT_COLUMNS, events)
+            self.counts['patents'] += patent_count
+            self.counts['fee events'] += event_count
+        self.elapsed += time.perf_counter()-start
+        return self
+
+    def insert_parsed(self, model, columns, parsed):
+        """Insert the rows of one table parsed from a chunk of a fee file
+        into the given columns of the model's table, batch_size rows per
+        query.
+        """
+        rows = column_rows(parsed)
+        quote_name = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            quote_name(model._meta.db_table),
+            ', '.join(quote_name(column) for column in columns),
+            ', '.join(['%s']*len(columns))
+        )
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), self.batch_size):
+                cursor.executemany(sql, rows[i:i+self.batch_size])
+
+    def load_batch(self, batch):
+        """Create the new patents of a batch, then all its fee events."""
+        new_patents = {}
+        for record in batch:
+            if record[0] not in self.patent_ids:
+                new_patents.setdefault(record[0], record)
+        if new_patents:
+            self.insert_patents(list(new_patents.values()))
+            self.resolve_ids(new_patents)
+        self.insert_fee_events([
+            (self.patent_ids[record[0]], record[5], record[6])
+            for record in batch
+        ])
+        self.counts['patents'] += len(new_patents)
+        self.counts['fee events'] += len(batch)
+
+    def resolve_ids(self, patent_numbers):
+        """Add the ids of some patent numbers to the patent id map."""
+        self.patent_ids.update(Patent.objects.filter(
+            patent_number__in=list(patent_numbers)
+        ).values_list('patent_number', 'id'))
+
+    def insert_patents(self, records):
+        """Insert a patent for each of the given fee records."""
+        Patent.objects.bulk_create([
+            Patent(
+                patent_number=record[0],
+                application_number=record[1],
+                entity_status=record[2],
+                application_date=record[3],
+                issue_date=record[4],
+            ) for record in records
+        ])
+
+    def insert_fee_events(self, events):
+        """Insert (patent_id, maintenance_date, maintenance_code) events."""
+        FeeEvents.objects.bulk_create([
+            FeeEvents(
+                patent_id=event[0],
+                maintenance_date=event[1],
+                maintenance_code=event[2],
+            ) for event in events
+        ])
+
+    def report(self):
+        """Print how many rows were loaded and how fast."""
+        rows = sum(self.counts.values())
+        print('%s: %s in %.1f s (%.0f rows/sec)' % (
+            type(self).__name__,
+            ', '.join('%d %s' % (count, name)
+                      for name, count in self.counts.items()),
+            self.elapsed, rows/self.elapsed if self.elapsed else 0
+        ))
+
+
+class UpsertLoader(BulkLoader):
+    """Loads fee records into tables that already hold patents, which is
+    what the weekly maintenance fee update does. Existing patents of a
+    batch are found with one query, and only get their entity_status
+    updated when it changed. Fee events are only inserted when the patent
+    doesn't have them yet.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE):
+        super().__init__(batch_size)
+        self.counts = {
+            'patents created': 0, 'patents updated': 0, 'patents skipped': 0,
+            'fee events created': 0, 'fee events skipped': 0
+        }
+
+    def load_batch(self, batch):
+        """Upsert the patents of a batch, then add its new fee events."""
+        # application fields come from the first record of a patent and
+        # the entity_status from its last one
+        first_records, statuses = {}, {}
+        for record in batch:
+            first_records.setdefault(record[0], record)
+            statuses[record[0]] = record[2]
+
+        self.patent_ids = {}
+        changed = []
+        for number, pk, status in Patent.objects.filter(
+                patent_number__in=list(first_records)
+        ).values_list('patent_number', 'id', 'entity_status'):
+            self.patent_ids[number] = pk
+            if status != statuses[number]:
+                changed.append(Patent(id=pk, entity_status=statuses[number]))
+        Patent.objects.bulk_update(changed, ['entity_status'])
+
+        new_patents = {
+            number: first_records[number][:2] + (statuses[number],) +
+                    first_records[number][3:]
+            for number in first_records if number not in self.patent_ids
+        }
+        if new_patents:
+            self.insert_patents(list(new_patents.values()))
+            self.resolve_ids(new_patents)
+
+        existing = set(FeeEvents.objects.filter(
+            patent_id__in=list(self.patent_ids.values())
+        ).values_list('patent_id', 'maintenance_date', 'maintenance_code'))
+        new_events = []
+        for record in batch:
+            event = (self.patent_ids[record[0]], record[5], record[6])
+            if event not in existing:
+                existing.add(event)
+                new_events.append(event)
+        self.insert_fee_events(new_events)
+
+        self.counts['patents created'] += len(new_patents)
+        self.counts['patents updated'] += len(changed)
+        self.counts['patents skipped'] += (len(first_records) -
+                                           len(new_patents) - len(changed))
+        self.counts['fee events created'] += len(new_events)
+        self.counts['fee events skipped'] += len(batch) - len(new_events)
+
+
+class MySQLLoadDataLoader(BulkLoader):
+    """BulkLoader writing each batch through MySQL's LOAD DATA LOCAL INFILE
+    instead of INSERT statements. The database connection needs
+    'local_infile': 1 in its OPTIONS, and the server has to allow it. With
+    load_file, each pool worker writes the files of its own chunk.
+    """
+
+    parse_chunk = staticmethod(chunk_tsv)
+
+    def load_data(self, model, columns, rows):
+        """Write rows to a temporary tab separated file and load it into
+        the given columns of the model's table.
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv',
+                                         delete=False) as tsv:
+            for row in rows:
+                tsv.write('\t'.join(str(value) for value in row) + '\n')
+        self.insert_parsed(model, columns, tsv.name)
+
+    def insert_parsed(self, model, columns, tsv_path):
+        """Load a tab separated file into the given columns of the model's
+        table, then delete it.
+        """
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "LOAD DATA LOCAL INFILE %s INTO TABLE " +
+                    model._meta.db_table + " FIELDS TERMINATED BY '\\t' (" +
+                    ', '.join(columns) + ')',
+                    [tsv_path]
+                )
+        finally:
+            os.remove(tsv_path)
+
+    def insert_patents(self, records):
+        self.load_data(Patent, ['patent_number', 'application_number',
+                                'entity_status', 'application_date',
+                                'issue_date'],
+                       [record[:5] for record in records])
+
+    def insert_fee_events(self, events):
+        self.load_data(FeeEvents, FEE_EVENT_COLUMNS, events)
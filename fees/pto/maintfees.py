@@ -0,0 +1,329 @@
+"""
+Parsing of the USPTO MaintFeeEvents file used by pto_cron.py. Each line of
+the file is a maintenance fee event, which is turned into a fee record:
+a (patent_number, application_number, entity_status, application_date,
+issue_date, maintenance_date, maintenance_code) tuple.
+
+The file has millions of lines, so it is parsed as a stream straight from
+the zip member, and fee records are handed on one at a time.
+
+To find the lines that changed since the previous week, every line is
+reduced to a 64-bit fingerprint. The sorted fingerprints of a week's file
+are kept in a map file, and the added and removed fingerprints come from a
+merge of last week's and this week's fingerprints.
+
+For the initial build, the decompressed file is parsed by a pool of
+processes, each turning a byte range of whole patents into the columns of
+the rows of its patents and fee events, ready to be inserted. The patents
+of every range are counted first, so each process can number its patents
+itself.
+"""
+
+import gc
+import os
+import sys
+import hashlib
+import zipfile
+import multiprocessing
+from array import array
+from collections import deque
+from datetime import date
+from functools import lru_cache
+from itertools import groupby
+
+
+@lru_cache(maxsize=None)
+def parse_date(date_string):
+    """Convert a YYYYMMDD string into a date. There are only a few thousand
+    distinct dates in the file, so they are cached.
+    """
+    return date(int(date_string[:4]), int(date_string[4:6]),
+                int(date_string[6:]))
+
+
+def fee_record(line):
+    """Convert the split fields of a maintenance fee line to a fee record."""
+    patent_number = line[0].lstrip('0')
+    application_number = line[1]
+    entity_status = line[2]
+    application_date = parse_date(line[3])
+    issue_date = parse_date(line[4])
+
+    # if there is no Fee Event Entry Date, set as the patent date
+    try:
+        maintenance_date = parse_date(line[5])
+    except (IndexError, ValueError):
+        maintenance_date = issue_date
+
+    # Deal with entries without maintenance code
+    try:
+        maintenance_code = line[6]
+    except IndexError:
+        maintenance_code = 'N/A'
+    return (patent_number, application_number, entity_status,
+            application_date, issue_date, maintenance_date, maintenance_code)
+
+
+# ISO format of a date, as inserted by the initial build
+iso_date = lru_cache(maxsize=None)(date.isoformat)
+
+# Approximate number of bytes of the fee file parsed by each process task
+CHUNK_SIZE = 2**24
+
+
+def fee_lines(member):
+    """Read the decoded lines of an open zip member one at a time."""
+    for line in member:
+        yield line.decode()
+
+
+def fee_records(lines):
+    """Parse maintenance fee lines into fee records as they are read,
+    leaving out blank lines, repeated lines and the example lines, whose
+    application numbers start with 59. The file is sorted by patent, so
+    only the lines of the current patent are kept to find repeats. Raises
+    ValueError if a patent number comes after a greater one, since repeats
+    could then be missed.
+    """
+    patent_lines = set()
+    patent_number = None
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[1].startswith('59'):
+            continue
+        if fields[0] != patent_number:
+            if patent_number is not None and fields[0] < patent_number:
+                raise ValueError('Fee lines of patent %s after patent %s'
+                                 % (fields[0], patent_number))
+            patent_lines.clear()
+            patent_number = fields[0]
+        if line in patent_lines:
+            continue
+        patent_lines.add(line)
+        yield fee_record(fields)
+
+
+def zip_fee_lines(zip_path):
+    """Read the lines of the maintenance fee data in a MaintFeeEvents zip
+    file, which is its biggest member.
+    """
+    with zipfile.ZipFile(zip_path) as fee_zip:
+        info = max(fee_zip.infolist(), key=lambda info: info.file_size)
+        with fee_zip.open(info) as member:
+            yield from fee_lines(member)
+
+
+def _digest(line):
+    """Hash a line, ignoring its line ending, into 8 bytes."""
+    return hashlib.blake2b(line.rstrip('\r\n').encode(),
+                           digest_size=8).digest()
+
+
+def fingerprint(line):
+    """Get the 64-bit fingerprint of a line, as stored in arrays."""
+    return int.from_bytes(_digest(line), sys.byteorder)
+
+
+def line_fingerprints(lines):
+    """Get the sorted, distinct fingerprints of some lines as an array.
+    Fingerprints are collected in buckets of their top byte, so only one
+    bucket at a time is ever turned into a list of ints to sort it.
+    """
+    top_byte = 7 if sys.byteorder == 'little' else 0
+    buckets = [bytearray() for _ in range(256)]
+    for line in lines:
+        digest = _digest(line)
+        buckets[digest[top_byte]] += digest
+    fingerprints = array('Q')
+    for bucket in buckets:
+        values = array('Q', bytes(bucket))
+        del bucket[:]
+        fingerprints.extend(sorted(set(values)))
+    return fingerprints
+
+
+def fingerprint_delta(old, new):
+    """Merge two sorted fingerprint sequences, returning the sets of
+    fingerprints only in new (added) and only in old (removed).
+    """
+    added, removed = set(), set()
+    old_iter, new_iter = iter(old), iter(new)
+    old_value, new_value = next(old_iter, None), next(new_iter, None)
+    while old_value is not None and new_value is not None:
+        if old_value == new_value:
+            old_value, new_value = next(old_iter, None), next(new_iter, None)
+        elif old_value < new_value:
+            removed.add(old_value)
+            old_value = next(old_iter, None)
+        else:
+            added.add(new_value)
+            new_value = next(new_iter, None)
+    if old_value is not None:
+        removed.add(old_value)
+        removed.update(old_iter)
+    if new_value is not None:
+        added.add(new_value)
+        added.update(new_iter)
+    return added, removed
+
+
+def matching_lines(lines, fingerprints):
+    """Get the lines whose fingerprint is in a set of fingerprints."""
+    for line in lines:
+        if fingerprint(line) in fingerprints:
+            yield line
+
+
+def fee_chunks(path, chunk_size=CHUNK_SIZE):
+    """Split a decompressed fee file into (start, end) byte ranges of about
+    chunk_size bytes. Ranges end where a patent's lines end, as repeated
+    lines are only looked for within a patent.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    start = 0
+    with open(path, 'rb') as fee_file:
+        while start < size:
+            if start+chunk_size >= size:
+                end = size
+            else:
+                fee_file.seek(start+chunk_size)
+                fee_file.readline()
+                first_number = None
+                while True:
+                    end = fee_file.tell()
+                    line = fee_file.readline()
+                    number = line.split(None, 1)[:1]
+                    if not line or first_number not in (None, number):
+                        break
+                    first_number = number
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def chunk_lines(path, start, end):
+    """Read the lines of a byte range of a decompressed fee file."""
+    with open(path, 'rb') as fee_file:
+        fee_file.seek(start)
+        return fee_file.read(end-start).decode().split('\n')
+
+
+def count_patents(path, start, end):
+    """Count the patents fee_records finds in a byte range of a
+    decompressed fee file. Returns the count along with the first and last
+    patent numbers of the range, or None for both if it has no patents.
+    """
+    numbers = []
+    for line in chunk_lines(path, start, end):
+        fields = line.split(None, 2)
+        if fields and not fields[1].startswith('59'):
+            numbers.append(fields[0])
+    if not numbers:
+        return 0, None, None
+    return sum(1 for _ in groupby(numbers)), numbers[0], numbers[-1]
+
+
+def chunk_columns(path, start, end, first_id):
+    """Parse a byte range of a decompressed fee file into the columns of the
+    rows inserted by the initial build, numbering its patents from first_id
+    in file order. Returns the number of patents and of fee events, then
+    the columns of the (id, patent_number, application_number,
+    entity_status, application_date, issue_date) patent rows, each from its
+    first fee record, and of the (patent_id, maintenance_date,
+    maintenance_code) fee event rows. Ids are arrays and the other columns
+    are strings joined by newlines, with dates in ISO format, which is much
+    faster to pass between processes than the rows themselves.
+    """
+    patents, events = [], []
+    patent_id = first_id-1
+    patent_number = None
+
+    # the rows hold no reference cycles, so garbage collection would only
+    # slow down building them
+    gc.disable()
+    try:
+        for record in fee_records(chunk_lines(path, start, end)):
+            if record[0] != patent_number:
+                patent_number = record[0]
+                patent_id += 1
+                patents.append((patent_id, patent_number, record[1],
+                                record[2], iso_date(record[3]),
+                                iso_date(record[4])))
+            events.append((patent_id, iso_date(record[5]), record[6]))
+        columns = []
+        for rows, width in ((patents, 6), (events, 3)):
+            table = list(zip(*rows)) or [()]*width
+            columns.append([array('i', table[0])] +
+                           ['\n'.join(column) for column in table[1:]])
+    finally:
+        gc.enable()
+    return len(patents), len(events), columns[0], columns[1]
+
+
+def column_rows(columns):
+    """Turn columns made by chunk_columns back into a list of rows."""
+    gc.disable()
+    try:
+        return list(zip(*[column.split('\n') if isinstance(column, str)
+                          else column for column in columns]))
+    finally:
+        gc.enable()
+
+
+def chunk_tsv(path, start, end, first_id):
+    """Parse a byte range of a decompressed fee file like chunk_columns, but
+    write the rows to tab separated files next to it for LOAD DATA. The
+    paths of the files are returned in place of the columns.
+    """
+    patent_count, event_count, patents, events = chunk_columns(
+        path, start, end, first_id
+    )
+    paths = []
+    for name, columns in (('patents', patents), ('events', events)):
+        paths.append('%s.%d.%s.tsv' % (path, start, name))
+        with open(paths[-1], 'w') as tsv:
+            for row in column_rows(columns):
+                tsv.write('\t'.join(map(str, row)) + '\n')
+    return patent_count, event_count, paths[0], paths[1]
+
+
+def parallel_chunks(path, parse_chunk=chunk_columns, first_id=1,
+                    workers=None):
+    """Parse a decompressed fee file with a pool of worker processes,
+    yielding what parse_chunk (chunk_columns or chunk_tsv) returns for each
+    chunk, in file order. The workers first count the patents of every
+    chunk, which gives the id of the first patent of each one. At most two
+    parsed chunks per worker are waiting to be used at a time. Raises
+    ValueError if the chunks aren't sorted by patent.
+    """
+    workers = workers or os.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        chunks = fee_chunks(path)
+        counts = [pool.apply_async(count_patents, (path,)+chunk)
+                  for chunk in chunks]
+        pending = deque()
+        last_number = None
+        for chunk, count in zip(chunks, counts):
+            patent_count, first_number, chunk_last = count.get()
+            if first_number is not None:
+                if last_number is not None and first_number <= last_number:
+                    raise ValueError('Fee lines of patent %s after patent %s'
+                                     % (first_number, last_number))
+                last_number = chunk_last
+            pending.append((patent_count, pool.apply_async(
+                parse_chunk, (path,)+chunk+(first_id,)
+            )))
+            first_id += patent_count
+            if len(pending) > 2*workers:
+                yield _parsed_chunk(*pending.popleft())
+        while pending:
+            yield _parsed_chunk(*pending.popleft())
+
+
+def _parsed_chunk(patent_count, result):
+    parsed = result.get()
+    if parsed[0] != patent_count:
+        raise ValueError('Parsed %d patents in a chunk of %d'
+                         % (parsed[0], patent_count))
+    return parsed
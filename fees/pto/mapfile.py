@@ -0,0 +1,95 @@
+"""
+Binary file format used for the data snapshots. A file holds named sections
+of raw arrays, bytes or small JSON values behind a JSON table of contents.
+Serving processes open the files with mmap and read the arrays in place,
+so the data lives once in the shared page cache instead of being copied
+into every worker process.
+"""
+
+import json
+import mmap
+import struct
+from array import array
+
+
+MAGIC = b'PTOMAP01'
+
+# Sections start at multiples of this, so every array is aligned
+ALIGNMENT = 8
+
+
+def write_mapfile(path, sections):
+    """Write a dictionary of arrays, bytes and JSON values to a file."""
+    contents, blobs = {}, []
+    offset = 0
+    for name, value in sections.items():
+        if isinstance(value, array):
+            entry = ['array', value.typecode]
+            value = value.tobytes()
+        elif isinstance(value, (bytes, bytearray)):
+            entry = ['bytes', '']
+        else:
+            entry = ['json', '']
+            value = json.dumps(value).encode()
+        padding = -offset % ALIGNMENT
+        blobs.append(b'\0'*padding)
+        offset += padding
+        contents[name] = entry + [offset, len(value)]
+        blobs.append(value)
+        offset += len(value)
+
+    header = json.dumps(contents).encode()
+    header += b' '*(-(len(MAGIC)+8+len(header)) % ALIGNMENT)
+    with open(path, 'wb') as map_file:
+        map_file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for blob in blobs:
+            map_file.write(blob)
+
+
+class MapFile:
+    """Read only, memory mapped view of a file written by write_mapfile.
+    Arrays come back as memoryviews over the mapped file and bytes as
+    byte memoryviews, so nothing is copied until it is used.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as map_file:
+            self.map = mmap.mmap(map_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a snapshot map file: ' + path)
+        header_length = struct.unpack_from('<Q', self.map, len(MAGIC))[0]
+        start = len(MAGIC)+8
+        self.contents = json.loads(self.map[start:start+header_length])
+        self.data_start = start+header_length
+        self.view = memoryview(self.map)
+
+    def __contains__(self, name):
+        return name in self.contents
+
+    def __getitem__(self, name):
+        kind, typecode, offset, length = self.contents[name]
+        offset += self.data_start
+        if kind == 'json':
+            return json.loads(self.map[offset:offset+length])
+        section = self.view[offset:offset+length]
+        if kind == 'array':
+            return section.cast(typecode)
+        return section
+
+    def names(self):
+        """Get the section names, in the order they were written."""
+        return list(self.contents)
+
+    def close(self):
+        """Unmap the file. Raises BufferError if sections read from it are
+        still in use.
+        """
+        self.view.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
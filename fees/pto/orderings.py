@@ -0,0 +1,230 @@
+"""
+Orderings of the patent sets built by pto_cron.py, one per table column and
+direction. They are built from the sort columns of a set, either by sorting
+the whole set, or by merging the patents that entered the set or had their
+sort columns changed into the orderings of the previous snapshot, after
+taking out the ones that left or changed. Both give the same orderings: ties
+are broken by patent id, and names sort before empty names, which sort
+before missing ones.
+
+The sort columns the orderings were built from are saved in the snapshot as
+SortKeys, so the next build can tell which patents changed.
+"""
+
+import unicodedata
+from array import array
+from datetime import date
+
+from pto.constants import SORT_IDS
+from pto.store import StringPool
+
+
+class SortKeys:
+    """The SORT_IDS columns of the patents in a patent set, sorted by patent
+    id. When saved, dates are kept as ordinals and text columns as indexes
+    into a string pool, with -1 standing in for a missing value.
+    """
+
+    def __init__(self, rows):
+        """Build the columns from tuples of ('pk',)+SORT_IDS sorted by id."""
+        self.ids = array('i')
+        self.columns = [[] for _ in SORT_IDS]
+        for row in rows:
+            self.ids.append(row[0])
+            for column, value in zip(self.columns, row[1:]):
+                column.append(value)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to_sections(self, prefix):
+        """Get the map file sections holding the columns."""
+        pool = StringPool()
+        sections = {prefix+'ids': self.ids}
+        for sort_id, column in zip(SORT_IDS, self.columns):
+            if 'date' in sort_id:
+                values = array('i', [value.toordinal() for value in column])
+            else:
+                values = array('i', [-1 if value is None else pool.add(value)
+                                     for value in column])
+            sections[prefix+sort_id] = values
+        pool.freeze()
+        sections.update(pool.to_sections(prefix+'pool:'))
+        return sections
+
+    @classmethod
+    def from_sections(cls, sections, prefix):
+        """Load columns saved by to_sections."""
+        sort_keys = cls.__new__(cls)
+        sort_keys.ids = sections[prefix+'ids']
+        pool = StringPool.from_sections(sections, prefix+'pool:')
+        sort_keys.columns = []
+        for sort_id in SORT_IDS:
+            if 'date' in sort_id:
+                column = [date.fromordinal(value)
+                          for value in sections[prefix+sort_id]]
+            else:
+                column = [None if value == -1 else pool.get(value)
+                          for value in sections[prefix+sort_id]]
+            sort_keys.columns.append(column)
+        return sort_keys
+
+
+def mysql_name_key(name):
+    """Get a key approximating how MySQL's *_general_ci collations order a
+    name: by the uppercase of each character, with accents removed and
+    trailing spaces ignored. This matches MySQL for ASCII names, so _ and
+    the like sort after letters, but not for every other character, since
+    MySQL's weights for those don't all follow Unicode decomposition.
+    """
+    name = name.rstrip(' ')
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        name = ''.join(character for character in
+                       unicodedata.normalize('NFD', name)
+                       if not unicodedata.combining(character))
+    return name.upper()
+
+
+def column_order(column):
+    """Get the positions of a column's values in ascending order. Ties
+    keep their order in the column, since the sort is stable.
+    """
+    return sorted(range(len(column)), key=column.__getitem__)
+
+
+def name_orders(column, key=None):
+    """Get the ascending and descending orders of the positions of a name
+    column. Either way, names come first, then empty names, then missing
+    ones, like an ORDER BY LENGTH(name) > 0 DESC, name.
+    """
+    names = [value for value in column if value]
+    positions = [i for i, value in enumerate(column) if value]
+    if key is not None:
+        names = [key(name) for name in names]
+    ascending = sorted(range(len(names)), key=names.__getitem__)
+    descending = sorted(range(len(names)), key=names.__getitem__,
+                        reverse=True)
+    empty = [i for i, value in enumerate(column) if value == '']
+    empty.extend(i for i, value in enumerate(column) if value is None)
+    return ([positions[i] for i in ascending] + empty,
+            [positions[i] for i in descending] + empty)
+
+
+def build_orderings(sort_keys, name_key=None):
+    """Sort the patents of a set for each table option. name_key, if given,
+    is applied to names before they are compared.
+    """
+    ids = sort_keys.ids
+    ordered_docs = {}
+    ordered_docs['count'] = len(ids)
+    for sort_id, column in zip(SORT_IDS, sort_keys.columns):
+        if 'name' in sort_id:
+            ascending, descending = name_orders(column, name_key)
+            ordered_docs[sort_id] = array('i', [ids[i] for i in ascending])
+            ordered_docs['-'+sort_id] = array(
+                'i', [ids[i] for i in descending]
+            )
+        else:
+            idlst = array('i', [ids[i] for i in column_order(column)])
+            ordered_docs[sort_id] = idlst
+            reverse_list = idlst[::-1]
+            ordered_docs['-'+sort_id] = reverse_list
+    return ordered_docs
+
+
+def _order_key(sort_id, column, index, name_key, descending):
+    """Get a function giving the key of a patent id in an ordering, from
+    a column and a map of patent id to row. Keys are unique and increase
+    along the ordering, so the position of a patent can be found with a
+    binary search.
+    """
+    if 'name' not in sort_id:
+        return lambda pk: (column[index[pk]], pk)
+
+    def key(pk):
+        value = column[index[pk]]
+        if not value:
+            return (1 if value == '' else 2, pk)
+        if name_key is not None:
+            value = name_key(value)
+        return (0, _Descending(value) if descending else value, pk)
+    return key
+
+
+class _Descending:
+    """Wraps a name so it sorts in reverse."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _merge(order, added, key):
+    """Insert patent ids, sorted by key, into an ordering sorted by key."""
+    merged = array('i')
+    start = 0
+    for pk in added:
+        pk_key = key(pk)
+        low, high = start, len(order)
+        while low < high:
+            middle = (low+high)//2
+            if key(order[middle]) < pk_key:
+                low = middle+1
+            else:
+                high = middle
+        merged.extend(order[start:low])
+        merged.append(pk)
+        start = low
+    merged.extend(order[start:])
+    return merged
+
+
+def merge_orderings(ordered_docs, old_keys, sort_keys, name_key=None):
+    """Update the orderings of a patent set that were built from old_keys
+    to the patents and sort columns of sort_keys, only sorting the patents
+    that entered the set or whose sort columns changed. Returns the new
+    orderings and a dictionary of the ids of the patents that entered,
+    left, changed and were replaced.
+    """
+    old_index = {pk: i for i, pk in enumerate(old_keys.ids)}
+    index = {pk: i for i, pk in enumerate(sort_keys.ids)}
+    entered = [pk for pk in sort_keys.ids if pk not in old_index]
+    left = set(old_index).difference(index)
+    # rows of the patents that stayed in the set, now and before
+    stayed = [(pk, i, old_index[pk]) for i, pk in enumerate(sort_keys.ids)
+              if pk in old_index]
+    changed = set()
+    # a patent number can't change, so an id with another patent number
+    # belongs to a patent that was deleted and reloaded
+    numbers, old_numbers = sort_keys.columns[0], old_keys.columns[0]
+    replaced = [pk for pk, i, j in stayed if numbers[i] != old_numbers[j]]
+
+    merged_docs = {'count': len(sort_keys)}
+    for sort_id, column, old_column in zip(SORT_IDS, sort_keys.columns,
+                                           old_keys.columns):
+        moved = [pk for pk, i, j in stayed if column[i] != old_column[j]]
+        changed.update(moved)
+        removed = left.union(moved)
+        directions = [(sort_id, False)]
+        if 'name' in sort_id:
+            directions.append(('-'+sort_id, True))
+        for order_id, descending in directions:
+            key = _order_key(sort_id, column, index, name_key, descending)
+            kept = array('i', [pk for pk in ordered_docs[order_id]
+                               if pk not in removed])
+            merged_docs[order_id] = _merge(
+                kept, sorted(entered+moved, key=key), key
+            )
+        if 'name' not in sort_id:
+            merged_docs['-'+sort_id] = merged_docs[sort_id][::-1]
+    return merged_docs, {'entered': entered, 'left': left,
+                         'changed': changed, 'replaced': replaced}
@@ -0,0 +1,263 @@
+"""
+Client for the PatentsView patents API, which pto_cron.py uses to fill in
+the assignee data missing from the USPTO assignment data. Patents are
+asked for by issue date range, one page of results per request, with the
+pages fetched concurrently by a small pool of threads sharing one session
+of pooled keep-alive connections. Requests are spaced out to stay under
+the API's rate limit. Failed requests are retried with a backoff, or after
+the delay of a Retry-After header, unless the error is one that won't go
+away, like a 400 or 404.
+
+Every page is cached on disk, keyed by its date range and page number.
+Date ranges are whole weeks aligned to a fixed calendar, so the windows
+of the patent sets, which move a week between weekly runs, ask for mostly
+the same ranges as the run before, and reruns don't fetch anything twice.
+Pages older than CACHE_DAYS are fetched again, and deleted by prune_cache.
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import (ThreadPoolExecutor, wait,
+                                FIRST_COMPLETED)
+import requests
+from requests.adapters import HTTPAdapter
+
+from pto.constants import ANAMES, API_CACHE_DIR
+from pto.downloads import retryable
+
+
+API_URL = 'https://www.patentsview.org/api/patents/query'
+
+# Patent and assignee fields asked for
+API_FIELDS = ['patent_number', 'patent_date'] + ANAMES + [
+    'assignee_lastknown_latitude', 'assignee_lastknown_longitude',
+    'assignee_type'
+]
+
+# Number of patents per page, the most the API returns
+PER_PAGE = 10000
+
+# Number of pages fetched at the same time
+API_WORKERS = 4
+
+# Most requests made per minute
+RATE_LIMIT = 45
+
+# Number of attempts made at fetching a page before giving up
+API_ATTEMPTS = 5
+
+# Seconds to wait for the server to connect or send data
+TIMEOUT = 60
+
+# Days a cached page is used before it is fetched again
+CACHE_DAYS = 30
+
+
+class RateLimiter:
+    """Spaces out calls from any number of threads so at most rate happen
+    per minute.
+    """
+
+    def __init__(self, rate):
+        self.interval = 60/rate
+        self.next_call = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call+self.interval
+        time.sleep(call-now)
+
+    def hold(self, seconds):
+        """Allow no calls for the next seconds."""
+        with self.lock:
+            self.next_call = max(self.next_call, time.monotonic()+seconds)
+
+
+def retry_after(error):
+    """Get the seconds a failed request's Retry-After header asks to wait,
+    if it has one.
+    """
+    response = getattr(error, 'response', None)
+    if response is None or not response.headers.get('Retry-After'):
+        return None
+    value = response.headers['Retry-After']
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (when-datetime.now(timezone.utc)).total_seconds())
+
+
+def week_ranges(beginning, end):
+    """Split the dates from beginning to end into whole weeks, counted from
+    a fixed day, as (first day, last day) pairs covering both dates.
+    """
+    first = beginning - timedelta(beginning.toordinal() % 7)
+    ranges = []
+    while first <= end:
+        ranges.append((first, first+timedelta(6)))
+        first += timedelta(7)
+    return ranges
+
+
+class PatentsViewClient:
+    """Fetches the patents issued in date ranges from the PatentsView API,
+    through the on-disk page cache.
+    """
+
+    def __init__(self, url=API_URL, cache_dir=API_CACHE_DIR,
+                 workers=API_WORKERS, rate_limit=RATE_LIMIT,
+                 attempts=API_ATTEMPTS, backoff=1.0, per_page=PER_PAGE):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.attempts = attempts
+        self.backoff = backoff
+        self.per_page = per_page
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.counts = {'fetched': 0, 'cached': 0, 'retried': 0}
+        self.counts_lock = threading.Lock()
+
+    def count(self, name):
+        """Add one to a count of pages, from any thread."""
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def params(self, start, end, page):
+        """Get the query parameters asking for a page of the patents issued
+        from start to end.
+        """
+        return {
+            'q': json.dumps({'_and': [
+                {'_gte': {'patent_date': start.isoformat()}},
+                {'_lte': {'patent_date': end.isoformat()}}
+            ]}),
+            'f': json.dumps(API_FIELDS),
+            'o': json.dumps({
+                'include_subentity_total_counts': 'true',
+                'matched_subentities_only': 'true',
+                'per_page': str(self.per_page),
+                'page': str(page)
+            })
+        }
+
+    def cache_path(self, start, end, page):
+        """Get the path a page is cached at."""
+        return os.path.join(self.cache_dir, '%s_%s_%d_%d.json' % (
+            start.isoformat(), end.isoformat(), self.per_page, page
+        ))
+
+    def page(self, start, end, page):
+        """Get a page of the patents issued from start to end, as the
+        decoded JSON response, from the cache if it has a recent copy.
+        """
+        path = self.cache_path(start, end, page)
+        try:
+            if time.time()-os.path.getmtime(path) < CACHE_DAYS*86400:
+                with open(path) as cache_file:
+                    result = json.load(cache_file)
+                self.count('cached')
+                return result
+        except (OSError, ValueError):
+            pass
+
+        for attempt in range(self.attempts):
+            self.rate_limiter.wait()
+            try:
+                response = self.session.get(
+                    self.url, params=self.params(start, end, page),
+                    timeout=TIMEOUT
+                )
+                response.raise_for_status()
+                result = response.json()
+                result['total_patent_count'] = int(
+                    result['total_patent_count']
+                )
+                result['patents'] = result['patents'] or []
+                break
+            except (requests.RequestException, ValueError, KeyError,
+                    TypeError) as error:
+                if attempt == self.attempts-1 or not retryable(error):
+                    raise
+                self.count('retried')
+                print('Retrying PatentsView page %d of %s to %s: %s'
+                      % (page, start, end, error))
+                # every thread waits out a Retry-After, since it applies
+                # to the whole API
+                delay = retry_after(error)
+                if delay is None:
+                    time.sleep(self.backoff * 2**attempt)
+                else:
+                    self.rate_limiter.hold(delay)
+        self.count('fetched')
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path+'.tmp', 'w') as cache_file:
+            json.dump(result, cache_file)
+        os.replace(path+'.tmp', path)
+        return result
+
+    def prune_cache(self):
+        """Delete the cached pages older than CACHE_DAYS, which are never
+        used again.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if time.time()-os.path.getmtime(path) >= CACHE_DAYS*86400:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def patents(self, ranges):
+        """Get the patents issued in each of a list of (start, end) date
+        ranges, as a dictionary of range to patents in page order. The first
+        page of every range is fetched right away, and the other pages as
+        soon as the first tells how many there are. Ranges with a page that
+        couldn't be fetched are left out, after printing the error.
+        """
+        pages, failed = {}, set()
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = {executor.submit(self.page, start, end, 1):
+                       (start, end, 1) for start, end in ranges}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end, page = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        print('Could not fetch PatentsView page %d of %s '
+                              'to %s: %s' % (page, start, end, error))
+                        failed.add((start, end))
+                        continue
+                    pages[(start, end, page)] = result['patents']
+                    if page == 1:
+                        page_count = -(-result['total_patent_count'] //
+                                       self.per_page)
+                        for other in range(2, page_count+1):
+                            pending[executor.submit(
+                                self.page, start, end, other
+                            )] = (start, end, other)
+
+        results = {}
+        for (start, end, page), patents in sorted(pages.items()):
+            if (start, end) not in failed:
+                results.setdefault((start, end), []).extend(patents)
+        return results
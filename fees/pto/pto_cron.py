@@ -3,66 +3,185 @@ This module automates the daily/weekly retrieval of USPTO Maintenance
 Fee and Assignment data from their bulk data website -
 (https://bulkdata.uspto.gov/), as well as their PatentView API -
 https://www.patentsview.org/api/patents. This data is processed
-and then the server is reloaded each night with the updated.
+and then published each night as a new snapshot, which the server swaps
+in without being restarted.
 """
 
+import os
 import re
-import csv
-import json
 import shlex
 import pickle
+import shutil
 import zipfile
 import subprocess
+import multiprocessing
+from array import array
+from collections import deque
 from glob import glob
-from math import ceil
-from time import strftime
-from xml.etree import ElementTree as ET
+from time import strftime, perf_counter
 from datetime import date, timedelta
-import requests
-
-from pto.extras import yearsago, get_date_arrays
-from pto.constants import FIRST_WORD, FIRST_NUM, ANAMES, SORT_IDS
+from django.conf import settings
+from django.db import connection, connections
+from django.utils.dateparse import parse_date
+
+from pto.extras import yearsago, get_date_arrays, get_fee_codes
+from pto.assignments import (
+    ASSIGNMENT_FIELDS, PatentResolver, assignment_updates, xml_assignments
+)
+from pto.constants import (FIRST_WORD, FIRST_NUM, ANAMES, SORT_IDS,
+                           ORDERED_PATS)
+from pto.downloads import download, retire_archive
+from pto.indexes import NumberIndex, FeeEventIndex
+from pto.ledger import JobLedger
+from pto.loaders import (
+    UPDATE_BATCH_SIZE, BulkLoader, UpsertLoader, MySQLLoadDataLoader,
+    batches, update_patents
+)
+from pto.maintfees import (
+    fee_lines, fee_records, zip_fee_lines, line_fingerprints,
+    fingerprint_delta, matching_lines
+)
+from pto.mapfile import MapFile
 from pto.models import Patent, FeeEvents
+from pto.orderings import (SortKeys, build_orderings, merge_orderings,
+                            mysql_name_key)
+from pto.patentsview import PatentsViewClient, week_ranges
+from pto.snapshot import (current_version, start_snapshot, discard_snapshot,
+                          dump_sections, publish_snapshot)
+from pto.store import FIELDS, DATE_FIELDS, PatentStore
 
 
 DATE_ARRAYS = get_date_arrays()
 
+# Patent fields set from the PatentsView API, in the order parse_api_result
+# returns them
+API_ASSIGNEE_FIELDS = ['pat_assignee_name', 'pat_assignee_address']
+
+# Number of the fee entries removed from the USPTO data printed each week
+REMOVED_PRINTED = 20
+
+
+def name_key():
+    """Get the function names are compared with. On MySQL it approximates
+    the database's case and accent insensitive collation, see
+    mysql_name_key.
+    """
+    return mysql_name_key if connection.vendor == 'mysql' else None
+
 
-def reload_server():
-    """Reload the server after update of datatsets."""
-    subprocess.call('./reload-dev.sh')
+def set_sort_keys(docs):
+    """Read the sort columns of a patent set in a single scan."""
+    return SortKeys(
+        docs.order_by('pk').values_list('pk', *SORT_IDS).iterator()
+    )
 
 
 def process_docs(docs):
-    """Create ordered lists of patent numbers for each table option."""
-    ordered_docs = {}
-    ordered_docs['count'] = docs.count()
-    for sort_id in SORT_IDS:
-        if 'name' in sort_id:
-            docs_sorted = docs.extra(select={
-                'has_foo': 'LENGTH(pto_patent.'+sort_id+') > 0'
-            })
-            docs_sorted_asc = docs_sorted.extra(order_by=[
-                '-has_foo', sort_id
-            ])
-            ordered_docs[sort_id] = [p.pk for p in docs_sorted_asc]
-            docs_sorted_reversed = docs_sorted.extra(order_by=[
-                '-has_foo', '-'+sort_id
-            ])
-            ordered_docs['-'+sort_id] = [p.pk for p in docs_sorted_reversed]
-        else:
-            docs_sorted = docs.order_by(sort_id)
-            idlst = [p.pk for p in docs_sorted]
-            ordered_docs[sort_id] = idlst
-            reverse_list = idlst[::-1]
-            ordered_docs['-'+sort_id] = reverse_list
-    return ordered_docs
+    """Create ordered lists of patent numbers for each table option, sorting
+    the sort columns of the whole set in memory.
+    """
+    return build_orderings(set_sort_keys(docs), name_key())
 
 
-def process_paid_patents(category, patent_list):
-    """Create updated lists of patents that the maintenance fee for
-    the specific time frame has already been paid for.
+def process_unpaid_docs(ordered_docs, paid_patents):
+    """Create ordered lists with the already paid patents removed, so any
+    page of the unpaid table can be served by a direct slice.
     """
+    unpaid_docs = {}
+    for sort_id, idlst in ordered_docs.items():
+        if sort_id != 'count':
+            unpaid_docs[sort_id] = array(
+                'i', [x for x in idlst if x not in paid_patents]
+            )
+    unpaid_docs['count'] = len(unpaid_docs['patent_number'])
+    return unpaid_docs
+
+
+def ordered_docs_sections(ordered_docs):
+    """Get the map file sections holding the orderings of a patent set."""
+    sections = {}
+    for sort_id, idlst in ordered_docs.items():
+        if sort_id != 'unpaid':
+            sections[sort_id] = idlst
+    for sort_id, idlst in ordered_docs['unpaid'].items():
+        sections['unpaid:'+sort_id] = idlst
+    return sections
+
+
+def published_patent_ids(snapshot_dir):
+    """Get the sorted ids of the patents in the orderings of a snapshot."""
+    pks = set()
+    for set_id in ORDERED_PATS:
+        path = os.path.join(snapshot_dir, set_id+'_ordered_ids.map')
+        if os.path.exists(path):
+            with MapFile(path) as sections:
+                pks.update(sections['patent_number'])
+    return sorted(pks)
+
+
+def store_rows(pks, old_store):
+    """Get the FIELDS of the patents with the given sorted ids, from the
+    database, or from old_store for patents deleted from the database
+    since it was built.
+    """
+    for batch in batches(pks):
+        rows = dict((row[0], row) for row in Patent.objects.filter(
+            pk__in=batch
+        ).values_list(*FIELDS))
+        for pk in batch:
+            if pk in rows:
+                yield rows[pk]
+            elif old_store is not None:
+                row = old_store.row(pk)
+                for field in DATE_FIELDS:
+                    row[field] = parse_date(row[field])
+                yield tuple(row[field] for field in FIELDS)
+            else:
+                raise KeyError('Patent %d is missing' % pk)
+
+
+def generate_patent_store(snapshot_dir):
+    """Build the columnar store holding every patent in the orderings of
+    the snapshot, so the app doesn't need to load the patents from the
+    database. Patents deleted since the orderings were built keep their
+    rows from the store being replaced, so the orderings published with
+    the new store never refer to a patent it doesn't have.
+    """
+    path = os.path.join(snapshot_dir, 'patent_store.map')
+    old_sections = MapFile(path) if os.path.exists(path) else None
+    old_store = None
+    if old_sections is not None:
+        old_store = PatentStore.from_sections(old_sections)
+    patent_store = PatentStore(
+        store_rows(published_patent_ids(snapshot_dir), old_store)
+    )
+    del old_store
+    if old_sections is not None:
+        old_sections.close()
+    dump_sections(snapshot_dir, 'patent_store.map',
+                  patent_store.to_sections())
+
+
+def publish_patent_store():
+    """Publish a snapshot with the patent store rebuilt after the patent
+    rows have changed. Until update_pto_data has published the first
+    snapshot there are no patent sets to build a store for, so nothing is
+    published.
+    """
+    if current_version() is None:
+        print('No patent sets published yet, patent store not built')
+        return
+    snapshot_dir = start_snapshot()
+    try:
+        generate_patent_store(snapshot_dir)
+    except BaseException:
+        discard_snapshot(snapshot_dir)
+        raise
+    publish_snapshot(snapshot_dir)
+
+
+def payment_codes(category):
+    """Get the fee codes of the payments made in a patent set's window."""
     first_category_word = category.split('_')[0]
 
     # fee code format is MX55Y, where X is the size of the entity, and
@@ -71,43 +190,36 @@ def process_paid_patents(category, patent_list):
     payment_codes = []
     for i in range(1, 4):
         payment_codes.append('M'+str(i)+'55'+code_num)
+    return payment_codes
+
+
+def process_paid_patents(category, patent_list):
+    """Create updated lists of patents that the maintenance fee for
+    the specific time frame has already been paid for.
+    """
     filtered_fees = FeeEvents.objects.filter(
         patent_id__in=patent_list,
-        maintenance_code__in=payment_codes
+        maintenance_code__in=payment_codes(category)
     )
     paid_fees = set([g.patent_id for g in filtered_fees])
     return paid_fees
 
 
-def patent_api_check(start_date, end_date):
-    """update rows for time frames with latest PatentsView API
-    information
+def merge_paid_patents(category, paid, changes, patent_ids, last_event_id):
+    """Update the paid patents of a set from the previous snapshot to the
+    set's current patent_ids, adding the payments of the patents that
+    entered the set or replaced another with the same id, and those made
+    since the fee event with id last_event_id.
     """
-    api_results = []
-    api_count = 1
-    total_pat_num = 100000
-    while ceil(total_pat_num/10000) >= api_count:
-        start = start_date.strftime('%Y-%m-%d')
-        end = end_date.strftime('%Y-%m-%d')
-        url = ('https://www.patentsview.org/api/patents/query?q={"_and":[{"_gt'
-               'e":{"patent_date":"' + start + '"}},{"_lte":{"patent_date":"' +
-               end + '"}}]}&f=["patent_number","patent_date","assignee_first_'
-               'name","assignee_last_name","assignee_organization","assignee_'
-               'lastknown_city","assignee_last,known_state","assignee_lastknow'
-               'n_country","assignee_lastknown_latitude","assignee_lastknown_'
-               'longitude","assignee_lastknown_location_id","assignee_type"]&'
-               'o={"include_subentity_total_counts":"true","matched_subentiti'
-               'es_only":"true","per_page":"10000","page":"' +str(api_count) +
-               '"}'
-              )
-        api_request = requests.get(url)
-        api_content = api_request.content
-        api_json = json.loads(api_content)
-        api_results += api_json['patents']
-        if api_count == 1:
-            total_pat_num = int(api_json['total_patent_count'])
-        api_count += 1
-    return api_results
+    new_patents = changes['entered'] + changes['replaced']
+    paid = patent_ids.intersection(paid).difference(changes['replaced'])
+    if new_patents:
+        paid.update(process_paid_patents(category, new_patents))
+    paid.update(patent_ids.intersection(FeeEvents.objects.filter(
+        pk__gt=last_event_id,
+        maintenance_code__in=payment_codes(category)
+    ).values_list('patent_id', flat=True)))
+    return paid
 
 
 def parse_api_result(patent):
@@ -128,118 +240,148 @@ def parse_api_result(patent):
     return name, address
 
 
+def api_assignee_updates(api_updates, empties):
+    """Match PatentsView results with the patents of a patent_number -> id
+    map of patents without an assignee name. Returns a dictionary of patent
+    id to the values of API_ASSIGNEE_FIELDS, from the first usable result
+    of each patent, and the number of results that matched a patent.
+    """
+    max_length = Patent._meta.get_field('pat_assignee_name').max_length
+    updates, matched = {}, 0
+    for pdata in api_updates:
+        pk = empties.get(pdata['patent_number'])
+        if pk is None:
+            continue
+        matched += 1
+        if pk in updates:
+            continue
+        try:
+            name, address = parse_api_result(pdata)
+        except (KeyError, IndexError, TypeError):
+            continue
+        if name and len(name) <= max_length:
+            updates[pk] = (name, address)
+    return updates, matched
+
+
 def initial_assignment_data():
     """Build assignment dataset from USPTO csv files if not yet been created"""
 
     # create necessary directories that we will save USPTO assignment data to
-    subprocess.call(shlex.split('mkdir -p ../../ad/csv'))
     subprocess.call(shlex.split('mkdir -p ../../ad/adzips'))
 
     # download the latest, most comprehensive USPTO assignment dataset
     cfile = ('https://bulkdata.uspto.gov/data/patent/assignment/economics/'
              '2019/csv.zip'
             )
-    assignment_csv_data = requests.get(cfile)
-
-    # write zip file to disk
     zfile = '../../ad/adzips/csv.zip'
-    with open(zfile, 'wb') as csv_zip:
-        csv_zip.write(assignment_csv_data.content)
-
-    # open zip file to get assignment data
-    csv_prefix = '../../ad/csv'
-    with zipfile.ZipFile(zfile, 'r') as extract_csv:
-        extract_csv.extractall(path=csv_prefix)
-
-    # Assignment data is broken up in separate csv files. For this reason,
-    # a complete dataset must be build from the associated data spread out
-    # in three csv files. A copy of the schema can be found here:
-    # uspto/fees/pat_assign_dataset_schema.pdf
-    mapped_dict = {}
-    mapped_list = ['assignee', 'assignment', 'documentid']
-
-    for mapfile in mapped_list:
-        csvfile = '../../ad/csv/' + mapfile + '.csv'
-        rows = []
-        with open(csvfile) as opencsv:
-            csvreader = csv.reader(opencsv)
-            for row in csvreader:
-                rows.append(row)
-            # First row is just cell column labels
-            mapped_dict[mapfile] = rows[1:]
-
-    mapped_data = {}
-    for row in mapped_dict['assignment']:
-        rfid = ''
-        for i, col in enumerate(row):
-            if i == 0:
-                rfid = col
-                mapped_data[rfid] = {}
-            if i == 2:
-                mapped_data[rfid]['correspondent_name'] = col
-            if 2 < i < 7:
-                if 'correspondent_address' not in mapped_data[rfid]:
-                    mapped_data[rfid]['correspondent_address'] = col
-                else:
-                    mapped_data[rfid]['correspondent_address'] += '\n' + col
-            if i == 7:
-                mapped_data[rfid]['reel_num'] = col
-            if i == 8:
-                mapped_data[rfid]['frame_num'] = col
-
-    for row in mapped_dict['documentid']:
-        rfid = ''
-        for i, col in enumerate(row):
-            if i == 0:
-                rfid = col
-            if rfid in mapped_data:
-                if i == 3:
-                    mapped_data[rfid]['application_number'] = col
-                if i == 4:
-                    mapped_data[rfid]['application_date'] = col
-                if i == 9:
-                    mapped_data[rfid]['patent_number'] = col
-                if i == 10:
-                    mapped_data[rfid]['issue_date'] = col
-
-    for row in mapped_dict['assignee']:
-        rfid = ''
-        for i, col in enumerate(row):
-            if i == 0:
-                rfid = col
-            if rfid in mapped_data:
-                if i == 1:
-                    mapped_data[rfid]['assignee_name'] = col
-                if i > 1:
-                    if 'assignee_address' not in mapped_data[rfid]:
-                        mapped_data[rfid]['assignee_address'] = col
-                    else:
-                        mapped_data[rfid]['assignee_address'] += '\n'+col
-
-    # Saved pickled data just in case we need it for future reference,
-    # also to test for it's existence when running function to determine
-    # whether it needs to be run before rest of update functions
-    pickle.dump(mapped_data, open('mapped_data.p', 'wb'), protocol=2)
-
-    # Update all patent database rows with complete current assignment data
-    for pat in mapped_data.values():
-        try:
-            saved_pat = Patent.objects.get(patent_number=pat['patent_number'])
-            saved_pat.reel_num = pat['reel_num']
-            saved_pat.frame_num = pat['frame_num']
-            saved_pat.correspondent_name = pat['correspondent_name']
-            saved_pat.correspondent_address = pat['correspondent_address']
-            saved_pat.pat_assignee_name = pat['assignee_name']
-            saved_pat.pat_assignee_address = pat['assignee_address']
-            saved_pat.save()
-        except Exception as e:
-            print(e)
-
-    reload_server()
-
-
-def generate_final_data():
-    """This function generates the bulk of the data used by the app."""
+    download(cfile, zfile)
+
+    # Join the assignment data spread out in three csv files of the zip
+    # file, keeping the assignments of patents in the database, and update
+    # those patents
+    patent_ids = dict(Patent.objects.values_list('patent_number', 'id'))
+    with zipfile.ZipFile(zfile) as csv_zip:
+        updates = assignment_updates(csv_zip, patent_ids)
+    del patent_ids
+    update_patents(updates, ASSIGNMENT_FIELDS)
+    print('%d patents updated with assignment data' % len(updates))
+    retire_archive(zfile)
+
+    publish_patent_store()
+
+
+def previous_set_data(snapshot_dir):
+    """Get the map file of the sort keys saved with the patent sets of the
+    snapshot being replaced, if the sets can be updated incrementally.
+    Fee events are only added between snapshots, so the sets are rebuilt
+    if the fee events table was emptied since.
+    """
+    path = os.path.join(snapshot_dir, 'sort_keys.map')
+    if not settings.PTO_INCREMENTAL_SETS or not os.path.exists(path):
+        return None
+    sort_key_sections = MapFile(path)
+    if not FeeEvents.objects.filter(
+            pk__gte=sort_key_sections['fee_events:last_id']).exists():
+        sort_key_sections.close()
+        return None
+    return sort_key_sections
+
+
+def update_set_data(snapshot_dir, key_name, sort_keys, previous,
+                    verify=False):
+    """Get the orderings and paid patents of a patent set, merging the
+    changes since the previous snapshot into its data if there is one.
+    Merged data is checked against a full rebuild, which is used instead
+    if they differ, when verify is set or when the merged orderings don't
+    hold exactly the patents of the set.
+    """
+    if previous is None:
+        ordered_ids = build_orderings(sort_keys, name_key())
+        paid = process_paid_patents(key_name, ordered_ids['patent_number'])
+        return ordered_ids, paid
+
+    # the previous data is read straight from its map files, which are
+    # closed once merged
+    ordered_path = os.path.join(snapshot_dir, key_name+'_ordered_ids.map')
+    paid_path = os.path.join(snapshot_dir, 'paid_patents.map')
+    with MapFile(ordered_path) as old_ordered_ids, \
+            MapFile(paid_path) as old_paid:
+        ordered_ids, changes = merge_orderings(
+            old_ordered_ids, SortKeys.from_sections(previous, key_name+':'),
+            sort_keys, name_key()
+        )
+        paid = merge_paid_patents(
+            key_name, old_paid[key_name], changes, set(sort_keys.ids),
+            previous['fee_events:last_id']
+        )
+    print('%s: %d patents entered, %d left, %d changed' % (
+        key_name, len(changes['entered']), len(changes['left']),
+        len(changes['changed'])
+    ))
+
+    drifted = set(ordered_ids['patent_number']) != set(sort_keys.ids) or any(
+        len(order) != len(sort_keys) for order_id, order in
+        ordered_ids.items() if order_id != 'count'
+    )
+    if drifted:
+        print('%s: merged orderings drifted from the set' % key_name)
+    if drifted or verify:
+        full_ids = build_orderings(sort_keys, name_key())
+        full_paid = process_paid_patents(key_name, full_ids['patent_number'])
+        if full_ids == ordered_ids and full_paid == paid:
+            print('%s: matches a full rebuild' % key_name)
+        else:
+            print('%s: DIFFERS from a full rebuild, which is used instead'
+                  % key_name)
+            ordered_ids, paid = full_ids, full_paid
+    return ordered_ids, paid
+
+
+def generate_final_data(snapshot_dir):
+    """This function generates the bulk of the data used by the app.
+
+    The orderings and paid patents of each patent set are updated from the
+    previous snapshot when settings.PTO_INCREMENTAL_SETS is set, only
+    sorting the patents that entered the set or changed. Every
+    settings.PTO_VERIFY_SETS_EVERY updates, they are checked against a full
+    rebuild instead, so a bad merge can't carry on into every later
+    snapshot.
+    """
+    fee_codes = get_fee_codes(snapshot_dir)
+    previous = previous_set_data(snapshot_dir)
+    merges = 0
+    if previous is not None:
+        merges = previous['sets:merges']+1 if 'sets:merges' in previous else 1
+    verify = merges >= settings.PTO_VERIFY_SETS_EVERY
+    api_client = PatentsViewClient()
+    api_client.prune_cache()
+    sort_key_sections = {
+        'fee_events:last_id': FeeEvents.objects.order_by('-pk').values_list(
+            'pk', flat=True
+        ).first() or 0,
+        'sets:merges': 0 if verify else merges
+    }
     paid_patents = {}
     for cnt, i in enumerate(DATE_ARRAYS):
         for j in range(2):
@@ -250,160 +392,206 @@ def generate_final_data():
                 extra_text = '_late'
             key_name = FIRST_NUM[cnt+1] + '_year' + extra_text
             pats = Patent.objects.filter(issue_date__range=(beginning, end))
-            ordered_ids = process_docs(pats)
-            pickle.dump(ordered_ids,
-                        open(key_name+'_ordered_ids.p', 'wb'), protocol=2)
+            sort_keys = set_sort_keys(pats)
+            ordered_ids, paid_patents[key_name] = update_set_data(
+                snapshot_dir, key_name, sort_keys, previous, verify
+            )
+            sort_key_sections.update(sort_keys.to_sections(key_name+':'))
             pat_list = ordered_ids['patent_number']
-            paid_patents[key_name] = process_paid_patents(key_name, pat_list)
+
+            # unpaid orderings are stored next to the full ones so the
+            # table never has to filter out paid patents per request
+            ordered_ids['unpaid'] = process_unpaid_docs(
+                ordered_ids, paid_patents[key_name]
+            )
+            dump_sections(snapshot_dir, key_name+'_ordered_ids.map',
+                          ordered_docs_sections(ordered_ids))
+
+            # substring index used by the table's patent number filter
+            number_index = NumberIndex(
+                ordered_ids, dict(zip(sort_keys.ids, sort_keys.columns[0])),
+                paid_patents[key_name]
+            )
+            dump_sections(snapshot_dir, key_name+'_number_index.map',
+                          number_index.to_sections())
+
+            # fee events of the set, so the app doesn't need to query them
+            set_events = FeeEvents.objects.filter(patent__in=pats).order_by(
+                'patent_id', 'pk'
+            ).values_list('patent_id', 'maintenance_date', 'maintenance_code')
+            fee_event_index = FeeEventIndex(sorted(pat_list),
+                                            set_events.iterator(), fee_codes)
+            dump_sections(snapshot_dir, key_name+'_fee_events.map',
+                          fee_event_index.to_sections())
 
             # on average, the main USPTO assignment data is ~25% incomplete
             # With USPTO API, 40-50% of the missing data can be added
-            while beginning < end:
-                old_beginning = beginning
-                beginning += timedelta(7)
-
-                # just try, not worth risking rest of the code breaking if
-                # there is an error retrieving some of the api results
-                try:
-                    api_updates = patent_api_check(old_beginning, beginning)
-                    api_updates = [
-                        y for y in api_updates
-                        if y['assignees'][0]['assignee_last_name'] != None
-                        or y['assignees'][0]['assignee_organization'] != None
-                    ]
-
-                    # filter patent set so we only check empty db entries
-                    empties = pats.filter(pat_assignee_name='')
-                    for pdata in api_updates:
-                        try:
-                            existing = empties.get(
-                                patent_number=pdata['patent_number']
-                            )
-                            name, address = parse_api_result(pdata)
-                            existing.pat_assignee_name = name
-                            existing.pat_assignee_address = address
-                            existing.save()
-                        except:
-                            pass
-                except:
-                    pass
-    pickle.dump(paid_patents, open('paid_patents.p', 'wb'), protocol=2)
-
-
-def process_assignment_xml(zip_file):
-    """download and process USPTO assignment zip and xml files"""
+            ranges = week_ranges(beginning, end)
+            api_results = api_client.patents(ranges)
+            print('%s: PatentsView data for %d of %d weeks' % (
+                key_name, len(api_results), len(ranges)
+            ))
+            api_updates = [
+                y for patents in api_results.values() for y in patents
+                if y.get('assignees') and (
+                    y['assignees'][0]['assignee_last_name'] != None
+                    or y['assignees'][0]['assignee_organization'] != None
+                )
+            ]
+
+            # filter patent set so we only check empty db entries
+            empties = dict(pats.filter(pat_assignee_name='').values_list(
+                'patent_number', 'id'
+            ))
+            api_assignees, matched = api_assignee_updates(api_updates,
+                                                          empties)
+            update_patents(api_assignees, API_ASSIGNEE_FIELDS)
+
+            # matched results are skipped when they can't be used, or when
+            # an earlier result already updated the patent
+            print('%s: %d PatentsView patents, %d unmatched, %d matched, '
+                  '%d updated, %d skipped' % (
+                      key_name, len(api_updates), len(api_updates)-matched,
+                      matched, len(api_assignees),
+                      matched-len(api_assignees)
+                  ))
+    dump_sections(snapshot_dir, 'paid_patents.map', {
+        key_name: array('i', sorted(paid))
+        for key_name, paid in paid_patents.items()
+    })
+    dump_sections(snapshot_dir, 'sort_keys.map', sort_key_sections)
+    if previous is not None:
+        previous.close()
+    print('PatentsView pages: %(fetched)d fetched, %(cached)d cached, '
+          '%(retried)d retried' % api_client.counts)
+    generate_patent_store(snapshot_dir)
+
+
+def patent_resolver():
+    """Map the numbers of all patents in the database to their ids."""
+    return PatentResolver(Patent.objects.values_list(
+        'id', 'patent_number', 'application_number', 'correspondent_name'
+    ).iterator())
+
+
+def process_assignment_xml(zip_file, resolver=None):
+    """download and process USPTO assignment zip and xml files. The
+    patents are found with a PatentResolver, which is built if none is
+    given.
+    """
     rfile = ('https://bulkdata.uspto.gov/data/patent/assignment/'
              + zip_file
             )
-    assignment_zip = requests.get(rfile)
+    zfile = '../../ad/adzips/' + zip_file
+    download(rfile, zfile)
+
+    if resolver is None:
+        resolver = patent_resolver()
+
+    # parse the assignment data straight from the zip file, one assignment
+    # at a time, and apply it in batches
+    with zipfile.ZipFile(zfile) as xml_zip:
+        with xml_zip.open(zip_file.replace('zip', 'xml')) as xml_file:
+            for batch in batches(xml_assignments(xml_file),
+                                 UPDATE_BATCH_SIZE):
+                update_patents(resolver.updates(batch), ASSIGNMENT_FIELDS)
+
+    retire_archive(zfile)
 
-    # write zip file to disk
+
+def parsed_assignments_path(zip_file):
+    """Get the path of the parsed assignment records of a zip file."""
+    return '../../ad/parsed/' + zip_file.replace('.zip', '.p')
+
+
+def parse_assignment_zip(zip_file):
+    """Pickle the assignment records of the xml file of a downloaded
+    assignment zip file, in batches, to parsed_assignments_path. Returns
+    the ledger fields of the file: its state, counts and timings. A file
+    that can't be parsed is left in the 'downloaded' state.
+    """
     zfile = '../../ad/adzips/' + zip_file
-    with open(zfile, 'wb') as assignment_file:
-        assignment_file.write(assignment_zip.content)
-
-    # open zip file to get assignment data
-    xml_prefix = '../../ad/'
-    with zipfile.ZipFile(zfile, 'r') as xml_file:
-        xml_file.extractall(path=xml_prefix)
-
-    assn_data = xml_prefix + zip_file.replace('zip', 'xml')
-    assn_tree = ET.parse(assn_data)
-    assn_root = assn_tree.getroot()
-    all_assignments = assn_root.findall('./patent-assignments/')
-    for assignment in all_assignments:
-        records = assignment.getchildren()
-        reel_num, frame_num, correspondent_name, correspondent_address, \
-        pat_assignee_name, pat_assignee_address = '', '', '', '', '', ''
-        correspondent_addys, pat_addys, all_doc_nums = [], [], []
-        for record in records:
-            if record.tag == 'assignment-record':
-                assignee_data = record.getchildren()
-                for assignee_field in assignee_data:
-                    if assignee_field.tag == 'reel-no':
-                        reel_num = assignee_field.text
-                    if assignee_field.tag == 'frame-no':
-                        frame_num = assignee_field.text
-                    if assignee_field.tag == 'correspondent':
-                        correspondent_fields = assignee_field.getchildren()
-                        for cfield in correspondent_fields:
-                            if cfield.tag == 'name':
-                                correspondent_name = cfield.text
-                            else:
-                                correspondent_addys.append(cfield.text)
-            if record.tag == 'patent-assignees':
-                pat_assignees = record.findall('./patent-assignee')
-                for pat_assignee in pat_assignees:
-                    pat_assignee_fields = pat_assignee.getchildren()
-                    for pat_address in pat_assignee_fields:
-                        if pat_address.tag == 'name':
-                            pat_assignee_name = pat_address.text
-                        else:
-                            pat_addys.append(pat_address.text)
-            if record.tag == 'patent-properties':
-                doc_records = record.findall('./patent-property')
-                for pat_assignee in doc_records:
-                    doc_nums = []
-                    doc_record_list = pat_assignee.findall('.//document-id')
-                    for doc_record in doc_record_list:
-                        doc_rec = doc_record.find('./doc-number')
-                        doc_num = doc_rec.text
-                        if len(doc_num) < 10:
-                            doc_nums.append(doc_num)
-                    all_doc_nums.append(doc_nums)
-        correspondent_addys = [addy for addy in correspondent_addys if addy]
-        correspondent_address = '\n'.join(correspondent_addys)
-        pat_addys = [addy for addy in pat_addys if addy]
-        pat_assignee_address = '\n'.join(pat_addys)
-        all_data = [reel_num, frame_num, correspondent_name,
-                    correspondent_address, pat_assignee_name,
-                    pat_assignee_address]
-        for pat_app_nums in all_doc_nums:
-            parent_patent = ''
-            if len(pat_app_nums) == 1:
-                try:
-                    parent_patent = Patent.objects.get(
-                        application_number=pat_app_nums[0]
-                    )
-                except:
-                    try:
-                        parent_patent = Patent.objects.get(
-                            patent_number=pat_app_nums[0]
-                        )
-                    except:
-                        pass
-            if len(pat_app_nums) == 2:
-                try:
-                    parent_patent = Patent.objects.get(
-                        application_number=pat_app_nums[0],
-                        patent_number=pat_app_nums[1]
-                    )
-                except:
-                    try:
-                        parent_patent = Patent.objects.get(
-                            application_number=pat_app_nums[-1],
-                            patent_number=pat_app_nums[0]
-                        )
-                    except:
-                        pass
-            if parent_patent:
-
-                # Every now and then an empty record gets included, but
-                # it is always missing the correspondent_name
-                if correspondent_name != '' and \
-                parent_patent.correspondent_name == '':
-                    parent_patent.reel_num = all_data[0],
-                    parent_patent.frame_num = all_data[1],
-                    parent_patent.correspondent_name = all_data[2],
-                    parent_patent.correspondent_address = all_data[3],
-                    parent_patent.pat_assignee_name = all_data[4],
-                    parent_patent.pat_assignee_address = all_data[5]
-                    parent_patent.save()
-
-
-def initial_pto_assignment_data():
+    fields = {'state': 'downloaded'}
+    start = perf_counter()
+    parsed = parsed_assignments_path(zip_file)
+    count = 0
+    try:
+        with zipfile.ZipFile(zfile) as xml_zip, \
+                xml_zip.open(zip_file.replace('zip', 'xml')) as xml_file, \
+                open(parsed+'.tmp', 'wb') as parsed_file:
+            for batch in batches(xml_assignments(xml_file),
+                                 UPDATE_BATCH_SIZE):
+                pickle.dump(batch, parsed_file, pickle.HIGHEST_PROTOCOL)
+                count += len(batch)
+    except Exception as error:
+        fields['error'] = repr(error)
+        return fields
+    os.replace(parsed+'.tmp', parsed)
+    fields.update(state='parsed', error=None, assignments=count,
+                  parse_s=round(perf_counter()-start, 2))
+    return fields
+
+
+def parsed_assignment_zips(pool, zip_files, workers):
+    """Download assignment zip files one at a time and parse them with a
+    pool of worker processes, giving (zip_file, ledger fields) pairs in the
+    order of zip_files. The files are downloaded here rather than in the
+    workers, so only this process updates the download mirror. At most two
+    parsed files per worker are waiting to be applied at a time.
+    """
+    pending = deque()
+    for zip_file in zip_files:
+        rfile = 'https://bulkdata.uspto.gov/data/patent/assignment/' + zip_file
+        start = perf_counter()
+        try:
+            download(rfile, '../../ad/adzips/' + zip_file)
+        except Exception as error:
+            pending.append((zip_file, {'error': repr(error)}, None))
+        else:
+            fields = {'download_s': round(perf_counter()-start, 2)}
+            pending.append((zip_file, fields, pool.apply_async(
+                parse_assignment_zip, (zip_file,)
+            )))
+        if len(pending) > 2*workers:
+            yield _parse_result(*pending.popleft())
+    while pending:
+        yield _parse_result(*pending.popleft())
+
+
+def _parse_result(zip_file, fields, result):
+    if result is not None:
+        fields.update(result.get())
+    return zip_file, fields
+
+
+def apply_parsed_assignments(zip_file, resolver):
+    """Update patents from the parsed assignment records of a zip file.
+    Returns the number of patents updated. Applying a file again after
+    being interrupted only updates the patents it didn't get to, since
+    patents that have assignment data are never updated.
+    """
+    patents = 0
+    with open(parsed_assignments_path(zip_file), 'rb') as parsed_file:
+        while True:
+            try:
+                batch = pickle.load(parsed_file)
+            except EOFError:
+                break
+            updates = resolver.updates(batch)
+            update_patents(updates, ASSIGNMENT_FIELDS)
+            patents += len(updates)
+    return patents
+
+
+def initial_pto_assignment_data(workers=None):
     """Build upon assignment dataset created from initial_assignment_data() by
-    dowloading and processing USPTO assignment zip and xml files
+    dowloading and processing USPTO assignment zip and xml files.
+
+    The zip files are downloaded and parsed by a pool of worker processes,
+    while their assignments are applied one file at a time in date order,
+    as they would be if processed one after the other. The state of each
+    file is kept in assignment_ledger.json, so an interrupted run resumes
+    with the files it hadn't finished.
     """
     all_zip_links = ['ad19800101-20191231-'+str(i).zfill(2)+'.zip'
                      for i in range(1, 18)]
@@ -415,25 +603,60 @@ def initial_pto_assignment_data():
         daily_xmls = daily_xmls + timedelta(1)
     pickle.dump(all_zip_links, open('all_zip_links.p', 'wb'), protocol=2)
 
-
-    if not glob('finished_zips.p'):
-        rem_zips = '../../ad/adzips/*.zip'
-        finished_zips = [zippy.split('/')[-1] for zippy in glob(rem_zips)]
-    else:
-        finished_zips = pickle.load(open('finished_zips.p', 'rb'))
+    ledger = JobLedger('assignment_ledger.json')
+    if not ledger.entries:
+        # carry over the files finished before there was a ledger. Older
+        # versions pickled a date instead of the list to finished_zips.p,
+        # in which case the zip files left from earlier runs are used
+        finished_zips = None
+        if glob('finished_zips.p'):
+            finished_zips = pickle.load(open('finished_zips.p', 'rb'))
+        if not isinstance(finished_zips, list):
+            rem_zips = '../../ad/adzips/*.zip'
+            finished_zips = [zippy.split('/')[-1]
+                             for zippy in glob(rem_zips)]
+        for finished_zip in finished_zips:
+            ledger.entries[finished_zip] = {'state': 'applied'}
+        ledger.save()
 
     remaining_zips = [zfile for zfile in all_zip_links
-                      if zfile not in finished_zips]
-
-    for remaining_zip in remaining_zips:
-        process_assignment_xml(remaining_zip)
-
-        # keep updating processed data in case process is interrupted
-        finished_zips.append(remaining_zip)
-        pickle.dump(today, open('finished_zips.p', 'wb'), protocol=2)
+                      if ledger.state(zfile) != 'applied']
+    # files parsed by an interrupted run don't need to be parsed again
+    unparsed_zips = {
+        zfile for zfile in remaining_zips
+        if ledger.state(zfile) != 'parsed'
+        or not os.path.exists(parsed_assignments_path(zfile))
+    }
+    os.makedirs('../../ad/parsed', exist_ok=True)
+
+    # the workers are forked before the resolver maps every patent, and
+    # without the database connection of this process
+    workers = workers or os.cpu_count()
+    connections.close_all()
+    with multiprocessing.Pool(workers) as pool:
+        resolver = patent_resolver()
+        parsed_zips = parsed_assignment_zips(
+            pool,
+            [zfile for zfile in remaining_zips if zfile in unparsed_zips],
+            workers
+        )
+        for remaining_zip in remaining_zips:
+            if remaining_zip in unparsed_zips:
+                parsed_zip, fields = next(parsed_zips)
+                ledger.update(parsed_zip, **fields)
+                if fields.get('state') != 'parsed':
+                    raise IOError('Could not parse %s: %s'
+                                  % (parsed_zip, fields['error']))
+
+            start = perf_counter()
+            patents = apply_parsed_assignments(remaining_zip, resolver)
+            ledger.update(remaining_zip, state='applied', patents=patents,
+                          apply_s=round(perf_counter()-start, 2))
+            os.remove(parsed_assignments_path(remaining_zip))
+            retire_archive('../../ad/adzips/' + remaining_zip)
 
     pickle.dump(today, open('last_assignment_update.p', 'wb'), protocol=2)
-    reload_server()
+    publish_patent_store()
 
 
 def update_pto_assignment_data():
@@ -467,7 +690,25 @@ def update_pto_assignment_data():
     # Make sure to save a record of last date updated so the program
     # processes any missing days
     pickle.dump(today, open('last_assignment_update.p', 'wb'), protocol=2)
-    reload_server()
+    publish_patent_store()
+
+
+def write_removed_lines(mdir, removed_lines):
+    """Write the fee entries removed from the USPTO data, sorted, to a
+    dated file in mdir, and print the first few. Returns the path of the
+    file, or None if no entries were removed.
+    """
+    if not removed_lines:
+        return None
+    removed_lines = sorted(removed_lines)
+    removed_file = mdir + '/removed-%s.txt' % date.today()
+    with open(removed_file, 'w') as removed_text:
+        for line in removed_lines:
+            removed_text.write(line.rstrip('\r\n') + '\n')
+    for line in removed_lines[:REMOVED_PRINTED]:
+        print('removed: ' + line.rstrip())
+    print('all removed entries written to ' + removed_file)
+    return removed_file
 
 
 def update_pto_data():
@@ -483,12 +724,8 @@ def update_pto_data():
     mainfile = ('https://bulkdata.uspto.gov/data/patent/'
                 'maintenancefee/MaintFeeEvents.zip'
                )
-    main_req = requests.get(mainfile)
-
-    # write zip file to disk
     zfile = '../../maintenance_fee_data/maintfees.zip'
-    with open(zfile, 'wb') as main_zip:
-        main_zip.write(main_req.content)
+    download(mainfile, zfile)
 
     # open zip file to get maintenance fee data
     mzip = zipfile.ZipFile(open(zfile, 'rb'))
@@ -500,151 +737,83 @@ def update_pto_data():
     mfile = sorted_files[-1][-1]
     efile = sorted_files[0][-1]
 
-    # each line contains a maintenance fee entry, so split into list of entries
-    with mzip.open(mfile) as main_lines:
-        lines = main_lines.readlines()
-
-    lines = set([line.decode() for line in lines])
-
-    # Need to load the previous entries to compare to latest entries
-    # because text comparison is much faster than DB filtering for # of entries
-    mpickle = '../../maintenance_fee_data/maintfees_old.p'
-    if glob(mpickle):
-        old_lines = pickle.load(open(mpickle, 'rb'))
-        new_lines = lines.difference(old_lines)
-
-        # split each entry into the separate fields, also remove example lines
-        split_lines = [line.split() for line in new_lines]
-        split_lines = [line for line in split_lines
-                       if not line[1].startswith('59')]
-
-        for line in split_lines:
-            patent_number = line[0].lstrip('0')
-            application_number = line[1]
-            entity_status = line[2]
-            application_date = date(int(line[3][:4]),
-                                    int(line[3][4:6]),
-                                    int(line[3][6:])
-                                   )
-            issue_date = date(int(line[4][:4]),
-                              int(line[4][4:6]), int(line[4][6:]))
-
-            # if there is no entity date, set as the patent date
-            try:
-                maintenance_date = date(int(line[5][:4]),
-                                        int(line[5][4:6]), int(line[5][6:]))
-            except:
-                maintenance_date = date(int(line[4][:4]),
-                                        int(line[4][4:6]), int(line[4][6:]))
-
-            # Deal with lines without maintenance code
-            try:
-                maintenance_code = line[6]
-            except:
-                maintenance_code = 'N/A'
-
-            # Cant use get_or_create here because patent_number is a unique
-            # field, but sometimes the application fields change in the
-            # updated USPTO data
-            patent = Patent.objects.filter(patent_number=patent_number)
-            if patent:
-                patent = patent.first()
-            else:
-                patent = Patent.objects.create(
-                    patent_number=patent_number,
-                    application_number=application_number,
-                    application_date=application_date,
-                    issue_date=issue_date,
-                )
-
-            # need to add/update the entity_status for each entry
-            patent.entity_status = entity_status
-            patent.save()
-
-            fee_event, fee_created = FeeEvents.objects.get_or_create(
-                patent=patent,
-                maintenance_date=maintenance_date,
-                maintenance_code=maintenance_code,
-            )
-
-    # if the file doesn't exist, then the database hasn't been built out yet
+    # Each line contains a maintenance fee entry. Lines are compared to last
+    # week's through their fingerprints, which is much faster than DB
+    # filtering for # of entries
+    with mzip.open(mfile) as member:
+        fingerprints = line_fingerprints(fee_lines(member))
+
+    mdir = '../../maintenance_fee_data'
+    fingerprint_file = mdir + '/maintfees_fingerprints.map'
+    old_zfile = mdir + '/maintfees_old.zip'
+    mpickle = mdir + '/maintfees_old.p'
+    if glob(fingerprint_file) or glob(mpickle):
+        if glob(fingerprint_file):
+            old_fingerprints = MapFile(fingerprint_file)['fingerprints']
+            old_lines = zip_fee_lines(old_zfile)
+        else:
+            # entries saved before fingerprints were used
+            old_lines = pickle.load(open(mpickle, 'rb'))
+            old_fingerprints = line_fingerprints(old_lines)
+        added, removed = fingerprint_delta(old_fingerprints, fingerprints)
+        with mzip.open(mfile) as member:
+            new_lines = list(matching_lines(fee_lines(member), added))
+        removed_lines = set(matching_lines(old_lines, removed))
+        del old_fingerprints
+
+        # Removed entries are only reported, their fee events are kept
+        print('%d fee entries added, %d removed'
+              % (len(new_lines), len(removed_lines)))
+        write_removed_lines(mdir, removed_lines)
+
+        # Patent application fields are left as they are, since they
+        # sometimes change in the updated USPTO data, but the entity_status
+        # is updated for each entry
+        UpsertLoader().load(fee_records(new_lines)).report()
+
+    # if neither file exists, then the database hasn't been built out yet
     else:
 
-        # split each entry into the separate fields, also remove example lines
-        split_lines = [line.split() for line in lines]
-        split_lines = [line for line in split_lines
-                       if not line[1].startswith('59')]
-
-        # Create new maintenance event entries, but have to check each because
-        # there is no easy way to separate the new entries
-        pat_dict = {}
-        for sline in split_lines:
-            ref_id = sline[0].lstrip('0')
-            if ref_id in pat_dict:
-                pat_dict[ref_id].append(sline[1:])
-            else:
-                pat_dict[ref_id] = [sline[1:]]
-        vcnt = 0
-        for k, mdata in pat_dict.items():
-            patent_number = k
-            for i, pat_data in enumerate(mdata):
-                if i == 0:
-                    application_number = pat_data[0]
-                    entity_status = pat_data[1]
-                    application_date = date(int(pat_data[2][:4]),
-                                            int(pat_data[2][4:6]),
-                                            int(pat_data[2][6:]))
-                    issue_date = date(int(pat_data[3][:4]),
-                                      int(pat_data[3][4:6]),
-                                      int(pat_data[3][6:]))
-
-                    patent = Patent.objects.create(
-                        patent_number=patent_number,
-                        application_number=application_number,
-                        entity_status=entity_status,
-                        application_date=application_date,
-                        issue_date=issue_date,
-                    )
-
-                # if there is no Fee Event Entry Date, set as the patent date
-                try:
-                    maintenance_date = date(int(pat_data[4][:4]),
-                                            int(pat_data[4][4:6]),
-                                            int(pat_data[4][6:]))
-                except:
-                    maintenance_date = date(int(pat_data[3][:4]),
-                                            int(pat_data[3][4:6]),
-                                            int(pat_data[3][6:]))
-                # Deal with entries without maintenance code
-                try:
-                    maintenance_code = pat_data[5]
-                except:
-                    maintenance_code = 'N/A'
-
-                fee_created = FeeEvents.objects.create(
-                    patent=patent,
-                    maintenance_date=maintenance_date,
-                    maintenance_code=maintenance_code,
-                )
-            vcnt += 1
-
-    # Need to save latest data in order to compare to new data the next week
-    pickle.dump(lines, open(mpickle, 'wb'), protocol=2)
+        # The database is empty, so every record is bulk loaded. The file
+        # is decompressed so that a pool of processes can parse it
+        if settings.PTO_MYSQL_LOAD_DATA:
+            loader = MySQLLoadDataLoader()
+        else:
+            loader = BulkLoader()
+        mtext = mdir + '/maintfees.txt'
+        with mzip.open(mfile) as member, open(mtext, 'wb') as text_file:
+            shutil.copyfileobj(member, text_file)
+        loader.load_file(mtext).report()
+        os.remove(mtext)
+
+    # Need to save latest data in order to compare to new data the next
+    # week. The zip file is kept to look up the entries removed by then
+    retire_archive(old_zfile)
+    os.replace(zfile, old_zfile)
+    dump_sections(mdir, 'maintfees_fingerprints.map',
+                  {'fingerprints': fingerprints})
+    if glob(mpickle):
+        os.remove(mpickle)
 
     # Create a pickled dictionary with event codes as keys and
     # their respective descriptions as their values
     with mzip.open(efile) as fee_file:
-        fee_lines = fee_file.readlines()
+        code_lines = fee_file.readlines()
 
     fee_codes = {}
-    for line in fee_lines:
+    for line in code_lines:
         line = line.decode()
         split_line = re.match(r'(.*?)\s+(.*?)\n', line)
         fee_codes[split_line.group(1)] = split_line.group(2)
 
-    pickle.dump(fee_codes, open('fee_event_codes.p', 'wb'), protocol=2)
-
     # When all the above code has executed, we can generate the
-    # remaining data and reload the server
-    generate_final_data()
-    reload_server()
+    # remaining data and publish it to the server
+    snapshot_dir = start_snapshot()
+    try:
+        dump_sections(snapshot_dir, 'fee_event_codes.map',
+                      {'fee_codes': fee_codes})
+        generate_final_data(snapshot_dir)
+    except BaseException:
+        discard_snapshot(snapshot_dir)
+        raise
+    publish_snapshot(snapshot_dir)
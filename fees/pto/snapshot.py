@@ -0,0 +1,343 @@
+"""
+Versioned snapshots of the data generated by pto_cron.py. Every cron job
+writes its files into a new snapshot directory, which is published
+atomically by pointing the CURRENT file at it. Serving processes check the
+CURRENT file between requests and swap the new snapshot in without being
+restarted, while requests already running keep the snapshot they started
+with. An old snapshot is released once no request is using it anymore, and
+its directory is only removed once no process has it open.
+Cron jobs stage their snapshots one at a time, holding a lock from
+start_snapshot until the snapshot is published, so none of them drops the
+files another one published in the meantime.
+
+The data of a snapshot is loaded lazily, one patent set at a time, so a
+process can start serving right away and a request only waits for the
+patent set it needs. A background thread can optionally warm up all the
+patent sets of every snapshot as soon as it is swapped in.
+"""
+
+import os
+import fcntl
+import shutil
+import threading
+from datetime import datetime
+from functools import wraps
+
+from django.conf import settings
+
+from pto.constants import SNAPSHOT_DIR, SNAPSHOTS_KEPT, ORDERED_PATS
+from pto.mapfile import write_mapfile
+from pto.extras import (get_ordered_docs, get_patent_store, get_number_index,
+    get_fee_event_index, get_fee_codes)
+
+
+CURRENT_FILE = os.path.join(SNAPSHOT_DIR, 'CURRENT')
+
+LOCK_FILE = os.path.join(SNAPSHOT_DIR, 'LOCK')
+
+STAGING_PREFIX = '.staging-'
+
+# Files every published snapshot must have
+REQUIRED_FILES = ['fee_event_codes.map', 'patent_store.map',
+                  'paid_patents.map'] + [
+    set_id+suffix for set_id in ORDERED_PATS
+    for suffix in ('_ordered_ids.map', '_number_index.map',
+                   '_fee_events.map')
+]
+
+# Open lock file of each staging directory, closed to release the lock
+_staging_locks = {}
+
+
+def current_version():
+    """Get the version of the latest published snapshot, if any."""
+    try:
+        with open(CURRENT_FILE) as current_file:
+            return current_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def start_snapshot():
+    """Create the staging directory of a new snapshot. It starts out with
+    links to the files of the current snapshot, so a cron job only has to
+    write the data it changes. Waits for any other snapshot being staged
+    to be published first.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    lock_file = open(LOCK_FILE, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    staging_dir = os.path.join(SNAPSHOT_DIR, STAGING_PREFIX+version)
+    os.makedirs(staging_dir)
+    current = current_version()
+    if current:
+        current_dir = os.path.join(SNAPSHOT_DIR, current)
+        for name in os.listdir(current_dir):
+            os.link(os.path.join(current_dir, name),
+                    os.path.join(staging_dir, name))
+    _staging_locks[staging_dir] = lock_file
+    return staging_dir
+
+
+def discard_snapshot(staging_dir):
+    """Remove a staged snapshot without publishing it."""
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    _staging_locks.pop(staging_dir).close()
+
+
+def dump_sections(snapshot_dir, name, sections):
+    """Write map file sections into a snapshot file. The file is replaced
+    rather than overwritten, since it may still be linked to by older
+    snapshots or mapped by serving processes.
+    """
+    path = os.path.join(snapshot_dir, name)
+    write_mapfile(path+'.tmp', sections)
+    os.replace(path+'.tmp', path)
+
+
+def publish_snapshot(staging_dir):
+    """Make a staged snapshot the current one and remove the oldest
+    snapshots. A snapshot missing any of the REQUIRED_FILES is discarded
+    instead, raising FileNotFoundError.
+    """
+    missing = [name for name in REQUIRED_FILES
+               if not os.path.exists(os.path.join(staging_dir, name))]
+    if missing:
+        discard_snapshot(staging_dir)
+        raise FileNotFoundError('Snapshot not published, missing '
+                                + ', '.join(missing))
+
+    version = os.path.basename(staging_dir)[len(STAGING_PREFIX):]
+    os.rename(staging_dir, os.path.join(SNAPSHOT_DIR, version))
+    with open(CURRENT_FILE+'.tmp', 'w') as current_file:
+        current_file.write(version)
+    os.replace(CURRENT_FILE+'.tmp', CURRENT_FILE)
+
+    # snapshots still open in a serving process may load more of their
+    # files later, so they are kept until a later publish finds them unused
+    versions = sorted(name for name in os.listdir(SNAPSHOT_DIR)
+                      if name[0].isdigit())
+    for old_version in versions[:-SNAPSHOTS_KEPT]:
+        _remove_unused(os.path.join(SNAPSHOT_DIR, old_version))
+    _staging_locks.pop(staging_dir).close()
+
+
+def _remove_unused(snapshot_dir):
+    """Remove a published snapshot unless a Snapshot has it open."""
+    dir_fd = os.open(snapshot_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(dir_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pass
+    else:
+        shutil.rmtree(snapshot_dir)
+    finally:
+        os.close(dir_fd)
+
+
+class Snapshot:
+    """Data of one published snapshot, shared by all the requests served
+    while it is current. Each part of the data is loaded the first time it
+    is used, holding a lock of its own so loading one patent set never
+    blocks requests for the others. The snapshot directory is share locked
+    until the snapshot is closed, so publish_snapshot doesn't remove it
+    while it may still be loaded from.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.snapshot_dir = os.path.join(SNAPSHOT_DIR, version)
+        self._dir_fd = os.open(self.snapshot_dir, os.O_RDONLY)
+        fcntl.flock(self._dir_fd, fcntl.LOCK_SH)
+        self.users = 0
+        self.retired = False
+        self.closed = False
+        self._data = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _load(self, key, loader, *args):
+        data = self._data.get(key)
+        if data is None:
+            with self._locks_lock:
+                if self.closed:
+                    raise RuntimeError('Snapshot %s is closed' % self.version)
+                lock = self._locks.setdefault(key, threading.Lock())
+            with lock:
+                data = self._data.get(key)
+                if data is None:
+                    data = loader(self.snapshot_dir, *args)
+                    with self._locks_lock:
+                        if not self.closed:
+                            self._data[key] = data
+        return data
+
+    def ordered_docs(self, set_id):
+        """Get the orderings of a patent set."""
+        return self._load(('ordered_docs', set_id), get_ordered_docs, set_id)
+
+    def number_index(self, set_id):
+        """Get the patent number substring index of a patent set."""
+        return self._load(('number_index', set_id), get_number_index, set_id)
+
+    def fee_event_index(self, set_id):
+        """Get the maintenance fee events of the patents in a patent set."""
+        return self._load(('fee_event_index', set_id), get_fee_event_index,
+                          set_id)
+
+    @property
+    def patent_store(self):
+        """Get the columnar store of the patents in every patent set."""
+        return self._load('patent_store', get_patent_store)
+
+    @property
+    def fee_codes(self):
+        """Get the maintenance fee codes defined by the USPTO."""
+        return self._load('fee_codes', get_fee_codes)
+
+    def warm_up(self):
+        """Load all the data of the snapshot that isn't loaded yet, stopping
+        if the snapshot is closed in the meantime.
+        """
+        try:
+            self._load('fee_codes', get_fee_codes)
+            self._load('patent_store', get_patent_store)
+            for set_id in ORDERED_PATS:
+                self.ordered_docs(set_id)
+                self.number_index(set_id)
+                self.fee_event_index(set_id)
+        except RuntimeError:
+            if not self.closed:
+                raise
+
+    def close(self):
+        """Drop the references to the snapshot data, which unmaps the
+        snapshot files once nothing else refers to them. Nothing is loaded
+        into a closed snapshot, so its directory can then be removed.
+        """
+        with self._locks_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._data = {}
+            os.close(self._dir_fd)
+
+
+# Snapshot used for new requests, swapped under _swap_lock. _load_lock
+# makes sure only one thread swaps in a newly published snapshot.
+_current = None
+_swap_lock = threading.Lock()
+_load_lock = threading.Lock()
+
+# Whether snapshots are warmed up in the background once swapped in
+_warm_up = False
+
+
+def _start_warm_up(snapshot):
+    threading.Thread(target=snapshot.warm_up, daemon=True).start()
+
+
+def load_snapshot():
+    """Load the latest published snapshot if it isn't the current one. The
+    previous snapshot keeps being served while the new one loads.
+    """
+    global _current
+    version = current_version()
+    if version is None:
+        raise FileNotFoundError('No snapshot published in ' + SNAPSHOT_DIR)
+    if _current is not None and _current.version == version:
+        return
+    if not _load_lock.acquire(blocking=_current is None):
+        return
+    try:
+        if _current is None or _current.version != version:
+            snapshot = Snapshot(version)
+            with _swap_lock:
+                old_snapshot, _current = _current, snapshot
+                if old_snapshot is not None:
+                    old_snapshot.retired = True
+                    if not old_snapshot.users:
+                        old_snapshot.close()
+            if _warm_up:
+                _start_warm_up(snapshot)
+    finally:
+        _load_lock.release()
+
+
+def warm_up():
+    """Warm up the current snapshot and all later ones in the background,
+    if enabled by the PTO_WARM_UP setting. Does nothing until the first
+    snapshot has been published.
+    """
+    global _warm_up
+    if not settings.PTO_WARM_UP:
+        return
+    with _load_lock:
+        _warm_up = True
+        snapshot = _current
+    # a snapshot swapped in from now on is warmed up by load_snapshot
+    if snapshot is not None:
+        _start_warm_up(snapshot)
+    elif current_version() is not None:
+        load_snapshot()
+
+
+def acquire_snapshot():
+    """Get the current snapshot, swapping in a newly published one first,
+    and keep it alive until it is released.
+    """
+    load_snapshot()
+    with _swap_lock:
+        snapshot = _current
+        snapshot.users += 1
+    return snapshot
+
+
+def release_snapshot(snapshot):
+    """Stop using a snapshot, closing it if it has been swapped out."""
+    with _swap_lock:
+        snapshot.users -= 1
+        if snapshot.retired and not snapshot.users:
+            snapshot.close()
+
+
+class _SnapshotContent:
+    """Streaming content holding a snapshot until the response is closed.
+    Django closes the response even if its content was never iterated, so
+    the snapshot is always released.
+    """
+
+    def __init__(self, streaming_content, snapshot):
+        self.streaming_content = streaming_content
+        self.snapshot = snapshot
+
+    def __iter__(self):
+        return iter(self.streaming_content)
+
+    def close(self):
+        if self.snapshot is not None:
+            snapshot, self.snapshot = self.snapshot, None
+            release_snapshot(snapshot)
+
+
+def with_snapshot(view):
+    """Pass the current snapshot to a view for the whole request. Streaming
+    responses keep the snapshot until they are closed.
+    """
+    @wraps(view)
+    def snapshot_view(request, *args, **kwargs):
+        snapshot = acquire_snapshot()
+        try:
+            response = view(request, snapshot, *args, **kwargs)
+        except BaseException:
+            release_snapshot(snapshot)
+            raise
+        if response.streaming:
+            response.streaming_content = _SnapshotContent(
+                response.streaming_content, snapshot
+            )
+        else:
+            release_snapshot(snapshot)
+        return response
+    return snapshot_view
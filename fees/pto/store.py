@@ -0,0 +1,178 @@
+"""
+Compact columnar copy of the patents in all the patent sets, built by
+pto_cron.py and read by views.py in place of Django model instances. Each
+patent is held once no matter how many patent sets it belongs to, dates are
+kept as ordinals and all text columns share one deduplicated string pool.
+The JSON of every row is also encoded once while building, so table pages
+can be put together without serializing anything per request. Stores are
+saved as map file sections and read in place from the memory mapped file.
+"""
+
+import json
+from array import array
+from bisect import bisect_left
+from datetime import date
+
+
+# Patent columns in the same order the PatentSerializer outputs them
+FIELDS = (
+    'id',
+    'patent_number',
+    'application_number',
+    'entity_status',
+    'application_date',
+    'issue_date',
+    'reel_num',
+    'frame_num',
+    'correspondent_name',
+    'correspondent_address',
+    'pat_assignee_name',
+    'pat_assignee_address'
+)
+
+DATE_FIELDS = ('application_date', 'issue_date')
+
+
+class StringPool:
+    """Deduplicated strings stored as one utf-8 blob and an offset array."""
+
+    def __init__(self):
+        self.blob = b''
+        self.offsets = array('l', [0])
+        self._lookup = {}
+        self._parts = []
+
+    def add(self, value):
+        """Add a string to the pool while building, returning its index."""
+        if value not in self._lookup:
+            encoded = value.encode()
+            self._parts.append(encoded)
+            self.offsets.append(self.offsets[-1]+len(encoded))
+            self._lookup[value] = len(self._lookup)
+        return self._lookup[value]
+
+    def freeze(self):
+        """Join the added strings and drop the build time lookups."""
+        self.blob = b''.join(self._parts)
+        self._lookup, self._parts = {}, []
+
+    def get(self, index):
+        """Decode a single string from the pool."""
+        return str(self.blob[self.offsets[index]:self.offsets[index+1]],
+                   'utf-8')
+
+    def to_sections(self, prefix):
+        """Get the map file sections holding the pool."""
+        return {prefix+'blob': self.blob, prefix+'offsets': self.offsets}
+
+    @classmethod
+    def from_sections(cls, sections, prefix):
+        """Create a pool reading its strings from map file sections."""
+        pool = cls.__new__(cls)
+        pool.blob = sections[prefix+'blob']
+        pool.offsets = sections[prefix+'offsets']
+        return pool
+
+
+class PatentStore:
+    """Id indexed patent columns shared by every patent set.
+
+    Rows are kept sorted by patent id, so a patent is found with a binary
+    search. Date columns hold ordinals and text columns hold indexes into
+    the string pool, with -1 standing in for a missing value. The JSON
+    fragments are byte for byte what JsonResponse outputs for each row.
+    """
+
+    def __init__(self, rows):
+        """Build the columns from tuples of FIELDS sorted by patent id."""
+        self.ids = array('i')
+        self.pool = StringPool()
+        self.columns = {field: array('i') for field in FIELDS[1:]}
+        for row in rows:
+            self.ids.append(row[0])
+            for field, value in zip(FIELDS[1:], row[1:]):
+                if field in DATE_FIELDS:
+                    value = value.toordinal()
+                elif value is None:
+                    value = -1
+                else:
+                    value = self.pool.add(value)
+                self.columns[field].append(value)
+        self.pool.freeze()
+
+        fragments = [json.dumps(self._row(i)).encode()
+                     for i in range(len(self.ids))]
+        self.fragment_offsets = array('l', [0])
+        for fragment in fragments:
+            self.fragment_offsets.append(
+                self.fragment_offsets[-1]+len(fragment)
+            )
+        self.fragments = b''.join(fragments)
+
+    def to_sections(self):
+        """Get the map file sections holding the store."""
+        sections = {'ids': self.ids}
+        for field, column in self.columns.items():
+            sections['column:'+field] = column
+        sections.update(self.pool.to_sections('pool:'))
+        sections['fragments'] = self.fragments
+        sections['fragment_offsets'] = self.fragment_offsets
+        return sections
+
+    @classmethod
+    def from_sections(cls, sections):
+        """Create a store reading its rows from map file sections."""
+        patent_store = cls.__new__(cls)
+        patent_store.ids = sections['ids']
+        patent_store.columns = {field: sections['column:'+field]
+                                for field in FIELDS[1:]}
+        patent_store.pool = StringPool.from_sections(sections, 'pool:')
+        patent_store.fragments = sections['fragments']
+        patent_store.fragment_offsets = sections['fragment_offsets']
+        return patent_store
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, pk):
+        """Get the row index of a patent id."""
+        i = bisect_left(self.ids, pk)
+        if i == len(self.ids) or self.ids[i] != pk:
+            raise KeyError(pk)
+        return i
+
+    def value(self, i, field):
+        """Get a single field of a row, formatted like the serializer."""
+        value = self.columns[field][i]
+        if field in DATE_FIELDS:
+            return date.fromordinal(value).isoformat()
+        if value == -1:
+            return None
+        return self.pool.get(value)
+
+    def _row(self, i):
+        patent = {'id': self.ids[i]}
+        for field in FIELDS[1:]:
+            patent[field] = self.value(i, field)
+        return patent
+
+    def row(self, pk):
+        """Get a patent as a dictionary matching PatentSerializer data."""
+        return self._row(self.index(pk))
+
+    def rows(self, pks):
+        """Get the rows of several patents, in the order requested."""
+        return [self.row(pk) for pk in pks]
+
+    def json_row(self, pk):
+        """Get the encoded JSON of a single patent."""
+        i = self.index(pk)
+        return self.fragments[
+            self.fragment_offsets[i]:self.fragment_offsets[i+1]
+        ]
+
+    def json_rows(self, pks):
+        """Get the encoded JSON array items of several patents, in the
+        order requested.
+        """
+        return b', '.join([self.json_row(pk) for pk in pks])
@@ -1,3 +1,1383 @@
-from django.test import TestCase
+import io
+import os
+import csv
+import json
+import random
+import time
+import hashlib
+import tempfile
+import threading
+import unittest
+import zipfile
+import multiprocessing
+from xml.etree import ElementTree as ET
+from array import array
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler
+from unittest import mock
 
-# Create your tests here.
+import requests
+
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.test import override_settings
+
+from pto import (downloads, maintfees, patentsview, pto_cron, snapshot,
+    views)
+from pto.assignments import (ASSIGNMENT_FIELDS, assignment_updates,
+    xml_assignments)
+from pto.benchmarks import (ThreadingHTTPServer, start_patentsview_standin,
+    synthetic_fee_zip)
+from pto.constants import ANAMES, MAX_BATCH_PATENTS
+from pto.cache import cached_response
+from pto.extras import get_ordered_docs, get_patent_store
+from pto.indexes import NumberIndex
+from pto.ledger import JobLedger
+from pto.loaders import BulkLoader, UpsertLoader
+from pto.maintfees import (fee_record, fee_records, fingerprint_delta,
+    line_fingerprints, matching_lines, zip_fee_lines)
+from pto.models import FeeEvents, Patent
+from pto.orderings import (SortKeys, build_orderings, merge_orderings,
+    mysql_name_key)
+from pto.serializers import PatentSerializer
+from pto.snapshot import dump_sections
+from pto.store import FIELDS, PatentStore
+
+
+def memory_usage(path):
+    """Get the RSS and PSS in kB of this process' mappings of a file, and
+    the anonymous memory of the whole process, which holds what it copied.
+    """
+    usage = {'Rss': 0, 'Pss': 0, 'Anonymous': 0}
+    in_mapping = False
+    with open('/proc/self/smaps') as smaps:
+        for line in smaps:
+            field = line.split()[0]
+            if not field.endswith(':'):
+                in_mapping = line.rstrip().endswith(path)
+            elif field == 'Anonymous:':
+                usage['Anonymous'] += int(line.split()[1])
+            elif in_mapping and field[:-1] in usage:
+                usage[field[:-1]] += int(line.split()[1])
+    return usage
+
+
+def ordered_docs_worker(snapshot_dir, results, loaded, done):
+    """Read every page of a patent set's orderings and report the memory
+    it took, once every worker has read them.
+    """
+    path = 'four_year_ordered_ids.map'
+    before = memory_usage(path)
+    ordered_docs = get_ordered_docs(snapshot_dir, 'four_year')
+    sum(ordered_docs['patent_number'][::1024])
+    loaded.wait()
+    usage = memory_usage(path)
+    usage['Anonymous'] -= before['Anonymous']
+    results.put(usage)
+    done.wait()
+
+
+# Maintenance fee lines with repeats, a blank line and an example line
+FEE_LINES = [
+    '00004000000 10000000 N 19980209 20030825 20120404 M183\n',
+    '00004000000 10000000 N 19980209 20030825\n',
+    '00004000000 10000000 N 19980209 20030825 20120404 M183\n',
+    '\n',
+    '00004000007 10000001 Y 19990301 20040105 20080312 M1551\n',
+    '00004000007 10000001 Y 19990301 20040105 20080312 M1551\n',
+    '00000000001 59000000 N 19900101 19910101 19920101 M170\n',
+    '00004000014 10000002 N 19990301 20040105 20110105 EXP.\n',
+]
+
+
+def baseline_fee_records(lines):
+    """Parse fee lines the way the original update did, removing repeated
+    lines with a set of the whole file.
+    """
+    return sorted(fee_record(line.split()) for line in set(lines)
+                  if line.split() and not line.split()[1].startswith('59'))
+
+
+class SnapshotDirTestCase(SimpleTestCase):
+    """Runs each test with its own snapshot directory."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.snapshot_dir = temp_dir.name
+        patcher = mock.patch.multiple(
+            snapshot, SNAPSHOT_DIR=temp_dir.name,
+            CURRENT_FILE=os.path.join(temp_dir.name, 'CURRENT'),
+            LOCK_FILE=os.path.join(temp_dir.name, 'LOCK')
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stage_all(self, staging_dir, content=b''):
+        """Write every required file into a staged snapshot."""
+        for name in snapshot.REQUIRED_FILES:
+            with open(os.path.join(staging_dir, name), 'wb') as staged:
+                staged.write(content)
+
+
+def create_patent(number, issue_date=date(2015, 6, 2), **fields):
+    """Create a patent with placeholder values for the fields not given."""
+    values = {'application_number': 'A'+number, 'entity_status': 'N',
+              'application_date': date(2013, 1, 8), 'issue_date': issue_date,
+              'correspondent_name': '', 'pat_assignee_name': ''}
+    values.update(fields)
+    return Patent.objects.create(patent_number=number, **values)
+
+
+class NumberIndexTests(SimpleTestCase):
+    """Patent number filter searches."""
+
+    def setUp(self):
+        numbers = {1: '7111000', 2: '7111100', 3: '7000111', 4: '8123456'}
+        ordered_docs = {'patent_number': array('i', [1, 2, 3, 4])}
+        for sort_id in ('issue_date', 'application_number',
+                        'application_date', 'pat_assignee_name',
+                        '-pat_assignee_name', 'correspondent_name',
+                        '-correspondent_name'):
+            ordered_docs[sort_id] = array('i', [4, 3, 2, 1])
+        self.index = NumberIndex(ordered_docs, numbers, {2})
+
+    def search(self, filt, sort_by='patent_number', unpaid=False):
+        return self.index.patent_ids(self.index.search(filt, sort_by, unpaid))
+
+    def test_repeated_gram_filter(self):
+        self.assertEqual(self.search('1111'), [2])
+        self.assertEqual(self.search('0000'), [])
+        self.assertEqual(self.search('111'), [1, 2, 3])
+
+    def test_order_and_unpaid(self):
+        self.assertEqual(self.search('11', 'issue_date'), [3, 2, 1])
+        self.assertEqual(self.search('11', '-patent_number', True), [3, 1])
+
+
+class OrderingTests(SimpleTestCase):
+    """Orderings of the patent sets."""
+
+    def test_mysql_name_order(self):
+        names = ['b', '_a', 'Zed', 'A', '\u00c9cole', 'ecole ', 'ECOLE']
+        self.assertEqual(sorted(names, key=mysql_name_key),
+                         ['A', 'b', '\u00c9cole', 'ecole ', 'ECOLE', 'Zed',
+                          '_a'])
+
+    def test_names_before_empty_and_missing(self):
+        day = date(2015, 6, 2)
+        sort_keys = SortKeys([
+            (pk, str(pk), day, 'A', day, name, '')
+            for pk, name in [(1, None), (2, 'beta'), (3, ''), (4, 'Alpha'),
+                             (5, 'alpha')]
+        ])
+        ordered_docs = build_orderings(sort_keys, mysql_name_key)
+        self.assertEqual(list(ordered_docs['pat_assignee_name']),
+                         [4, 5, 2, 3, 1])
+        self.assertEqual(list(ordered_docs['-pat_assignee_name']),
+                         [2, 4, 5, 3, 1])
+
+    def test_merged_weeks_match_rebuild(self):
+        rand = random.Random(0)
+        names = [None, '', 'acme', 'ACME ', 'Beta', '\u00c9cole', 'zed']
+
+        def patent(pk):
+            day = date(2015, 1, 6) + timedelta(rand.randrange(60))
+            return [pk, str(7000000+pk), day, str(rand.randrange(100)),
+                    day - timedelta(rand.randrange(900)), rand.choice(names),
+                    rand.choice(names)]
+
+        rows = {pk: patent(pk) for pk in range(1, 301)}
+        sort_keys = SortKeys(sorted(map(tuple, rows.values())))
+        ordered_docs = build_orderings(sort_keys, mysql_name_key)
+        for week in range(6):
+            for pk in rand.sample(sorted(rows), 10):
+                del rows[pk]
+            for pk in rand.sample(sorted(rows), 20):
+                column = rand.randrange(2, 7)
+                rows[pk][column] = patent(pk)[column]
+            for pk in range(301+15*week, 316+15*week):
+                rows[pk] = patent(pk)
+
+            # the previous week's keys come back from their map sections
+            old_keys = SortKeys.from_sections(sort_keys.to_sections('set:'),
+                                              'set:')
+            sort_keys = SortKeys(sorted(map(tuple, rows.values())))
+            ordered_docs, changes = merge_orderings(
+                ordered_docs, old_keys, sort_keys, mysql_name_key
+            )
+            self.assertEqual(ordered_docs,
+                             build_orderings(sort_keys, mysql_name_key))
+
+    def test_unpaid_pages_match_filtered_orderings(self):
+        rand = random.Random(1)
+        day = date(2015, 1, 6)
+        sort_keys = SortKeys([
+            (pk, str(7000000+pk), day + timedelta(rand.randrange(30)), 'N',
+             day, rand.choice(['acme', 'beta', '']), None)
+            for pk in range(1, 101)
+        ])
+        ordered_docs = build_orderings(sort_keys)
+        paid = set(rand.sample(range(1, 101), 40))
+        unpaid_docs = pto_cron.process_unpaid_docs(ordered_docs, paid)
+        self.assertEqual(unpaid_docs['count'],
+                         ordered_docs['count'] - len(paid))
+        for sort_by in ordered_docs:
+            if sort_by == 'count':
+                continue
+            # pages were taken from the filtered ordering on every request
+            unpaid = [x for x in ordered_docs[sort_by] if x not in paid]
+            for start_row in range(0, 70, 25):
+                self.assertEqual(
+                    list(unpaid_docs[sort_by][start_row:start_row+25]),
+                    unpaid[start_row:start_row+25]
+                )
+
+
+class PatentStoreTests(TestCase):
+    """Patent stores built for the orderings of a snapshot."""
+
+    def test_store_follows_orderings(self):
+        patents = [create_patent(str(7000000+i)) for i in range(3)]
+        deleted_pk = patents[0].pk
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            dump_sections(snapshot_dir, 'four_year_ordered_ids.map', {
+                'patent_number': array('i', [patents[1].pk, patents[0].pk])
+            })
+            pto_cron.generate_patent_store(snapshot_dir)
+            self.assertEqual(list(get_patent_store(snapshot_dir).ids),
+                             [patents[0].pk, patents[1].pk])
+
+            # a patent deleted after the orderings were built keeps its row
+            patents[0].delete()
+            patents[1].pat_assignee_name = 'ACME'
+            patents[1].save()
+            pto_cron.generate_patent_store(snapshot_dir)
+            patent_store = get_patent_store(snapshot_dir)
+            self.assertEqual(patent_store.row(deleted_pk)['patent_number'],
+                             '7000000')
+            self.assertEqual(
+                patent_store.row(patents[1].pk)['pat_assignee_name'], 'ACME'
+            )
+            self.assertRaises(KeyError, patent_store.index, patents[2].pk)
+
+    def test_json_rows_match_serializer(self):
+        patents = [
+            create_patent('7000000'),
+            create_patent('7000001', reel_num='12', frame_num='34',
+                          correspondent_name='O\'Brien "Law"',
+                          correspondent_address='1 Main St\nSuite 2',
+                          pat_assignee_name='\u00c9cole \u2603'),
+            create_patent('7000002', correspondent_name=None,
+                          pat_assignee_name=None),
+        ]
+        patent_store = PatentStore(Patent.objects.order_by('pk').values_list(
+            *FIELDS
+        ))
+        page = [patents[2], patents[0], patents[1]]
+        # pages were serialized per request and encoded by JsonResponse
+        expected = JsonResponse({
+            'patents': [PatentSerializer(p).data for p in page], 'count': 3
+        }).content
+        json_rows = patent_store.json_rows([p.pk for p in page])
+        self.assertEqual(b'{"patents": [%s], "count": %d}' % (json_rows, 3),
+                         expected)
+
+
+class PublishSnapshotTests(SnapshotDirTestCase):
+    """Staging and publishing snapshots."""
+
+    def test_snapshots_staged_one_at_a_time(self):
+        first = snapshot.start_snapshot()
+        self.stage_all(first, b'first')
+        staged = []
+        second = threading.Thread(
+            target=lambda: staged.append(snapshot.start_snapshot())
+        )
+        second.start()
+        second.join(0.2)
+        self.assertTrue(second.is_alive())
+        snapshot.publish_snapshot(first)
+        second.join(5)
+        self.assertFalse(second.is_alive())
+
+        # the second snapshot starts out with the files of the first one
+        path = os.path.join(staged[0], 'patent_store.map')
+        with open(path, 'rb') as staged_file:
+            self.assertEqual(staged_file.read(), b'first')
+        snapshot.publish_snapshot(staged[0])
+        version = os.path.basename(staged[0])[len(snapshot.STAGING_PREFIX):]
+        self.assertEqual(snapshot.current_version(), version)
+
+    def test_incomplete_snapshot_not_published(self):
+        staging_dir = snapshot.start_snapshot()
+        dump_sections(staging_dir, 'patent_store.map', {})
+        self.assertRaises(FileNotFoundError, snapshot.publish_snapshot,
+                          staging_dir)
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertIsNone(snapshot.current_version())
+
+        # the lock was released along with the discarded snapshot
+        staging_dir = snapshot.start_snapshot()
+        self.stage_all(staging_dir)
+        snapshot.publish_snapshot(staging_dir)
+        self.assertIsNotNone(snapshot.current_version())
+
+    def test_snapshots_in_use_kept(self):
+        def publish():
+            staging_dir = snapshot.start_snapshot()
+            self.stage_all(staging_dir)
+            snapshot.publish_snapshot(staging_dir)
+            return snapshot.current_version()
+
+        def published():
+            return sorted(name for name in os.listdir(self.snapshot_dir)
+                          if name[0].isdigit())
+
+        oldest = snapshot.Snapshot(publish())
+        versions = [oldest.version] + [
+            publish() for i in range(snapshot.SNAPSHOTS_KEPT)
+        ]
+        self.assertEqual(published(), versions)
+
+        oldest.close()
+        versions.append(publish())
+        self.assertEqual(published(), versions[-snapshot.SNAPSHOTS_KEPT:])
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/smaps'),
+                     'needs /proc/self/smaps')
+class SnapshotMemoryTests(SimpleTestCase):
+    """Snapshot data is shared by the workers instead of copied into them."""
+
+    def worker_usages(self, snapshot_dir, workers):
+        context = multiprocessing.get_context('fork')
+        results, done = context.Queue(), context.Event()
+        loaded = context.Barrier(workers)
+        processes = [
+            context.Process(target=ordered_docs_worker,
+                            args=(snapshot_dir, results, loaded, done))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        usages = [results.get(timeout=60) for _ in processes]
+        done.set()
+        for process in processes:
+            process.join()
+        return usages
+
+    def test_rss_flat_as_workers_grow(self):
+        size_kb = 32*1024
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            dump_sections(snapshot_dir, 'four_year_ordered_ids.map', {
+                'patent_number': array('i', range(size_kb*256))
+            })
+            for workers in (1, 2, 4):
+                usages = self.worker_usages(snapshot_dir, workers)
+                for usage in usages:
+                    # every worker sees the whole file, without copying it
+                    self.assertGreater(usage['Rss'], size_kb*0.9)
+                    self.assertLess(usage['Anonymous'], size_kb/8)
+                # and all of them together use it once
+                pss = sum(usage['Pss'] for usage in usages)
+                self.assertLess(pss, size_kb*1.1)
+
+
+class SnapshotCloseTests(SnapshotDirTestCase):
+    """Closing a snapshot that is still being loaded."""
+
+    def test_nothing_loaded_after_close(self):
+        os.mkdir(os.path.join(self.snapshot_dir, '20200101000000000000'))
+        retired = snapshot.Snapshot('20200101000000000000')
+
+        def close_while_loading(snapshot_dir):
+            retired.close()
+            return {'loaded': True}
+
+        self.assertEqual(retired._load('fee_codes', close_while_loading),
+                         {'loaded': True})
+        self.assertEqual(retired._data, {})
+        # a warm-up still running stops at the next part it would load
+        retired.warm_up()
+        self.assertEqual(retired._data, {})
+
+
+@override_settings(PTO_WARM_UP=True)
+class WarmUpTests(SnapshotDirTestCase):
+    """Background warm-up of the snapshots swapped in."""
+
+    def setUp(self):
+        super().setUp()
+        self.started = []
+        patcher = mock.patch.multiple(
+            snapshot, _current=None, _warm_up=False,
+            _start_warm_up=self.started.append
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def publish(self):
+        staging_dir = snapshot.start_snapshot()
+        self.stage_all(staging_dir)
+        snapshot.publish_snapshot(staging_dir)
+
+    def test_each_snapshot_warmed_up_once(self):
+        self.publish()
+        snapshot.warm_up()
+        self.assertEqual([started.version for started in self.started],
+                         [snapshot.current_version()])
+        self.publish()
+        snapshot.load_snapshot()
+        self.assertEqual(self.started[-1].version,
+                         snapshot.current_version())
+        self.assertEqual(len(self.started), 2)
+
+    def test_snapshot_loaded_before_warm_up(self):
+        self.publish()
+        snapshot.load_snapshot()
+        snapshot.warm_up()
+        self.assertEqual(self.started, [snapshot._current])
+
+
+@override_settings(
+    CACHES={'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }},
+    PTO_RESPONSE_CACHE='responses', PTO_RESPONSE_CACHE_MAX_BYTES=10
+)
+class ResponseCacheTests(SimpleTestCase):
+    """Responses cached per snapshot version."""
+
+    def setUp(self):
+        self.calls = []
+
+        @cached_response(lambda query: (query['page'],))
+        def view(request, snapshot):
+            self.calls.append(request.GET['page'])
+            return HttpResponse(request.GET['page'] * int(request.GET['n']))
+        self.view = view
+
+    def get(self, version, page, n=1, **headers):
+        request = RequestFactory().get('/', {'page': page, 'n': n},
+                                       **headers)
+        return self.view(request, mock.Mock(version=version))
+
+    def test_cached_per_version(self):
+        first = self.get('1', 'a')
+        self.assertEqual(self.get('1', 'a').content, b'a')
+        self.assertEqual(self.calls, ['a'])
+        self.get('2', 'a')
+        self.assertEqual(self.calls, ['a', 'a'])
+
+        response = self.get('1', 'a', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_large_responses_not_cached(self):
+        self.get('1', 'b', 11)
+        self.get('1', 'b', 11)
+        self.assertEqual(self.calls, ['b', 'b'])
+
+
+class StreamingSnapshotTests(SnapshotDirTestCase):
+    """Snapshots held by streaming responses."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(snapshot, '_current', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        staging_dir = snapshot.start_snapshot()
+        self.stage_all(staging_dir)
+        snapshot.publish_snapshot(staging_dir)
+
+        @snapshot.with_snapshot
+        def view(request, used_snapshot):
+            self.used = used_snapshot
+            return StreamingHttpResponse(iter([b'a', b'b']))
+        self.view = view
+
+    def test_released_when_closed_unread(self):
+        response = self.view(RequestFactory().get('/'))
+        self.assertEqual(self.used.users, 1)
+        response.close()
+        self.assertEqual(self.used.users, 0)
+
+    def test_released_once_after_streaming(self):
+        response = self.view(RequestFactory().get('/'))
+        self.assertEqual(b''.join(response), b'ab')
+        response.close()
+        response.close()
+        self.assertEqual(self.used.users, 0)
+
+
+@override_settings(
+    CACHES={'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }},
+    PTO_RESPONSE_CACHE='responses'
+)
+class FeeEventViewTests(TestCase):
+    """Fee events of patents outside the snapshot's patent sets."""
+
+    def setUp(self):
+        fee_event_index = mock.Mock()
+        fee_event_index.events.return_value = None
+        used = mock.Mock(version='1', fee_codes={'M1551': 'Payment'})
+        used.fee_event_index.return_value = fee_event_index
+        for name, value in [('acquire_snapshot', lambda: used),
+                            ('release_snapshot', lambda released: None)]:
+            patcher = mock.patch.object(snapshot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def batch(self, patents):
+        request = RequestFactory().get('/', {
+            'patents': ','.join(str(patent) for patent in patents)
+        })
+        return views.batch_fee_events(request)
+
+    def test_unknown_codes_described_as_empty(self):
+        patent = create_patent('7000001')
+        for code in ['M1551', 'N/A']:
+            FeeEvents.objects.create(patent=patent, maintenance_code=code,
+                                     maintenance_date=date(2019, 1, 2))
+        response = self.batch([patent.pk])
+        self.assertEqual(response.status_code, 200)
+        events = json.loads(response.content)['events'][str(patent.pk)]
+        self.assertEqual(sorted(events), [['2019-01-02', 'M1551', 'Payment'],
+                                          ['2019-01-02', 'N/A', '']])
+
+    def test_batch_size_capped(self):
+        patents = range(1, MAX_BATCH_PATENTS+2)
+        self.assertEqual(self.batch(patents).status_code, 400)
+        self.assertEqual(self.batch(patents[1:]).status_code, 200)
+
+
+class FeeFileTests(SimpleTestCase):
+    """Parsing the maintenance fee file."""
+
+    def test_records_match_baseline(self):
+        records = list(fee_records(FEE_LINES))
+        self.assertEqual(sorted(records), baseline_fee_records(FEE_LINES))
+        self.assertEqual(records[1][5:], (date(2003, 8, 25), 'N/A'))
+
+    def test_repeat_after_other_patent_raises(self):
+        lines = FEE_LINES[:1] + FEE_LINES[4:5] + FEE_LINES[:1]
+        with self.assertRaises(ValueError):
+            list(fee_records(lines))
+
+
+class FeeDeltaTests(SimpleTestCase):
+    """Finding the fee entries that changed since the previous week."""
+
+    def test_delta_matches_set_difference(self):
+        old_lines = FEE_LINES[:6] + ['00004000010 10000009 N 19990301 '
+                                     '20040105 20110105 M1551\n']
+        new_lines = FEE_LINES + ['00004000020 10000010 Y 19990301 '
+                                 '20040105 20110105 M2551\n']
+        added, removed = fingerprint_delta(line_fingerprints(old_lines),
+                                           line_fingerprints(new_lines))
+        # the original update kept last week's lines and took differences
+        self.assertEqual(sorted(matching_lines(new_lines, added)),
+                         sorted(set(new_lines).difference(old_lines)))
+        removed_lines = set(matching_lines(old_lines, removed))
+        self.assertEqual(removed_lines,
+                         set(old_lines).difference(new_lines))
+
+        with tempfile.TemporaryDirectory() as mdir, \
+                mock.patch('builtins.print'):
+            self.assertIsNone(pto_cron.write_removed_lines(mdir, set()))
+            path = pto_cron.write_removed_lines(mdir, removed_lines)
+            with open(path) as removed_text:
+                self.assertEqual(removed_text.readlines(),
+                                 sorted(removed_lines))
+
+
+def fee_tables():
+    """Get the patents and fee events in the database, without their ids."""
+    return (
+        sorted(Patent.objects.values_list(
+            'patent_number', 'application_number', 'entity_status',
+            'application_date', 'issue_date'
+        )),
+        sorted(FeeEvents.objects.values_list(
+            'patent__patent_number', 'maintenance_date', 'maintenance_code'
+        ))
+    )
+
+
+def baseline_initial_load(lines):
+    """Load fee lines into empty tables the way the original initial build
+    did, creating each patent and fee event with its own query.
+    """
+    patents = {}
+    for record in baseline_fee_records(lines):
+        if record[0] not in patents:
+            patents[record[0]] = Patent.objects.create(
+                patent_number=record[0], application_number=record[1],
+                entity_status=record[2], application_date=record[3],
+                issue_date=record[4]
+            )
+        FeeEvents.objects.create(patent=patents[record[0]],
+                                 maintenance_date=record[5],
+                                 maintenance_code=record[6])
+
+
+def baseline_weekly_update(lines):
+    """Load new fee lines the way the original weekly update did, with
+    queries for every record.
+    """
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[1].startswith('59'):
+            continue
+        record = fee_record(fields)
+        patent = Patent.objects.filter(patent_number=record[0]).first()
+        if patent is None:
+            patent = Patent.objects.create(
+                patent_number=record[0], application_number=record[1],
+                application_date=record[3], issue_date=record[4]
+            )
+        patent.entity_status = record[2]
+        patent.save()
+        FeeEvents.objects.get_or_create(patent=patent,
+                                        maintenance_date=record[5],
+                                        maintenance_code=record[6])
+
+
+class FeeLoaderTests(TestCase):
+    """Loading the parsed maintenance fee file into the database."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'maintfees.txt')
+        zip_path = os.path.join(temp_dir.name, 'maintfees.zip')
+        synthetic_fee_zip(zip_path, 300)
+        with open(self.path, 'w') as text_file:
+            text_file.writelines(zip_fee_lines(zip_path))
+        fee_chunks = maintfees.fee_chunks
+        patcher = mock.patch.object(maintfees, 'fee_chunks',
+                                    lambda path: fee_chunks(path, 1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parallel_load_matches_record_load(self):
+        with open(self.path) as text_file:
+            BulkLoader().load(fee_records(text_file))
+        expected = fee_tables()
+        FeeEvents.objects.all().delete()
+        Patent.objects.all().delete()
+
+        loader = BulkLoader(batch_size=100).load_file(self.path, 2)
+        self.assertEqual(fee_tables(), expected)
+        self.assertEqual(loader.counts, {'patents': len(expected[0]),
+                                         'fee events': len(expected[1])})
+        # ids follow the file order, like those of the record load
+        numbers = list(Patent.objects.order_by('id').values_list(
+            'patent_number', flat=True
+        ))
+        self.assertEqual(numbers, sorted(numbers, key=int))
+
+    def test_bulk_load_matches_baseline(self):
+        with open(self.path) as text_file:
+            lines = FEE_LINES + text_file.readlines()
+        baseline_initial_load(lines)
+        expected = fee_tables()
+        FeeEvents.objects.all().delete()
+        Patent.objects.all().delete()
+
+        BulkLoader(batch_size=50).load(fee_records(lines))
+        self.assertEqual(fee_tables(), expected)
+
+    def test_upsert_matches_baseline(self):
+        week_lines = [
+            # a new event and entity status for a loaded patent
+            '00004000007 10000001 N 19990301 20040105 20120312 M2552\n',
+            # an event the patent already has
+            '00004000014 10000002 N 19990301 20040105 20110105 EXP.\n',
+            # a new patent, with its status changing within the week
+            '00004000021 10000003 Y 20000301 20050105 20090105 M1551\n',
+            '00004000021 10000003 N 20000301 20050105 20130105 M2552\n',
+        ]
+        BulkLoader().load(fee_records(FEE_LINES))
+        baseline_weekly_update(week_lines)
+        expected = fee_tables()
+        FeeEvents.objects.all().delete()
+        Patent.objects.all().delete()
+
+        BulkLoader().load(fee_records(FEE_LINES))
+        loader = UpsertLoader(batch_size=2).load(fee_records(week_lines))
+        self.assertEqual(fee_tables(), expected)
+        self.assertEqual(loader.counts, {
+            'patents created': 1, 'patents updated': 1, 'patents skipped': 1,
+            'fee events created': 3, 'fee events skipped': 1
+        })
+
+    def test_unsorted_chunks_raise(self):
+        with open(self.path) as text_file:
+            lines = text_file.readlines()
+        with open(self.path, 'w') as text_file:
+            text_file.writelines(lines[len(lines)//2:] +
+                                 lines[:len(lines)//2])
+        with self.assertRaises(ValueError):
+            BulkLoader().load_file(self.path, 2)
+
+
+class BulkDataStandIn(BaseHTTPRequestHandler):
+    """Local stand-in for bulkdata.uspto.gov, serving the files of its
+    server with ETags and Range requests. Paths in the server's failures
+    are answered with the statuses listed there first, and paths in its
+    cuts have that many transfers cut short. Requests are logged.
+    """
+
+    def send_file(self, with_body):
+        server = self.server
+        server.log.append((self.command, self.path,
+                           self.headers.get('Range')))
+        if server.failures.get(self.path):
+            self.send_error(server.failures[self.path].pop(0))
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        data = server.files[self.path]
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        start = 0
+        if self.headers.get('Range') and \
+                self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if with_body:
+            if server.cuts.get(self.path):
+                server.cuts[self.path] -= 1
+                body = body[:len(body)//2]
+                self.close_connection = True
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(PTO_MIRROR_MAX_BYTES=2**30)
+class DownloadTests(SimpleTestCase):
+    """Downloads through the mirror, from a local stand-in server."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+        mirror_dir = os.path.join(temp_dir.name, 'mirror')
+        patcher = mock.patch.multiple(
+            downloads, MIRROR_DIR=mirror_dir,
+            INDEX_FILE=os.path.join(mirror_dir, 'index.json')
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(downloads.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.makedirs(mirror_dir)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BulkDataStandIn)
+        self.server.files, self.server.failures = {}, {}
+        self.server.cuts, self.server.log = {}, []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def download(self, path):
+        local_path = os.path.join(self.temp_dir, path.split('/')[-1])
+        downloads.download(self.url(path), local_path)
+        with open(local_path, 'rb') as local_file:
+            return local_file.read()
+
+    def requests_made(self, command):
+        return [request for request in self.server.log
+                if request[0] == command]
+
+    def test_resumes_cut_transfer(self):
+        data = os.urandom(3*downloads.CHUNK_SIZE)
+        self.server.files['/ad20200102.zip'] = data
+        self.server.cuts['/ad20200102.zip'] = 1
+        self.assertEqual(self.download('/ad20200102.zip'), data)
+        # the chunk written before the cut isn't downloaded again
+        gets = self.requests_made('GET')
+        self.assertEqual([get[2] for get in gets],
+                         [None, 'bytes=%d-' % downloads.CHUNK_SIZE])
+
+    def test_mirror_hit(self):
+        data = os.urandom(1000)
+        self.server.files['/csv.zip'] = data
+        self.download('/csv.zip')
+        self.server.log.clear()
+        self.assertEqual(self.download('/csv.zip'), data)
+        self.assertEqual(self.requests_made('GET'), [])
+
+        # a new version of the file is downloaded again
+        self.server.files['/csv.zip'] = b'new'
+        self.assertEqual(self.download('/csv.zip'), b'new')
+        self.assertEqual(len(self.requests_made('GET')), 1)
+
+    def test_client_errors_fail_fast(self):
+        self.assertRaises(requests.HTTPError, self.download,
+                          '/ad20991231.zip')
+        self.assertEqual(len(self.requests_made('GET')), 1)
+
+    def test_server_errors_retried(self):
+        self.server.files['/maint.zip'] = b'fees'
+        self.server.failures['/maint.zip'] = [503, 429, 500]
+        self.assertEqual(self.download('/maint.zip'), b'fees')
+        self.assertEqual([request[0] for request in self.server.log],
+                         ['HEAD']*4 + ['GET'])
+
+    def test_least_recently_used_evicted(self):
+        for name in ('a', 'b', 'c'):
+            self.server.files['/%s.zip' % name] = name.encode()*600
+        with self.settings(PTO_MIRROR_MAX_BYTES=1500):
+            self.download('/a.zip')
+            self.download('/b.zip')
+            self.download('/a.zip')
+            self.download('/c.zip')
+        index = downloads._load_index()
+        self.assertEqual(sorted(index),
+                         [self.url('/a.zip'), self.url('/c.zip')])
+        for entry in index.values():
+            self.assertTrue(os.path.exists(
+                downloads.mirror_path(entry['sha256'])
+            ))
+
+
+class PatentsViewClientTests(SimpleTestCase):
+    """PatentsView fetches, from a local stand-in of the API."""
+
+    beginning = date(2015, 1, 1)
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = temp_dir.name
+        self.ranges = patentsview.week_ranges(
+            self.beginning, self.beginning+timedelta(20)
+        )
+
+    def standin(self, **attributes):
+        server = start_patentsview_standin(per_day=30, latency=0,
+                                           **attributes)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def api_client(self, server, **options):
+        options = dict({'rate_limit': 60000, 'backoff': 0.01,
+                        'per_page': 100}, **options)
+        return patentsview.PatentsViewClient(server.url, self.cache_dir,
+                                             **options)
+
+    def fetch(self, server, **options):
+        client = self.api_client(server, **options)
+        with mock.patch('builtins.print'):
+            return client, client.patents(self.ranges)
+
+    def test_failed_requests_retried(self):
+        _, expected = self.fetch(self.standin())
+        for cached in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, cached))
+        server = self.standin(failure_rate=3)
+        client, results = self.fetch(server)
+        self.assertEqual(results, expected)
+        self.assertEqual(len(results), 4)
+        self.assertGreater(client.counts['retried'], 0)
+        self.assertEqual(server.requests,
+                         client.counts['fetched']+client.counts['retried'])
+
+    def test_requests_rate_limited(self):
+        server = self.standin()
+        start = time.monotonic()
+        client, _ = self.fetch(server, rate_limit=600)
+        # 0.1 seconds between requests, the first one right away
+        self.assertEqual(client.counts['fetched'], 12)
+        self.assertGreaterEqual(time.monotonic()-start, 1.1)
+
+    def test_retry_after_honored(self):
+        server = self.standin(failure_rate=4, failure_status=429,
+                              retry_after=1)
+        start = time.monotonic()
+        client, results = self.fetch(server)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(client.counts['retried'], 3)
+        self.assertGreaterEqual(time.monotonic()-start, 3)
+
+    def test_failed_weeks_dropped(self):
+        broken = self.ranges[1][0].isoformat()
+        server = self.standin(broken_starts=(broken,))
+        client, results = self.fetch(server)
+        self.assertEqual(sorted(results),
+                         self.ranges[:1] + self.ranges[2:])
+        # a 404 isn't retried
+        self.assertEqual(client.counts['retried'], 0)
+        self.assertEqual(server.requests, 10)
+
+    def test_cache_hits(self):
+        server = self.standin()
+        _, fetched = self.fetch(server)
+        requests_made = server.requests
+        client, cached = self.fetch(server)
+        self.assertEqual(cached, fetched)
+        self.assertEqual(server.requests, requests_made)
+        self.assertEqual(client.counts['cached'], requests_made)
+
+    def test_old_pages_pruned(self):
+        server = self.standin()
+        client, _ = self.fetch(server)
+        pages = sorted(os.listdir(self.cache_dir))
+        old = time.time() - patentsview.CACHE_DAYS*86400 - 60
+        os.utime(os.path.join(self.cache_dir, pages[0]), (old, old))
+        client.prune_cache()
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), pages[1:])
+
+
+class ApiAssigneeTests(SimpleTestCase):
+    """Matching PatentsView results with patents missing an assignee."""
+
+    def result(self, number, organization='ACME'):
+        assignee = dict.fromkeys(ANAMES)
+        assignee['assignee_organization'] = organization
+        return {'patent_number': number, 'assignees': [assignee]}
+
+    def test_matched_and_skipped(self):
+        results = [
+            self.result('1'), self.result('1', 'OTHER'), self.result('2'),
+            self.result('3', 'X'*300), {'patent_number': '4'},
+            self.result('5')
+        ]
+        empties = {'1': 11, '3': 13, '4': 14, '5': 15}
+        updates, matched = pto_cron.api_assignee_updates(results, empties)
+        self.assertEqual(matched, 5)
+        self.assertEqual(sorted(updates), [11, 15])
+        self.assertEqual(updates[11][0], 'ACME')
+
+
+# Rows of the assignment csv files, joined on their rf_id column. 4 has no
+# assignee, 5 no patent in the database, and 6 reassigns the patent of 1
+ASSIGNMENT_CSV = {
+    'assignment': [
+        ['1', 'x', 'LAW LLP', '1 Main St', 'Suite 2', '', 'Boston', '11',
+         '22'],
+        ['2', 'x', 'IP GROUP', '9 Elm St', '', 'MA', '02110', '12', '23'],
+        ['4', 'x', 'NOBODY', '', '', '', '', '13', '24'],
+        ['5', 'x', 'ELSEWHERE', '', '', '', '', '14', '25'],
+        ['6', 'x', 'LATER LLP', '2 Oak St', '', '', '', '15', '26'],
+    ],
+    'documentid': [
+        ['1', 'x', 'x', '10000000', '19980209', 'x', 'x', 'x', 'x',
+         '4000000', '20030825'],
+        ['2', 'x', 'x', '10000001', '19990301', 'x', 'x', 'x', 'x',
+         '4000007', '20040105'],
+        ['3', 'x', 'x', '10000002', '19990301', 'x', 'x', 'x', 'x',
+         '4000014', '20040105'],
+        ['4', 'x', 'x', '10000002', '19990301', 'x', 'x', 'x', 'x',
+         '4000014', '20040105'],
+        ['5', 'x', 'x', '10000009', '19990301', 'x', 'x', 'x', 'x',
+         '9999999', '20040105'],
+        ['6', 'x', 'x', '10000000', '19980209', 'x', 'x', 'x', 'x',
+         '4000000', '20030825'],
+    ],
+    'assignee': [
+        ['1', 'ACME', '1 Road', 'Springfield'],
+        ['2', 'FIRST CO', 'A St'],
+        ['2', 'SECOND CO', 'B St', 'Town'],
+        ['3', 'UNUSED', ''],
+        ['5', 'ELSE CO', ''],
+        ['6', 'ACME HOLDINGS', ''],
+    ],
+}
+
+
+def assignment_csv_zip(zip_path):
+    """Write the ASSIGNMENT_CSV files, with their column labels, into a zip
+    file laid out like the USPTO's.
+    """
+    with zipfile.ZipFile(zip_path, 'w') as csv_zip:
+        for name, rows in ASSIGNMENT_CSV.items():
+            text = io.StringIO()
+            writer = csv.writer(text)
+            writer.writerow(['rf_id'] + ['column']*(len(rows[0])-1))
+            writer.writerows(rows)
+            csv_zip.writestr('csv/%s.csv' % name, text.getvalue())
+
+
+def baseline_csv_updates(patent_ids):
+    """Join the ASSIGNMENT_CSV rows with the nested loops of the original
+    initial_assignment_data, getting the same patent id -> values of
+    ASSIGNMENT_FIELDS as assignment_updates.
+    """
+    mapped_data = {}
+    for row in ASSIGNMENT_CSV['assignment']:
+        rfid = ''
+        for i, col in enumerate(row):
+            if i == 0:
+                rfid = col
+                mapped_data[rfid] = {}
+            if i == 2:
+                mapped_data[rfid]['correspondent_name'] = col
+            if 2 < i < 7:
+                if 'correspondent_address' not in mapped_data[rfid]:
+                    mapped_data[rfid]['correspondent_address'] = col
+                else:
+                    mapped_data[rfid]['correspondent_address'] += '\n' + col
+            if i == 7:
+                mapped_data[rfid]['reel_num'] = col
+            if i == 8:
+                mapped_data[rfid]['frame_num'] = col
+    for row in ASSIGNMENT_CSV['documentid']:
+        if row[0] in mapped_data:
+            mapped_data[row[0]]['patent_number'] = row[9]
+    for row in ASSIGNMENT_CSV['assignee']:
+        rfid = ''
+        for i, col in enumerate(row):
+            if i == 0:
+                rfid = col
+            if rfid in mapped_data:
+                if i == 1:
+                    mapped_data[rfid]['assignee_name'] = col
+                if i > 1:
+                    if 'assignee_address' not in mapped_data[rfid]:
+                        mapped_data[rfid]['assignee_address'] = col
+                    else:
+                        mapped_data[rfid]['assignee_address'] += '\n'+col
+
+    # patents were saved one assignment at a time, skipping any error
+    updates = {}
+    for pat in mapped_data.values():
+        try:
+            pk = patent_ids[pat['patent_number']]
+            updates[pk] = tuple(pat[key] for key in [
+                'reel_num', 'frame_num', 'correspondent_name',
+                'correspondent_address', 'assignee_name', 'assignee_address'
+            ])
+        except KeyError:
+            pass
+    return updates
+
+
+class AssignmentCsvTests(SimpleTestCase):
+    """Joining the assignment economics csv files."""
+
+    def test_join_matches_nested_loops(self):
+        patent_ids = {'4000000': 1, '4000007': 2, '4000014': 3}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, 'csv.zip')
+            assignment_csv_zip(zip_path)
+            with zipfile.ZipFile(zip_path) as csv_zip:
+                updates = assignment_updates(csv_zip, patent_ids)
+        self.assertEqual(updates, baseline_csv_updates(patent_ids))
+        self.assertEqual(sorted(updates), [1, 2])
+        self.assertEqual(dict(zip(ASSIGNMENT_FIELDS, updates[2])), {
+            'reel_num': '12', 'frame_num': '23',
+            'correspondent_name': 'IP GROUP',
+            'correspondent_address': '9 Elm St\n\nMA\n02110',
+            'pat_assignee_name': 'SECOND CO',
+            'pat_assignee_address': 'A St\nB St\nTown'
+        })
+
+
+# An assignment xml file: the second assignment has no correspondent name,
+# and the last has a number too long to be a patent or application number
+ASSIGNMENT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<us-patent-assignments>
+<patent-assignments>
+<patent-assignment>
+ <assignment-record>
+  <reel-no>11</reel-no><frame-no>22</frame-no>
+  <correspondent><name>LAW LLP</name><address-1>1 Main St</address-1>
+   <address-2></address-2><address-3>Boston</address-3></correspondent>
+ </assignment-record>
+ <patent-assignees><patent-assignee><name>ACME</name>
+  <address-1>1 Road</address-1><city>Springfield</city>
+ </patent-assignee></patent-assignees>
+ <patent-properties><patent-property>
+  <document-id><doc-number>10000000</doc-number></document-id>
+  <document-id><doc-number>4000000</doc-number></document-id>
+ </patent-property></patent-properties>
+</patent-assignment>
+<patent-assignment>
+ <assignment-record><reel-no>12</reel-no><frame-no>23</frame-no>
+  <correspondent><address-1>Nowhere</address-1></correspondent>
+ </assignment-record>
+ <patent-properties><patent-property>
+  <document-id><doc-number>10000001</doc-number></document-id>
+ </patent-property></patent-properties>
+</patent-assignment>
+<patent-assignment>
+ <assignment-record><reel-no>13</reel-no><frame-no>24</frame-no>
+  <correspondent><name>IP GROUP</name></correspondent></assignment-record>
+ <patent-assignees><patent-assignee><name>FIRST CO</name></patent-assignee>
+  <patent-assignee><name>SECOND CO</name><city>Town</city></patent-assignee>
+ </patent-assignees>
+ <patent-properties>
+  <patent-property>
+   <document-id><doc-number>10000001</doc-number></document-id>
+  </patent-property>
+  <patent-property>
+   <document-id><doc-number>4000014</doc-number></document-id>
+  </patent-property>
+ </patent-properties>
+</patent-assignment>
+<patent-assignment>
+ <assignment-record><reel-no>14</reel-no><frame-no>25</frame-no>
+  <correspondent><name>LATER LLP</name></correspondent></assignment-record>
+ <patent-assignees><patent-assignee><name>OTHER</name></patent-assignee>
+ </patent-assignees>
+ <patent-properties><patent-property>
+  <document-id><doc-number>4000007</doc-number></document-id>
+  <document-id><doc-number>10000001</doc-number></document-id>
+  <document-id><doc-number>US20040012345</doc-number></document-id>
+ </patent-property></patent-properties>
+</patent-assignment>
+</patent-assignments>
+</us-patent-assignments>
+'''
+
+
+def assignment_xml_zip(zip_path):
+    """Write ASSIGNMENT_XML into a zip file named like the USPTO's daily
+    files, with the xml file named after it.
+    """
+    xml_name = os.path.basename(zip_path).replace('zip', 'xml')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as xml_zip:
+        xml_zip.writestr(xml_name, ASSIGNMENT_XML)
+
+
+def baseline_xml_records(xml_file):
+    """Parse a whole assignment xml file with ET.parse and the loops of the
+    original process_assignment_xml, into assignment records.
+    """
+    records = []
+    for assignment in ET.parse(xml_file).getroot().findall(
+            './patent-assignments/'):
+        reel_num, frame_num, correspondent_name, pat_assignee_name = \
+            '', '', '', ''
+        correspondent_addys, pat_addys, all_doc_nums = [], [], []
+        for record in list(assignment):
+            if record.tag == 'assignment-record':
+                for assignee_field in list(record):
+                    if assignee_field.tag == 'reel-no':
+                        reel_num = assignee_field.text
+                    if assignee_field.tag == 'frame-no':
+                        frame_num = assignee_field.text
+                    if assignee_field.tag == 'correspondent':
+                        for cfield in list(assignee_field):
+                            if cfield.tag == 'name':
+                                correspondent_name = cfield.text
+                            else:
+                                correspondent_addys.append(cfield.text)
+            if record.tag == 'patent-assignees':
+                for pat_assignee in record.findall('./patent-assignee'):
+                    for pat_address in list(pat_assignee):
+                        if pat_address.tag == 'name':
+                            pat_assignee_name = pat_address.text
+                        else:
+                            pat_addys.append(pat_address.text)
+            if record.tag == 'patent-properties':
+                for pat_assignee in record.findall('./patent-property'):
+                    doc_nums = []
+                    for doc_record in pat_assignee.findall('.//document-id'):
+                        doc_num = doc_record.find('./doc-number').text
+                        if len(doc_num) < 10:
+                            doc_nums.append(doc_num)
+                    all_doc_nums.append(doc_nums)
+        records.append((
+            reel_num, frame_num, correspondent_name,
+            '\n'.join([addy for addy in correspondent_addys if addy]),
+            pat_assignee_name, '\n'.join([addy for addy in pat_addys if addy]),
+            all_doc_nums
+        ))
+    return records
+
+
+def baseline_resolved_updates(records):
+    """Apply assignment records with the per-record queries of the original
+    process_assignment_xml, returning the patent id -> values of
+    ASSIGNMENT_FIELDS it saved. The original also saved all but the last
+    value as 1-tuples, which is left out.
+    """
+    updates = {}
+    for record in records:
+        for pat_app_nums in record[6]:
+            parent_patent = ''
+            if len(pat_app_nums) == 1:
+                try:
+                    parent_patent = Patent.objects.get(
+                        application_number=pat_app_nums[0]
+                    )
+                except Exception:
+                    try:
+                        parent_patent = Patent.objects.get(
+                            patent_number=pat_app_nums[0]
+                        )
+                    except Exception:
+                        pass
+            if len(pat_app_nums) == 2:
+                try:
+                    parent_patent = Patent.objects.get(
+                        application_number=pat_app_nums[0],
+                        patent_number=pat_app_nums[1]
+                    )
+                except Exception:
+                    try:
+                        parent_patent = Patent.objects.get(
+                            application_number=pat_app_nums[-1],
+                            patent_number=pat_app_nums[0]
+                        )
+                    except Exception:
+                        pass
+            if parent_patent and record[2] != '' and \
+                    parent_patent.correspondent_name == '':
+                for field, value in zip(ASSIGNMENT_FIELDS, record):
+                    setattr(parent_patent, field, value)
+                parent_patent.save()
+                updates[parent_patent.pk] = record[:6]
+    return updates
+
+
+class BackfillDate(date):
+    """A date whose today() is the third day of daily assignment files."""
+
+    @classmethod
+    def today(cls):
+        return cls(2020, 1, 4)
+
+
+class AssignmentXmlTests(TestCase):
+    """Parsing the assignment xml files and applying them to patents."""
+
+    def setUp(self):
+        # pto_cron keeps its files relative to the working directory
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.ad_dir = os.path.join(temp_dir.name, 'ad')
+        work_dir = os.path.join(temp_dir.name, 'fees', 'fees')
+        os.makedirs(os.path.join(self.ad_dir, 'adzips'))
+        os.makedirs(work_dir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(work_dir)
+        self.patents = [
+            create_patent('4000000', application_number='10000000'),
+            create_patent('4000007', application_number='10000001'),
+            create_patent('4000014', application_number='10000002'),
+        ]
+
+    def fake_download(self, url, path):
+        assignment_xml_zip(path)
+
+    def test_iterparse_matches_parse(self):
+        xml_file = io.BytesIO(ASSIGNMENT_XML.encode())
+        records = list(xml_assignments(xml_file))
+        xml_file.seek(0)
+        self.assertEqual(records, baseline_xml_records(xml_file))
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0][3:6], ('1 Main St\nBoston', 'ACME',
+                                           '1 Road\nSpringfield'))
+
+    def test_resolver_matches_queries(self):
+        # an application number shared by two patents, and a patent whose
+        # correspondent is missing rather than empty
+        create_patent('4000021', application_number='10000005')
+        create_patent('4000028', application_number='10000005')
+        create_patent('4000035', application_number='10000006',
+                      correspondent_name=None)
+        records = list(xml_assignments(io.BytesIO(ASSIGNMENT_XML.encode())))
+        records.append(('15', '26', 'NEW LLP', '', 'NEW CO', '', [
+            ['10000005'], ['4000021', '10000005'], ['10000006']
+        ]))
+        updates = pto_cron.patent_resolver().updates(records)
+        self.assertEqual(updates, baseline_resolved_updates(records))
+        self.assertEqual(len(updates), 4)
+
+    def test_members_read_in_place(self):
+        zip_path = os.path.join(self.ad_dir, 'adzips', 'ad20200102.zip')
+        assignment_xml_zip(zip_path)
+        # the original update extracted the xml file next to the zip file
+        with zipfile.ZipFile(zip_path) as xml_zip:
+            xml_zip.extractall(self.ad_dir)
+            with xml_zip.open('ad20200102.xml') as xml_file:
+                records = list(xml_assignments(xml_file))
+        xml_path = os.path.join(self.ad_dir, 'ad20200102.xml')
+        with open(xml_path, 'rb') as xml_file:
+            self.assertEqual(records, list(xml_assignments(xml_file)))
+        os.remove(xml_path)
+
+        with mock.patch.object(pto_cron, 'download', self.fake_download):
+            pto_cron.process_assignment_xml('ad20200103.zip')
+        self.assertEqual(sorted(os.listdir(self.ad_dir)), ['adzips'])
+        self.assertEqual(
+            sorted(Patent.objects.values_list('patent_number',
+                                              'correspondent_name')),
+            [('4000000', 'LAW LLP'), ('4000007', 'IP GROUP'),
+             ('4000014', 'IP GROUP')]
+        )
+
+    def test_ledger_resumes_after_failed_zip(self):
+        zip_files = ['ad19800101-20191231-%02d.zip' % i for i in range(1, 18)]
+        zip_files += ['ad20200101.zip', 'ad20200102.zip', 'ad20200103.zip']
+        # the original backfill processed the files one after the other
+        with mock.patch.object(pto_cron, 'download', self.fake_download):
+            for zip_file in zip_files:
+                pto_cron.process_assignment_xml(zip_file)
+        fields = ['patent_number'] + ASSIGNMENT_FIELDS
+        expected = sorted(Patent.objects.values_list(*fields))
+        Patent.objects.update(reel_num=None, frame_num=None,
+                              correspondent_name='',
+                              correspondent_address=None,
+                              pat_assignee_name='', pat_assignee_address=None)
+        # zip files left from earlier runs would count as finished
+        for zip_file in zip_files:
+            os.remove(os.path.join(self.ad_dir, 'adzips', zip_file))
+
+        downloads, failures = [], ['ad20200102.zip']
+
+        def failing_download(url, path):
+            downloads.append(os.path.basename(path))
+            if downloads[-1] in failures:
+                failures.remove(downloads[-1])
+                raise IOError('connection reset')
+            self.fake_download(url, path)
+
+        with mock.patch.multiple(pto_cron, date=BackfillDate,
+                                 download=failing_download,
+                                 publish_patent_store=mock.DEFAULT):
+            with self.assertRaises(IOError):
+                pto_cron.initial_pto_assignment_data(workers=2)
+            ledger = JobLedger('assignment_ledger.json')
+            self.assertEqual([ledger.state(zip_file) for zip_file in
+                              zip_files[-3:]], ['applied', None, None])
+            self.assertIn('connection reset',
+                          ledger.entries['ad20200102.zip']['error'])
+
+            del downloads[:]
+            pto_cron.initial_pto_assignment_data(workers=2)
+        ledger = JobLedger('assignment_ledger.json')
+        self.assertEqual({ledger.state(zip_file) for zip_file in zip_files},
+                         {'applied'})
+        self.assertEqual(downloads, ['ad20200102.zip', 'ad20200103.zip'])
+        self.assertEqual(sorted(Patent.objects.values_list(*fields)),
+                         expected)
@@ -1,8 +1,11 @@
 from django.urls import path
-from .views import update_patents, update_fee_events
+from .views import (update_patents, update_fee_events, batch_fee_events,
+    export_patents)
 
 
 urlpatterns = [
     path('update_patents', update_patents),
     path('update_fee_events', update_fee_events),
+    path('batch_fee_events', batch_fee_events),
+    path('export_patents', export_patents),
 ]
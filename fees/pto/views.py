@@ -8,25 +8,35 @@ fee events are loaded using the django framework.
 from __future__ import unicode_literals
 
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import (HttpResponse, HttpResponseBadRequest, JsonResponse,
+    StreamingHttpResponse)
 
-from pto.serializers import PatentSerializer
-from pto.extras import get_ordered_data, get_fee_codes, get_paid_patents
-from pto.constants import PAT_PARAM_CONVERSION
+from pto.cache import cached_response
+from pto.export import EXPORT_FORMATS, gzip_rows
+from pto.snapshot import with_snapshot
+from pto.constants import (PAT_PARAM_CONVERSION, ORDERED_PATS,
+    MAX_BATCH_PATENTS)
 from pto.models import FeeEvents
 
 
-# Load ordered dictionaries/sorted lists built from patent sets
-ORDERED_DICT, ORDERED_QS = get_ordered_data()
+def patents_cache_key(query):
+    """Normalized update_patents parameters used to cache its responses."""
+    return (query['patent_set'], query['sort_by'],
+            query['descending'] == 'true', query['unpaid'] == 'true',
+            query.get('filter') or None, int(query['start_row']),
+            int(query['count']))
 
-# Mainenance fee codes defined by the USPTO
-FEE_CODES = get_fee_codes()
 
-# Patents that have already been paid for each patent set
-PAID_PATENTS = get_paid_patents()
+def fee_events_cache_key(query):
+    """Normalized fee event parameters used to cache their responses."""
+    patents = query.get('patents') or query['patent']
+    return (tuple(int(patent) for patent in patents.split(',')),
+            query.get('patent_set') or None)
 
 
-def update_patents(request):
+@with_snapshot
+@cached_response(patents_cache_key)
+def update_patents(request, snapshot):
     """(Re)load sorted, filtered paginated patent data using Vue.js and
     Quasar framework and routes. Returns serialized queryset and total
     patent document counts.
@@ -43,37 +53,127 @@ def update_patents(request):
     filt = request.GET.get('filter', default=None)
     if descending == 'true':
         sort_by = '-'+sort_by
-    pats_to_remove = set()
+
+    # paid patents are already removed from the unpaid orderings
+    ordered_ids = snapshot.ordered_docs(set_id)
+    if unpaid == 'true':
+        ordered_ids = ordered_ids['unpaid']
+    if filt:
+        number_index = snapshot.number_index(set_id)
+        matches = number_index.search(filt, sort_by, unpaid == 'true')
+        pats_to_load = number_index.patent_ids(matches[start_row:end_row])
+        pats_count = len(matches)
+    else:
+        pats_to_load = ordered_ids[sort_by][start_row:end_row]
+        pats_count = ordered_ids['count']
+
+    # rows are encoded when the patent store is built, so the page only has
+    # to be joined into the same JSON that JsonResponse would produce
+    queryset = snapshot.patent_store.json_rows(pats_to_load)
+    queryset_and_counts = b'{"patents": [%s], "count": %d}' % (queryset,
+                                                              pats_count)
+    return HttpResponse(queryset_and_counts, content_type='application/json')
+
+
+@with_snapshot
+def export_patents(request, snapshot):
+    """Stream a whole patent set as CSV or NDJSON (given by the format
+    parameter), sorted and filtered the same way as update_patents, and
+    optionally gzipped.
+    """
+    params = request.GET
+    patent_set = str(params['patent_set'])
+    set_id = PAT_PARAM_CONVERSION[patent_set]
+    sort_by = params['sort_by']
+    descending = params['descending']
+    unpaid = params['unpaid']
+    filt = params.get('filter', default=None)
+    export_format = params.get('format', default='csv')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Unknown export format')
+    if descending == 'true':
+        sort_by = '-'+sort_by
+
+    # rows are generated lazily from the orderings, only the ids of the
+    # patents matching a filter are held in memory
+    ordered_ids = snapshot.ordered_docs(set_id)
     if unpaid == 'true':
-        pats_to_remove = PAID_PATENTS[set_id]
-    pats_to_load = []
+        ordered_ids = ordered_ids['unpaid']
     if filt:
-        [pats_to_load.append(ORDERED_QS[set_id][pat])
-         for pat in ORDERED_DICT[set_id][sort_by]
-         if filt in str(ORDERED_QS[set_id][pat].patent_number)
-         and pat not in pats_to_remove]
-        pats_count = len(pats_to_load)
-        pats_to_load = pats_to_load[start_row:end_row]
+        number_index = snapshot.number_index(set_id)
+        matches = number_index.search(filt, sort_by, unpaid == 'true')
+        pats_to_export = (number_index.ids[pos] for pos in matches)
     else:
-        [pats_to_load.append(ORDERED_QS[set_id][pat])
-         for pat in [x for x in ORDERED_DICT[set_id][sort_by]
-                     if x not in pats_to_remove][start_row:end_row]]
-        if unpaid == 'true':
-            pats_count = ORDERED_DICT[set_id]['count'] - len(pats_to_remove)
-        else:
-            pats_count = ORDERED_DICT[set_id]['count']
-    queryset = [PatentSerializer(p).data for p in pats_to_load]
-    queryset_and_counts = {'patents': queryset, 'count': pats_count}
-    return JsonResponse(queryset_and_counts)
-
-
-def update_fee_events(request):
+        pats_to_export = ordered_ids[sort_by]
+
+    export_rows, content_type = EXPORT_FORMATS[export_format]
+    rows = export_rows(snapshot.patent_store, pats_to_export)
+    filename = set_id + '.' + export_format
+    if params.get('gzip') == 'true':
+        rows = gzip_rows(rows)
+        content_type = 'application/gzip'
+        filename += '.gz'
+    response = StreamingHttpResponse(rows, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+@with_snapshot
+@cached_response(fee_events_cache_key)
+def update_fee_events(request, snapshot):
     """Load Mainenance Fee Event records for each selected patent using
     django framework and templates.
     """
     patent = int(request.GET['patent'])
-    fee_events = FeeEvents.objects.filter(patent_id=patent)
-    event_results = [[event.maintenance_date, event.maintenance_code,
-                      FEE_CODES[event.maintenance_code]] for event in fee_events]
+    patent_set = request.GET.get('patent_set', default=None)
+    event_results = get_fee_events(snapshot, [patent], patent_set)[patent]
     context = {'event_results': event_results}
     return render(request, 'pto/events.html', context)
+
+
+@with_snapshot
+@cached_response(fee_events_cache_key)
+def batch_fee_events(request, snapshot):
+    """Load the Mainenance Fee Event records of several patents at once,
+    given as comma separated patent ids. Returns the [date, code,
+    description] events of each patent, for up to MAX_BATCH_PATENTS
+    patents.
+    """
+    patents = [int(patent) for patent in request.GET['patents'].split(',')]
+    if len(patents) > MAX_BATCH_PATENTS:
+        return HttpResponseBadRequest(
+            'At most %d patents per batch' % MAX_BATCH_PATENTS
+        )
+    patent_set = request.GET.get('patent_set', default=None)
+    event_results = get_fee_events(snapshot, patents, patent_set)
+    return JsonResponse({'events': event_results})
+
+
+def get_fee_events(snapshot, patents, patent_set=None):
+    """Get the fee events of each patent from the fee event indexes of the
+    snapshot, only querying the database for patents outside every patent
+    set (or outside patent_set, when it is given).
+    """
+    set_ids = ORDERED_PATS
+    if patent_set:
+        set_ids = [PAT_PARAM_CONVERSION[patent_set]]
+    event_results = {}
+    for set_id in set_ids:
+        fee_event_index = snapshot.fee_event_index(set_id)
+        for patent in patents:
+            if patent not in event_results:
+                patent_events = fee_event_index.events(patent)
+                if patent_events is not None:
+                    event_results[patent] = patent_events
+
+    missing = [patent for patent in patents if patent not in event_results]
+    if missing:
+        for patent in missing:
+            event_results[patent] = []
+        fee_events = FeeEvents.objects.filter(patent_id__in=missing)
+        for event in fee_events:
+            event_results[event.patent_id].append([
+                event.maintenance_date, event.maintenance_code,
+                snapshot.fee_codes.get(event.maintenance_code, '')
+            ])
+    return event_results